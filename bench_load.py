@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Benchmark di carico offline di /api/v1/query
+
+Invia query concorrenti al server e riporta p50/p95/p99 e throughput per ogni
+livello di concorrenza, sia a freddo (prime richieste dopo l'avvio, con pool
+degli agent vuoto e sessioni MCP da aprire) sia a caldo (dopo il riscaldamento).
+
+Con --spawn avvia da solo lo stub LLM (bench_stub_llm.py), lo stub MCP
+(bench_stub_mcp.py) e mcp_server.py con una configurazione temporanea che punta
+agli stub, quindi non servono chiavi API né server esterni. Il server viene
+riavviato a ogni livello per misurare le richieste a freddo.
+
+Uso:
+    python bench_load.py --spawn
+    python bench_load.py --spawn --concurrency 1,8,32 --requests 200 --llm-latency 0.5
+    python bench_load.py --url http://localhost:8000 --concurrency 4,16 --json risultati.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PROMPT = "recupera i dati di benchmark e riassumili"
+
+
+def _percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(pct) - 1]
+
+
+def _wait_port(host: str, port: int, timeout: float, process: subprocess.Popen):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Processo terminato durante l'avvio: {' '.join(process.args)}")
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"Timeout in attesa della porta {host}:{port}")
+
+
+def _spawn(args, env=None, log_file=None) -> subprocess.Popen:
+    output = open(log_file, "ab") if log_file else subprocess.DEVNULL
+    return subprocess.Popen([sys.executable, *args], cwd=HERE, env=env, stdout=output, stderr=subprocess.STDOUT)
+
+
+def _stop(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+@contextmanager
+def stub_servers(args):
+    """Avvia gli stub LLM e MCP e scrive la configurazione temporanea che li usa"""
+    processes = [
+        _spawn(["bench_stub_llm.py", "--port", str(args.llm_port), "--latency", str(args.llm_latency),
+                "--tokens-per-second", str(args.tokens_per_second), "--tool-rounds", str(args.tool_rounds)],
+               log_file=args.log_file),
+        _spawn(["bench_stub_mcp.py", "--port", str(args.mcp_port), "--tools", str(args.tools),
+                "--tool-latency", str(args.tool_latency)],
+               log_file=args.log_file)
+    ]
+    config = {
+        "mcpServers": {"bench": {"url": f"http://127.0.0.1:{args.mcp_port}/sse", "description": "Stub MCP di benchmark"}},
+        "providers": {
+            "openrouter": {
+                "model": "bench/stub-model",
+                "base_url": f"http://127.0.0.1:{args.llm_port}",
+                "models": ["bench/stub-model"]
+            }
+        },
+        "default_provider": "openrouter",
+        "max_steps": args.max_steps
+    }
+    fd, config_path = tempfile.mkstemp(prefix="bench_mcp_config_", suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    try:
+        _wait_port("127.0.0.1", args.llm_port, 15, processes[0])
+        _wait_port("127.0.0.1", args.mcp_port, 15, processes[1])
+        yield config_path
+    finally:
+        for process in processes:
+            _stop(process)
+        os.unlink(config_path)
+
+
+@contextmanager
+def mcp_server(args, config_path: str):
+    """Avvia mcp_server.py sugli stub; ogni avvio riparte da pool e sessioni vuote"""
+    env = {
+        **os.environ,
+        "MCP_CONFIG_FILE": config_path,
+        "MCP_SERVER_HOST": "127.0.0.1",
+        "MCP_SERVER_PORT": str(args.server_port),
+        "MCP_SERVER_DEBUG": "false",
+        "MCP_USE_ANONYMIZED_TELEMETRY": "false",
+        "OPENROUTER_API_KEY": "bench",
+        "RESPONSE_CACHE_ENABLED": "false",
+        "ADMISSION_MAX_CONCURRENT": os.environ.get("ADMISSION_MAX_CONCURRENT", str(max(args.levels))),
+        "ADMISSION_MAX_QUEUE": os.environ.get("ADMISSION_MAX_QUEUE", str(max(args.levels) * 4))
+    }
+    process = _spawn(["mcp_server.py"], env=env, log_file=args.log_file)
+    try:
+        _wait_port("127.0.0.1", args.server_port, 60, process)
+        yield f"http://127.0.0.1:{args.server_port}"
+    finally:
+        _stop(process)
+
+
+async def _query(session: aiohttp.ClientSession, url: str, payload: dict):
+    start = time.perf_counter()
+    try:
+        async with session.post(f"{url}/api/v1/query", json=payload) as response:
+            await response.read()
+            return response.status, time.perf_counter() - start
+    except aiohttp.ClientError:
+        return 0, time.perf_counter() - start
+
+
+async def run_batch(url: str, concurrency: int, total: int, args, tag: str):
+    """Esegue `total` query con `concurrency` richieste sempre in volo; un utente diverso per richiesta"""
+    counter = iter(range(total))
+    results = []
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        async def worker():
+            for index in counter:
+                payload = {
+                    "prompt": args.prompt,
+                    "user_id": f"bench-{tag}-{index}",
+                    "max_steps": args.max_steps,
+                    "use_context": False,
+                    "use_cache": False
+                }
+                results.append(await _query(session, url, payload))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+    return results, wall
+
+
+def summarize(mode: str, concurrency: int, results, wall: float) -> dict:
+    latencies = sorted(seconds * 1000 for status, seconds in results if status == 200)
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(latencies),
+        "errors": len(results) - len(latencies),
+        "p50_ms": round(_percentile(latencies, 50), 1),
+        "p95_ms": round(_percentile(latencies, 95), 1),
+        "p99_ms": round(_percentile(latencies, 99), 1),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else 0.0
+    }
+
+
+def print_row(row: dict):
+    print(f"{row['mode']:<6} {row['concurrency']:>5} {row['requests']:>6} {row['errors']:>6} "
+          f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['throughput_rps']:>9.2f}")
+
+
+async def measure_level(url: str, concurrency: int, args, cold: bool):
+    rows = []
+    if cold:
+        # Richieste a freddo: un'ondata pari alla concorrenza subito dopo l'avvio del server
+        results, wall = await run_batch(url, concurrency, concurrency, args, f"cold{concurrency}")
+        rows.append(summarize("cold", concurrency, results, wall))
+        print_row(rows[-1])
+    if args.warmup:
+        await run_batch(url, concurrency, args.warmup, args, f"warmup{concurrency}")
+    results, wall = await run_batch(url, concurrency, args.requests, args, f"warm{concurrency}")
+    rows.append(summarize("warm", concurrency, results, wall))
+    print_row(rows[-1])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di carico offline di /api/v1/query")
+    parser.add_argument("--url", default="http://localhost:8000", help="Server già avviato (ignorato con --spawn)")
+    parser.add_argument("--spawn", action="store_true", help="Avvia stub LLM, stub MCP e mcp_server.py")
+    parser.add_argument("--concurrency", default="1,4,16", help="Livelli di concorrenza separati da virgola")
+    parser.add_argument("--requests", type=int, default=50, help="Richieste misurate a caldo per livello")
+    parser.add_argument("--warmup", type=int, default=10, help="Richieste di riscaldamento non misurate per livello")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT)
+    parser.add_argument("--max-steps", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout per richiesta (secondi)")
+    parser.add_argument("--json", dest="json_file", default=None, help="Salva i risultati in un file JSON")
+    parser.add_argument("--log-file", default=None, help="File per l'output dei processi avviati con --spawn")
+    spawn_group = parser.add_argument_group("opzioni di --spawn")
+    spawn_group.add_argument("--server-port", type=int, default=8765)
+    spawn_group.add_argument("--llm-port", type=int, default=9100)
+    spawn_group.add_argument("--mcp-port", type=int, default=9200)
+    spawn_group.add_argument("--llm-latency", type=float, default=0.2, help="Latenza del primo token dello stub LLM")
+    spawn_group.add_argument("--tokens-per-second", type=float, default=100.0)
+    spawn_group.add_argument("--tool-rounds", type=int, default=1, help="Chiamate ai tool per query")
+    spawn_group.add_argument("--tools", type=int, default=3, help="Tool esposti dallo stub MCP")
+    spawn_group.add_argument("--tool-latency", type=float, default=0.05)
+    args = parser.parse_args()
+    args.levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+
+    print("🏁 Benchmark di carico /api/v1/query")
+    print("=" * 72)
+    print(f"{'modo':<6} {'conc.':>5} {'richieste':>6} {'errori':>6} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}")
+
+    rows = []
+    if args.spawn:
+        with stub_servers(args) as config_path:
+            for concurrency in args.levels:
+                with mcp_server(args, config_path) as url:
+                    rows += asyncio.run(measure_level(url, concurrency, args, cold=True))
+    else:
+        print("(server esterno: solo misure a caldo, le richieste a freddo richiedono --spawn)")
+        for concurrency in args.levels:
+            rows += asyncio.run(measure_level(args.url.rstrip("/"), concurrency, args, cold=False))
+
+    if args.json_file:
+        with open(args.json_file, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+        print(f"💾 Risultati salvati in {args.json_file}")
+
+
+if __name__ == "__main__":
+    main()
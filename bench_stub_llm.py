@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Server LLM fittizio compatibile OpenAI per i benchmark offline
+
+Espone POST /chat/completions (anche sotto /api/v1 come OpenRouter) con latenza
+del primo token e velocità di generazione configurabili, in modalità normale e
+in streaming SSE. Se la richiesta contiene dei tool e la conversazione ha meno
+risultati di tool di --tool-rounds, risponde con una chiamata al primo tool così
+da esercitare anche il ciclo agent -> server MCP.
+
+Uso:
+    python bench_stub_llm.py --port 9100 --latency 0.2 --tokens-per-second 80
+    python bench_stub_llm.py --tool-rounds 2 --completion-tokens 120
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+WORDS = ["benchmark", "risposta", "sintetica", "del", "modello", "fittizio", "per", "misurare", "il", "server"]
+
+
+def _sample_arguments(schema: dict) -> dict:
+    """Costruisce argomenti validi per un tool a partire dal suo JSON schema"""
+    samples = {"integer": 1, "number": 1.0, "boolean": True, "array": [], "object": {}}
+    properties = schema.get("properties") or {}
+    return {
+        name: samples.get((properties.get(name) or {}).get("type"), "bench")
+        for name in schema.get("required") or []
+    }
+
+
+class StubLLM:
+    """Genera risposte con tempi controllati e tiene il conto delle richieste servite"""
+
+    def __init__(self, latency: float, jitter: float, tokens_per_second: float,
+                 completion_tokens: int, tool_rounds: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.tool_rounds = tool_rounds
+        self.requests = 0
+
+    def _first_token_delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _tool_call(self, payload: dict):
+        """Chiamata al primo tool se la conversazione non ha ancora esaurito i giri previsti"""
+        tools = payload.get("tools") or []
+        tool_results = sum(1 for message in payload.get("messages", []) if message.get("role") == "tool")
+        if not tools or tool_results >= self.tool_rounds:
+            return None
+        function = tools[0].get("function") or {}
+        return {
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {
+                "name": function.get("name"),
+                "arguments": json.dumps(_sample_arguments(function.get("parameters") or {}))
+            }
+        }
+
+    def _usage(self, payload: dict, completion_tokens: int) -> dict:
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in payload.get("messages", [])) // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+    def _tokens(self, payload: dict):
+        count = min(self.completion_tokens, payload.get("max_tokens") or self.completion_tokens)
+        return [WORDS[i % len(WORDS)] + " " for i in range(count)]
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        self.requests += 1
+        model = payload.get("model", "bench-model")
+        tool_call = self._tool_call(payload)
+
+        await asyncio.sleep(self._first_token_delay())
+
+        if payload.get("stream"):
+            return await self._stream(request, payload, model, tool_call)
+
+        if tool_call:
+            message = {"role": "assistant", "content": "", "tool_calls": [tool_call]}
+            finish_reason, completion_tokens = "tool_calls", 10
+        else:
+            tokens = self._tokens(payload)
+            await asyncio.sleep(self._token_delay() * len(tokens))
+            message = {"role": "assistant", "content": "".join(tokens).strip()}
+            finish_reason, completion_tokens = "stop", len(tokens)
+
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": self._usage(payload, completion_tokens)
+        })
+
+    async def _stream(self, request: web.Request, payload: dict, model: str, tool_call) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        async def send(delta: dict, finish_reason=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        if tool_call:
+            await send({"role": "assistant", "tool_calls": [{"index": 0, **tool_call}]})
+            await send({}, "tool_calls")
+        else:
+            delay = self._token_delay()
+            for index, token in enumerate(self._tokens(payload)):
+                if index and delay:
+                    await asyncio.sleep(delay)
+                await send({"content": token})
+            await send({}, "stop")
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests})
+
+
+def create_app(stub: StubLLM) -> web.Application:
+    app = web.Application()
+    for prefix in ("", "/v1", "/api/v1"):
+        app.router.add_post(f"{prefix}/chat/completions", stub.handle)
+    app.router.add_get("/stats", stub.stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server LLM fittizio compatibile OpenAI per benchmark offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.2, help="Secondi prima del primo token")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Variazione casuale (±secondi) della latenza")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0, help="Velocità di generazione (0 = istantanea)")
+    parser.add_argument("--completion-tokens", type=int, default=40, help="Token generati per risposta")
+    parser.add_argument("--tool-rounds", type=int, default=1, help="Chiamate ai tool prima della risposta finale")
+    args = parser.parse_args()
+
+    stub = StubLLM(args.latency, args.jitter, args.tokens_per_second, args.completion_tokens, args.tool_rounds)
+    print(f"🤖 Stub LLM su http://{args.host}:{args.port}/chat/completions "
+          f"(latenza {args.latency}s, {args.tokens_per_second} token/s, {args.tool_rounds} giri di tool)")
+    web.run_app(create_app(stub), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
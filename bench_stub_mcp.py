@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Server MCP fittizio (FastMCP su SSE) per i benchmark offline
+
+Registra N tool con latenza e dimensione della risposta configurabili, così da
+misurare il server senza database o servizi esterni. I tool possono essere
+descritti anche in un file JSON:
+
+    [{"name": "cerca", "latency": 0.05, "payload_bytes": 2048, "description": "..."}]
+
+Uso:
+    python bench_stub_mcp.py --port 9200 --tools 5 --tool-latency 0.05
+    python bench_stub_mcp.py --tools-file bench_tools.json
+"""
+
+import argparse
+import asyncio
+import json
+import random
+
+from mcp.server.fastmcp import FastMCP
+
+
+def _make_tool(name: str, latency: float, jitter: float, payload_bytes: int):
+    """Crea la funzione del tool: attende la latenza e restituisce un testo della dimensione richiesta"""
+    async def tool(query: str) -> str:
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+        header = f"{name}: risultato per '{query}'\n"
+        return header + "x" * max(0, payload_bytes - len(header))
+    return tool
+
+
+def load_tool_specs(args) -> list:
+    if args.tools_file:
+        with open(args.tools_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return [{"name": f"bench_tool_{i + 1}"} for i in range(args.tools)]
+
+
+def create_server(specs: list, host: str, port: int, latency: float, jitter: float, payload_bytes: int) -> FastMCP:
+    mcp = FastMCP("bench-stub", host=host, port=port, log_level="WARNING")
+    for spec in specs:
+        name = spec["name"]
+        mcp.add_tool(
+            _make_tool(
+                name,
+                float(spec.get("latency", latency)),
+                float(spec.get("jitter", jitter)),
+                int(spec.get("payload_bytes", payload_bytes))
+            ),
+            name=name,
+            description=spec.get("description", f"Tool di benchmark {name}: restituisce dati sintetici per la query")
+        )
+    return mcp
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server MCP fittizio su SSE per benchmark offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--tools", type=int, default=3, help="Numero di tool generati")
+    parser.add_argument("--tools-file", default=None, help="File JSON con la definizione dei tool")
+    parser.add_argument("--tool-latency", type=float, default=0.05, help="Latenza di default di ogni tool (secondi)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Variazione casuale (±secondi) della latenza")
+    parser.add_argument("--payload-bytes", type=int, default=512, help="Dimensione di default della risposta dei tool")
+    args = parser.parse_args()
+
+    specs = load_tool_specs(args)
+    server = create_server(specs, args.host, args.port, args.tool_latency, args.jitter, args.payload_bytes)
+    print(f"🔧 Stub MCP su http://{args.host}:{args.port}/sse con {len(specs)} tool")
+    server.run(transport="sse")
+
+
+if __name__ == "__main__":
+    main()
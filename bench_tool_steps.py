@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark dei passi MCP con e senza function calling nativo di OpenRouter
+
+Esegue gli stessi prompt con native_tools attivo e disattivo, usando i server
+MCP e il provider configurati in mcp_config.json, e confronta chiamate LLM,
+chiamate ai tool e tempo per query.
+
+Uso:
+    python bench_tool_steps.py
+    python bench_tool_steps.py --model openai/gpt-4o-mini --runs 3 --prompt "elenca le tabelle"
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MCP_USE_ANONYMIZED_TELEMETRY", "false")
+
+from mcp_server import MCPService, http_pool
+
+DEFAULT_PROMPTS = [
+    "elenca le tabelle disponibili nel database",
+    "quanti record ci sono nella tabella rubrica?",
+    "mostra i primi 3 record della tabella rubrica ordinati per nome",
+]
+
+
+async def _measure(service: MCPService, native_tools: bool, model: str, prompts, runs: int, max_steps: int):
+    config = service._default_llm_config("openrouter", model)
+    client = service._create_mcp_client()
+    entry = await service._create_agent(config, client)
+    if entry is None:
+        raise SystemExit("Impossibile creare l'agent: controllare OPENROUTER_API_KEY e i server MCP")
+    entry.llm.native_tools = native_tools
+
+    results = []
+    try:
+        for prompt in prompts:
+            for _ in range(runs):
+                llm_calls = tool_calls = 0
+                start = time.perf_counter()
+                async for event in entry.agent.stream_events(query=prompt, max_steps=max_steps):
+                    kind = event.get("event")
+                    if kind == "on_chat_model_start":
+                        llm_calls += 1
+                    elif kind == "on_tool_start":
+                        tool_calls += 1
+                results.append({
+                    "prompt": prompt,
+                    "llm_calls": llm_calls,
+                    "tool_calls": tool_calls,
+                    "seconds": time.perf_counter() - start
+                })
+    finally:
+        await client.close_all_sessions()
+    return results
+
+
+def _report(label: str, results):
+    llm_calls = [r["llm_calls"] for r in results]
+    tool_calls = [r["tool_calls"] for r in results]
+    seconds = [r["seconds"] for r in results]
+    print(f"{label:<12} query: {len(results):>3}  "
+          f"chiamate LLM medie: {statistics.mean(llm_calls):5.2f}  "
+          f"chiamate tool medie: {statistics.mean(tool_calls):5.2f}  "
+          f"tempo medio: {statistics.mean(seconds):6.2f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Confronta i passi MCP con e senza function calling nativo")
+    parser.add_argument("--model", default=None, help="Modello OpenRouter (default: quello in mcp_config.json)")
+    parser.add_argument("--prompt", action="append", help="Prompt da eseguire (ripetibile)")
+    parser.add_argument("--runs", type=int, default=1, help="Esecuzioni per prompt")
+    parser.add_argument("--max-steps", type=int, default=10, help="Passi massimi dell'agent")
+    args = parser.parse_args()
+
+    service = MCPService()
+    prompts = args.prompt or DEFAULT_PROMPTS
+
+    print("🧪 Benchmark passi MCP (OpenRouter)")
+    print("=" * 50)
+    try:
+        for label, native in (("nativo", True), ("solo testo", False)):
+            results = await _measure(service, native, args.model, prompts, args.runs, args.max_steps)
+            _report(label, results)
+    finally:
+        await http_pool.close()
+        service.memory_store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
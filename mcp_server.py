@@ -4,29 +4,49 @@ MCP Server con supporto per Gemini e OpenRouter
 Server HTTP che espone API per interagire con MCP usando diversi provider AI
 """
 
+import time
+
+# Istante di inizio dell'import del modulo, per il report dei tempi di avvio
+_IMPORT_STARTED = time.perf_counter()
+
 import os
+import copy
 import json
 import asyncio
+import importlib
+import importlib.util
 import logging
-from typing import Dict, Any, Optional, List
-from datetime import datetime
+from typing import Dict, Any, Optional, List, Tuple, AsyncIterator, Awaitable, Callable, ClassVar, Literal
+from datetime import datetime, timedelta
+import sqlite3
+import threading
 import traceback
-from collections import defaultdict, deque
+import re
+import hashlib
+import uuid
+import heapq
+import itertools
+import math
+import random
+from collections import defaultdict, deque, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 
 # FastAPI imports
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, PrivateAttr
 import uvicorn
 
 # Environment and utilities
 from dotenv import load_dotenv
 import requests
 
-# Environment and utilities
-from dotenv import load_dotenv
-import requests
+# Importazioni aggiuntive per connessioni HTTP/SSE
+import aiohttp
+from urllib.parse import urljoin, urlparse
 
 # Caricate le variabili d'ambiente
 load_dotenv()
@@ -38,46 +58,62 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Importazioni MCP e LangChain
+# Importazioni LangChain: le classi base servono alle definizioni del modulo.
+# mcp_use e i pacchetti dei provider sono importati solo quando servono (vedi LazyImports)
 try:
-    from mcp_use import MCPAgent, MCPClient
-    from langchain_openai import ChatOpenAI
-    from langchain_google_genai import ChatGoogleGenerativeAI
     from langchain_core.language_models.chat_models import BaseChatModel
-    from langchain_core.messages import BaseMessage, AIMessage, HumanMessage, SystemMessage
-    from langchain_core.outputs import ChatGeneration, ChatResult
-    from langchain_core.callbacks.manager import CallbackManagerForLLMRun
-    MCP_AVAILABLE = True
-    logger.info("MCP e LangChain disponibili")
+    from langchain_core.messages import BaseMessage, AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+    from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+    from langchain_core.output_parsers.openai_tools import parse_tool_call, make_invalid_tool_call
+    from langchain_core.utils.function_calling import convert_to_openai_tool
+    from langchain_core.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+    from langchain_core.callbacks import AsyncCallbackHandler
+    MCP_AVAILABLE = importlib.util.find_spec("mcp_use") is not None
+    if MCP_AVAILABLE:
+        logger.info("MCP e LangChain disponibili")
+    else:
+        logger.error("MCP non disponibile: pacchetto mcp_use non installato")
 except ImportError as e:
     logger.error(f"MCP o LangChain non disponibili: {e}")
     MCP_AVAILABLE = False
 
-# Importazioni aggiuntive per connessioni HTTP/SSE
-import aiohttp
-from urllib.parse import urljoin, urlparse
-
-# Configurazione logging
-logging.basicConfig(
-    level=os.getenv('LOG_LEVEL', 'INFO'),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+class LazyImports:
+    """Import differiti dei pacchetti pesanti (mcp_use, SDK dei provider) con i tempi di caricamento"""
+    
+    # Pacchetti richiesti dai provider; OpenRouter usa il client HTTP interno
+    PROVIDER_MODULES = {"gemini": "langchain_google_genai"}
+    
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    def load(self, module: str, name: str) -> Any:
+        """Restituisce module.name, importando il modulo alla prima richiesta"""
+        with self._lock:
+            if module not in self.timings:
+                started = time.perf_counter()
+                importlib.import_module(module)
+                self.timings[module] = round(time.perf_counter() - started, 3)
+                logger.info(f"Modulo {module} importato in {self.timings[module]:.2f}s")
+        return getattr(importlib.import_module(module), name)
+    
+    def modules_for(self, config: Dict[str, Any]) -> List[str]:
+        """Moduli necessari per i server MCP e i provider abilitati nella configurazione"""
+        modules = ["mcp_use"]
+        for name, provider in config.get("providers", {}).items():
+            module = self.PROVIDER_MODULES.get(name)
+            if module and not provider.get("disabled", False) and module not in modules:
+                modules.append(module)
+        return modules
+    
+    def preload(self, modules: List[str]):
+        for module in modules:
+            try:
+                self.load(module, "__name__")
+            except ImportError as e:
+                logger.warning(f"Import di {module} non riuscito: {e}")
 
-# Importazioni MCP e LangChain
-try:
-    from mcp_use import MCPAgent, MCPClient
-    from langchain_openai import ChatOpenAI
-    from langchain_google_genai import ChatGoogleGenerativeAI
-    from langchain_core.language_models.chat_models import BaseChatModel
-    from langchain_core.messages import BaseMessage, AIMessage, HumanMessage, SystemMessage
-    from langchain_core.outputs import ChatGeneration, ChatResult
-    from langchain_core.callbacks.manager import CallbackManagerForLLMRun
-    MCP_AVAILABLE = True
-    logger.info("MCP e LangChain disponibili")
-except ImportError as e:
-    logger.error(f"MCP o LangChain non disponibili: {e}")
-    MCP_AVAILABLE = False
+lazy_imports = LazyImports()
 
 # Modelli Pydantic per API
 class ConversationMessage(BaseModel):
@@ -98,6 +134,8 @@ class MCPQueryRequest(BaseModel):
     system_prompt: Optional[str] = Field(None, description="Prompt di sistema opzionale")
     prompt_file: Optional[str] = Field(None, description="Nome del file di prompt da usare (senza estensione)")
     use_context: Optional[bool] = Field(True, description="Se includere il contesto delle conversazioni precedenti")
+    use_cache: Optional[bool] = Field(True, description="Se usare la cache delle risposte (solo con use_context false)")
+    priority: Literal["high", "normal", "low"] = Field("normal", description="Priorità in coda quando il server è al limite")
 
 class MCPQueryResponse(BaseModel):
     response: str = Field(..., description="Risposta del modello AI")
@@ -109,6 +147,28 @@ class MCPQueryResponse(BaseModel):
     conversation_id: str = Field(..., description="ID della conversazione")
     context_used: bool = Field(..., description="Se è stato utilizzato il contesto precedente")
     context_messages_count: int = Field(..., description="Numero di messaggi del contesto utilizzati")
+    context_tokens: int = Field(0, description="Token stimati del contesto conversazione inclusi nel prompt")
+    prompt_tokens: int = Field(0, description="Token stimati del prompt completo inviato all'agent")
+    summary_used: bool = Field(False, description="Se il prompt include il riassunto dei turni precedenti")
+    cached: bool = Field(False, description="Se la risposta proviene dalla cache")
+
+class MCPBatchRequest(BaseModel):
+    items: List[MCPQueryRequest] = Field(..., min_length=1, description="Query indipendenti da eseguire")
+    concurrency: Optional[int] = Field(None, ge=1, description="Query del batch eseguite in parallelo (default BATCH_CONCURRENCY)")
+
+class JobInfo(BaseModel):
+    job_id: str = Field(..., description="ID del job da usare in GET /api/v1/jobs/{job_id}")
+    status: Literal["queued", "running", "succeeded", "failed", "cancelled"] = Field(..., description="Stato del job")
+    created_at: str = Field(..., description="Timestamp di creazione")
+    started_at: Optional[str] = Field(None, description="Timestamp di inizio dell'esecuzione")
+    finished_at: Optional[str] = Field(None, description="Timestamp di fine dell'esecuzione")
+    execution_time: Optional[float] = Field(None, description="Durata dell'esecuzione in secondi")
+    user_id: str = Field(..., description="ID dell'utente della query")
+    worker_pid: int = Field(..., description="Processo worker che esegue il job")
+    result: Optional[MCPQueryResponse] = Field(None, description="Risposta della query se il job è riuscito")
+    error: Optional[str] = Field(None, description="Errore se il job è fallito o annullato")
+    status_code: Optional[int] = Field(None, description="Codice HTTP dell'errore se il job è fallito")
+    cancel_requested: bool = Field(False, description="Annullamento richiesto a un job di un altro worker")
 
 class ProviderInfo(BaseModel):
     name: str
@@ -116,18 +176,41 @@ class ProviderInfo(BaseModel):
     default_model: str
     available: bool
 
+class PromptInfo(BaseModel):
+    name: str = Field(..., description="Nome del prompt da usare in prompt_file")
+    file: str = Field(..., description="Percorso del file del prompt")
+    characters: int = Field(..., description="Lunghezza del prompt in caratteri")
+    modified: str = Field(..., description="Data di ultima modifica del file")
+    preview: str = Field(..., description="Prime righe del prompt")
+
 class ServerStatus(BaseModel):
     status: str
     version: str
     mcp_available: bool
     providers: List[ProviderInfo]
     uptime: str
+    agent_pool: Optional[Dict[str, Any]] = None
+    response_cache: Optional[Dict[str, Any]] = None
+    tool_calls: Optional[Dict[str, Any]] = None
+    tool_cache: Optional[Dict[str, Any]] = None
+    mcp_servers: Optional[Dict[str, Any]] = None
+    admission: Optional[Dict[str, Any]] = None
+    rate_limits: Optional[Dict[str, Any]] = None
+    llm_calls: Optional[Dict[str, Any]] = None
+    routing: Optional[Dict[str, Any]] = None
+    tracing: Optional[Dict[str, Any]] = None
+    jobs: Optional[Dict[str, Any]] = None
 
 # Modelli per la gestione della memoria delle conversazioni
 class MemoryStatsResponse(BaseModel):
     memory_limit: int = Field(..., description="Limite massimo di messaggi per utente")
     default_user_id: str = Field(..., description="ID utente di default")
+    backend: str = Field("memory", description="Backend di memorizzazione (memory, sqlite)")
     active_users: int = Field(..., description="Numero di utenti attivi con conversazioni")
+    total_bytes: int = Field(0, description="Spazio stimato occupato dai messaggi in byte")
+    limits: Dict[str, Any] = Field(default_factory=dict, description="Limiti globali (TTL inattività, utenti, byte)")
+    evictions: Dict[str, int] = Field(default_factory=dict, description="Utenti rimossi per motivo (ttl, max_users, max_bytes)")
+    summaries: Dict[str, Any] = Field(default_factory=dict, description="Stato del riassunto incrementale delle conversazioni")
     users: Dict[str, Dict[str, Any]] = Field(..., description="Statistiche per ogni utente")
 
 class ClearMemoryRequest(BaseModel):
@@ -139,6 +222,1290 @@ class ClearMemoryResponse(BaseModel):
     cleared_user: Optional[str] = Field(None, description="ID dell'utente pulito")
     users_cleared: int = Field(..., description="Numero di utenti le cui conversazioni sono state pulite")
 
+def worker_count() -> int:
+    """Numero di processi worker del server: lo stato in memoria (pool, code, limiti) è per worker"""
+    return max(1, int(os.getenv('MCP_SERVER_WORKERS', 1)))
+
+# Pool di connessioni HTTP condiviso per le chiamate ai provider AI
+class HTTPClientPool:
+    """Sessione aiohttp condivisa con keep-alive e limiti di connessione per host"""
+    
+    def __init__(self):
+        self.limit = int(os.getenv('HTTP_POOL_LIMIT', 100))
+        self.limit_per_host = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 20))
+        self.keepalive_timeout = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 30))
+        self.connect_timeout = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+        self.request_timeout = float(os.getenv('REQUEST_TIMEOUT', 30))
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop = None
+        self._closing: set = set()
+        
+        # Sessione sincrona usata solo dal percorso _generate (fuori dall'event loop)
+        self.sync_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.limit_per_host,
+            pool_maxsize=self.limit_per_host
+        )
+        self.sync_session.mount("https://", adapter)
+        self.sync_session.mount("http://", adapter)
+    
+    def get_session(self) -> aiohttp.ClientSession:
+        """Restituisce la sessione condivisa, creandola sull'event loop corrente se necessario"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            if self._session is not None and not self._session.closed:
+                self._discard_session(self._session, self._loop)
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.request_timeout,
+                connect=self.connect_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._loop = loop
+            logger.debug(f"Sessione HTTP creata - limit: {self.limit}, limit_per_host: {self.limit_per_host}, "
+                         f"keepalive: {self.keepalive_timeout}s, timeout: {self.request_timeout}s")
+        return self._session
+    
+    def _discard_session(self, session: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop):
+        """Chiude la sessione creata su un altro event loop, che altrimenti terrebbe aperti connettore e socket"""
+        if loop.is_running():
+            # Il loop originale è ancora attivo (es. in un altro thread): la chiusura va eseguita lì
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            # Loop chiuso o fermo: aiohttp rilascia le connessioni senza usarlo
+            task = asyncio.get_running_loop().create_task(self._close_stale(session))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        logger.debug("Event loop cambiato: chiusa la sessione HTTP precedente")
+    
+    @staticmethod
+    async def _close_stale(session: aiohttp.ClientSession):
+        try:
+            await session.close()
+        except Exception as e:
+            logger.debug(f"Chiusura della sessione HTTP precedente non completata: {e}")
+    
+    async def close(self):
+        """Chiude la sessione condivisa e le connessioni persistenti"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("Sessione HTTP condivisa chiusa")
+        self._session = None
+        self._loop = None
+        self.sync_session.close()
+
+http_pool = HTTPClientPool()
+
+# Metriche in formato Prometheus (registro interno, senza dipendenze esterne)
+class _Metric:
+    """Base delle metriche: valori indicizzati per combinazione di etichette"""
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+    
+    @staticmethod
+    def _escape(value: Any) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    
+    @classmethod
+    def _format_labels(cls, names, values, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(names, values)) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{cls._escape(value)}"' for name, value in pairs) + "}"
+    
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+    
+    def dump(self) -> List[list]:
+        """Valori correnti serializzabili in JSON, per condividerli con gli altri worker"""
+        with self._lock:
+            return [[list(key), copy.deepcopy(value)] for key, value in self._values.items()]
+    
+    def merge(self, items: List[list]):
+        raise NotImplementedError
+    
+    def empty_copy(self) -> "_Metric":
+        clone = copy.copy(self)
+        clone._values = {}
+        clone._lock = threading.Lock()
+        return clone
+    
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+class Counter(_Metric):
+    kind = "counter"
+    
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+    
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+    
+    def merge(self, items: List[list]):
+        with self._lock:
+            for key, value in items:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0.0) + value
+    
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{self._format_labels(self.labels, key)} {value:g}" for key, value in items]
+
+class Gauge(Counter):
+    kind = "gauge"
+    
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+class Histogram(_Metric):
+    kind = "histogram"
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+    
+    def merge(self, items: List[list]):
+        with self._lock:
+            for key, (counts, total, count) in items:
+                entry = self._values.setdefault(tuple(key), [[0] * len(self.buckets), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+    
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = sorted((key, (list(entry[0]), entry[1], entry[2])) for key, entry in self._values.items())
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{self._format_labels(self.labels, key, ('le', f'{bound:g}'))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{self._format_labels(self.labels, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(self.labels, key)} {total:g}")
+            lines.append(f"{self.name}_count{self._format_labels(self.labels, key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Registro delle metriche esposte da /metrics
+    
+    Con shared_dir ogni worker salva periodicamente le proprie metriche in un file
+    della directory e /metrics restituisce la somma di tutti i worker, qualunque
+    processo risponda allo scrape. Contatori e istogrammi dei worker terminati
+    restano nel totale (così non decrescono), i gauge contano solo i processi vivi.
+    """
+    
+    def __init__(self, shared_dir: Optional[str] = None):
+        self._metrics: Dict[str, _Metric] = {}
+        self.shared_dir = shared_dir
+        # Funzioni che aggiornano i gauge prima di ogni render o salvataggio
+        self.collectors: List[Any] = []
+    
+    def collect(self):
+        for collector in self.collectors:
+            collector()
+    
+    def _register(self, metric: _Metric) -> Any:
+        return self._metrics.setdefault(metric.name, metric)
+    
+    def counter(self, name: str, description: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, description, labels))
+    
+    def gauge(self, name: str, description: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, description, labels))
+    
+    def histogram(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets=Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, labels, buckets))
+    
+    def _snapshot_path(self, pid: int) -> str:
+        return os.path.join(self.shared_dir, f"metrics_{pid}.json")
+    
+    def write_snapshot(self):
+        """Salva le metriche di questo worker nella directory condivisa (scrittura atomica)"""
+        if not self.shared_dir:
+            return
+        os.makedirs(self.shared_dir, exist_ok=True)
+        self.collect()
+        path = self._snapshot_path(os.getpid())
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({name: metric.dump() for name, metric in self._metrics.items()}, f)
+        os.replace(path + ".tmp", path)
+    
+    def reset_shared_dir(self):
+        """Rimuove i file dei worker di un'esecuzione precedente (da chiamare prima di avviarli)"""
+        if not self.shared_dir or not os.path.isdir(self.shared_dir):
+            return
+        for name in os.listdir(self.shared_dir):
+            if name.startswith("metrics_") and name.endswith(".json"):
+                os.remove(os.path.join(self.shared_dir, name))
+    
+    @staticmethod
+    def _pid_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    
+    def _other_workers(self) -> List[Tuple[bool, Dict[str, List[list]]]]:
+        snapshots = []
+        for name in os.listdir(self.shared_dir):
+            match = re.fullmatch(r"metrics_(\d+)\.json", name)
+            if not match or int(match.group(1)) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, name), "r", encoding="utf-8") as f:
+                    snapshots.append((self._pid_alive(int(match.group(1))), json.load(f)))
+            except (OSError, json.JSONDecodeError) as e:
+                logger.debug(f"Metriche del worker ignorate ({name}): {e}")
+        return snapshots
+    
+    async def run_sync(self, interval: float):
+        """Task in background che aggiorna il file di questo worker nella directory condivisa"""
+        logger.info(f"Metriche condivise tra worker in {self.shared_dir} (aggiornamento ogni {interval}s)")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                logger.warning(f"Errore nel salvataggio delle metriche condivise: {e}")
+    
+    def render(self) -> str:
+        self.collect()
+        if not self.shared_dir:
+            return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+        
+        self.write_snapshot()
+        others = self._other_workers()
+        rendered = []
+        for name, metric in self._metrics.items():
+            merged = metric.empty_copy()
+            merged.merge(metric.dump())
+            for alive, snapshot in others:
+                if alive or metric.kind != "gauge":
+                    merged.merge(snapshot.get(name, []))
+            rendered.append(merged.render())
+        return "\n".join(rendered) + "\n"
+
+metrics = MetricsRegistry(os.getenv('METRICS_SHARED_DIR') or None)
+REQUEST_LATENCY = metrics.histogram("mcp_request_duration_seconds", "Durata totale delle query", ("endpoint", "status"))
+CONTEXT_BUILD_LATENCY = metrics.histogram("mcp_context_build_seconds", "Tempo di preparazione di prompt e contesto conversazione")
+QUEUE_WAIT = metrics.histogram("mcp_admission_wait_seconds", "Attesa in coda prima dell'esecuzione")
+LLM_LATENCY = metrics.histogram("mcp_llm_call_duration_seconds", "Durata delle chiamate LLM", ("provider", "model", "status"))
+TOOL_LATENCY = metrics.histogram("mcp_tool_call_duration_seconds", "Durata delle chiamate ai tool MCP", ("server", "tool", "status"))
+AGENT_STEPS = metrics.counter("mcp_agent_steps_total", "Passi dell'agent (chiamate ai tool) eseguiti", ("provider", "model"))
+LLM_TOKENS = metrics.counter("mcp_llm_tokens_total", "Token riportati dai provider", ("provider", "model", "direction"))
+CACHE_LOOKUPS = metrics.counter("mcp_cache_lookups_total", "Ricerche nelle cache", ("cache", "result"))
+ERRORS = metrics.counter("mcp_errors_total", "Errori per fase", ("stage",))
+ADMISSION_ACTIVE = metrics.gauge("mcp_admission_active", "Query in esecuzione")
+ADMISSION_QUEUE_DEPTH = metrics.gauge("mcp_admission_queue_depth", "Query in attesa di esecuzione")
+JOBS = metrics.counter("mcp_jobs_total", "Job asincroni terminati per esito", ("status",))
+
+# Contatori della richiesta in corso, condivisi con i task figli dell'agent
+request_counters: ContextVar[Optional[Dict[str, int]]] = ContextVar("request_counters", default=None)
+
+class MetricsCallbackHandler(AsyncCallbackHandler):
+    """Misura chiamate LLM, token e chiamate ai tool di un agent e conta i passi della richiesta"""
+    
+    run_inline = True
+    
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self._started: Dict[Any, float] = {}
+    
+    async def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+    
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            LLM_LATENCY.observe(time.perf_counter() - started, provider=self.provider, model=self.model, status="ok")
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                if usage:
+                    LLM_TOKENS.inc(usage.get("input_tokens", 0), provider=self.provider, model=self.model, direction="in")
+                    LLM_TOKENS.inc(usage.get("output_tokens", 0), provider=self.provider, model=self.model, direction="out")
+    
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            LLM_LATENCY.observe(time.perf_counter() - started, provider=self.provider, model=self.model, status="error")
+        ERRORS.inc(stage="llm")
+    
+    async def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        AGENT_STEPS.inc(provider=self.provider, model=self.model)
+        counters = request_counters.get()
+        if counters is not None:
+            counters["steps"] = counters.get("steps", 0) + 1
+
+# Tracing delle richieste con span esportati in formato OTLP/JSON
+class Span:
+    """Intervallo di lavoro di una richiesta (trace), con padre, attributi ed esito"""
+    
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "attributes",
+                 "start_ns", "end_ns", "error")
+    
+    # Codici SpanKind di OTLP
+    KINDS = {"internal": 1, "server": 2, "client": 3}
+    
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 kind: str = "internal", attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+    
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+    
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+    
+    @staticmethod
+    def _otlp_value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+    
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.KINDS.get(self.kind, 1),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": key, "value": self._otlp_value(value)}
+                           for key, value in self.attributes.items() if value is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+class OTLPJsonExporter:
+    """Esporta le trace completate in OTLP/JSON su file (una riga per trace) e/o a un collector HTTP
+    
+    Il file è nel formato letto dal receiver otlpjsonfile dell'OpenTelemetry
+    Collector; l'endpoint è quello OTLP/HTTP (ad esempio http://localhost:4318/v1/traces).
+    """
+    
+    def __init__(self, path: Optional[str] = None, endpoint: Optional[str] = None, service_name: str = "mcp-server"):
+        self.path = path
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.stats = {"traces": 0, "spans": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._pending: set = set()
+    
+    def encode(self, spans: List[Span]) -> Dict[str, Any]:
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "mcp_server"}, "spans": [span.to_otlp() for span in spans]}]
+        }]}
+    
+    def export(self, spans: List[Span]):
+        payload = self.encode(spans)
+        self.stats["traces"] += 1
+        self.stats["spans"] += len(spans)
+        if self.path:
+            try:
+                with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+            except OSError as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Impossibile scrivere le trace su {self.path}: {e}")
+        if self.endpoint:
+            try:
+                task = asyncio.get_running_loop().create_task(self._post(payload))
+            except RuntimeError:
+                return
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+    
+    async def _post(self, payload: Dict[str, Any]):
+        try:
+            async with http_pool.get_session().post(self.endpoint, json=payload) as response:
+                response.raise_for_status()
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.debug(f"Invio delle trace a {self.endpoint} fallito: {e!r}")
+    
+    async def close(self):
+        """Attende gli invii al collector ancora in corso"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+# Span corrente della richiesta, ereditato dai task figli
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+class Tracer:
+    """Crea gli span delle richieste e li esporta quando termina lo span radice
+    
+    Con slow_ms > 0 vengono esportate solo le trace la cui radice dura almeno
+    slow_ms millisecondi: le richieste lente restano analizzabili a posteriori
+    senza scrivere tutte le altre.
+    """
+    
+    def __init__(self, enabled: bool = False, exporter: Optional[OTLPJsonExporter] = None,
+                 slow_ms: float = 0, max_spans_per_trace: int = 2000):
+        self.enabled = enabled
+        self.exporter = exporter
+        self.slow_ms = slow_ms
+        self.max_spans_per_trace = max_spans_per_trace
+        self._traces: Dict[str, List[Span]] = {}
+        self.stats = {"traces": 0, "exported": 0, "dropped_spans": 0}
+    
+    @staticmethod
+    def new_trace_id() -> str:
+        return os.urandom(16).hex()
+    
+    def start_span(self, name: str, parent: Optional[Span] = None, trace_id: Optional[str] = None,
+                   kind: str = "internal", **attributes) -> Optional[Span]:
+        """Apre uno span figlio di parent (o dello span corrente) senza renderlo corrente"""
+        if not self.enabled:
+            return None
+        parent = parent or current_span.get()
+        if parent is not None:
+            span = Span(name, parent.trace_id, parent.span_id, kind, attributes)
+        else:
+            span = Span(name, trace_id or self.new_trace_id(), None, kind, attributes)
+            self._traces[span.trace_id] = []
+            self.stats["traces"] += 1
+        return span
+    
+    def end_span(self, span: Optional[Span], error: Optional[BaseException] = None):
+        if span is None:
+            return
+        span.end_ns = time.time_ns()
+        if error is not None and not isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            span.error = f"{type(error).__name__}: {error}"
+        if span.parent_id is None:
+            spans = self._traces.pop(span.trace_id, []) + [span]
+            if self.exporter is not None and span.duration_ms >= self.slow_ms:
+                self.exporter.export(spans)
+                self.stats["exported"] += 1
+            return
+        spans = self._traces.get(span.trace_id)
+        if spans is None:
+            return
+        if len(spans) >= self.max_spans_per_trace:
+            self.stats["dropped_spans"] += 1
+            return
+        spans.append(span)
+    
+    @contextmanager
+    def span(self, name: str, trace_id: Optional[str] = None, kind: str = "internal", **attributes):
+        """Context manager che rende lo span corrente per il codice (anche asincrono) al suo interno"""
+        if not self.enabled:
+            yield None
+            return
+        span = self.start_span(name, trace_id=trace_id, kind=kind, **attributes)
+        token = current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_span.reset(token)
+            self.end_span(span, error)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "open_traces": len(self._traces),
+            "slow_ms": self.slow_ms,
+            "exporter": self.exporter.stats if self.exporter else None
+        }
+
+def create_tracer() -> Tracer:
+    """Crea il tracer se TRACING_ENABLED è attivo, con export su file e/o collector OTLP/HTTP"""
+    if os.getenv('TRACING_ENABLED', 'false').lower() != 'true':
+        return Tracer(enabled=False)
+    exporter = OTLPJsonExporter(
+        path=os.getenv('TRACING_FILE', 'traces.jsonl') or None,
+        endpoint=os.getenv('TRACING_OTLP_ENDPOINT') or None,
+        service_name=os.getenv('TRACING_SERVICE_NAME', 'mcp-server')
+    )
+    tracer = Tracer(enabled=True, exporter=exporter, slow_ms=float(os.getenv('TRACING_SLOW_MS', 0)))
+    logger.info(f"Tracing attivo (file: {exporter.path or '-'}, collector: {exporter.endpoint or '-'}, "
+                f"solo richieste oltre {tracer.slow_ms:g} ms)")
+    return tracer
+
+tracer = create_tracer()
+
+class TracingCallbackHandler(AsyncCallbackHandler):
+    """Span per i passi dell'agent (nodi del grafo), le chiamate LLM e le chiamate ai tool
+    
+    Gli span vengono collegati tramite parent_run_id di LangChain; la radice è lo
+    span corrente della richiesta al primo evento.
+    """
+    
+    run_inline = True
+    
+    def __init__(self, tracer: Tracer, provider: str, model: str):
+        self.tracer = tracer
+        self.provider = provider
+        self.model = model
+        # Span di ogni run LangChain (o quello del primo antenato con uno span)
+        self._spans: Dict[Any, Optional[Span]] = {}
+        self._owned: Dict[Any, Span] = {}
+    
+    def _parent(self, parent_run_id) -> Optional[Span]:
+        if parent_run_id is not None and parent_run_id in self._spans:
+            return self._spans[parent_run_id]
+        return current_span.get()
+    
+    def _start(self, run_id, parent_run_id, name: Optional[str], **attributes):
+        parent = self._parent(parent_run_id)
+        if name is None or parent is None:
+            self._spans[run_id] = parent
+            return
+        span = self.tracer.start_span(name, parent=parent, **attributes)
+        self._spans[run_id] = span
+        self._owned[run_id] = span
+    
+    def _end(self, run_id, error: Optional[BaseException] = None, **attributes):
+        self._spans.pop(run_id, None)
+        span = self._owned.pop(run_id, None)
+        if span is not None:
+            span.attributes.update(attributes)
+            self.tracer.end_span(span, error)
+    
+    async def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        metadata = metadata or {}
+        node = metadata.get("langgraph_node")
+        # Solo i nodi del grafo (modello, tool) diventano passi; le catene interne ereditano lo span
+        is_step = node is not None and kwargs.get("name") == node
+        self._start(run_id, parent_run_id, f"agent.step {node}" if is_step else None,
+                    **{"agent.node": node, "agent.step": metadata.get("langgraph_step")})
+    
+    async def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+    
+    async def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+    
+    async def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, "llm.call", kind="client",
+                    **{"llm.provider": self.provider, "llm.model": self.model,
+                       "llm.messages": sum(len(batch) for batch in messages)})
+    
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        attributes = {}
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                if usage:
+                    attributes = {"llm.input_tokens": usage.get("input_tokens"),
+                                  "llm.output_tokens": usage.get("output_tokens")}
+        self._end(run_id, **attributes)
+    
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+    
+    async def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        name = (serialized or {}).get("name") or kwargs.get("name") or "tool"
+        self._start(run_id, parent_run_id, f"tool.call {name}", **{"tool.name": name})
+    
+    async def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+    
+    async def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+# Limiti di frequenza dei provider AI (richieste e token al minuto)
+class TokenBucket:
+    """Token bucket a prenotazione: ogni richiesta prenota la sua quota e attende il proprio turno
+    
+    Il saldo può diventare negativo: chi arriva dopo attende il tempo necessario a
+    ricaricarlo, così le richieste escono distanziate al ritmo della quota invece
+    di partire tutte insieme e ricevere 429.
+    """
+    
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, burst if burst else per_minute / 10.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self, amount: float = 1.0) -> float:
+        """Prenota amount unità e restituisce i secondi da attendere prima di usarle"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+    
+    def debit(self, amount: float):
+        """Scala (o restituisce, se negativo) unità già consumate senza attendere"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens - amount)
+    
+    def limit_remaining(self, remaining: float):
+        """Allinea il saldo a quanto il provider dichiara ancora disponibile"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, remaining)
+
+class ProviderRateLimiter:
+    """Token bucket per provider e modello, configurati in providers.<nome>.rate_limits
+    
+    Esempio di configurazione:
+        "rate_limits": {"requests_per_minute": 20, "tokens_per_minute": 100000,
+                        "models": {"gemini-2.5-flash": {"requests_per_minute": 10}}}
+    
+    Gli header x-ratelimit-* delle risposte riallineano i bucket al saldo reale e
+    un 429 sospende le richieste verso quel modello fino a Retry-After. Con più
+    worker ogni processo riceve una quota pari a 1/workers dei limiti configurati.
+    """
+    
+    RATE_KEYS = ("requests_per_minute", "tokens_per_minute", "burst", "token_burst")
+    
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        self._limits: Dict[str, Dict[str, Any]] = {}
+        self.workers = 1
+        self._buckets: Dict[Tuple[str, str], Dict[str, Optional[TokenBucket]]] = {}
+        self._blocked_until: Dict[Tuple[str, str], float] = {}
+        self._stats: Dict[Tuple[str, str], Dict[str, float]] = defaultdict(
+            lambda: {"requests": 0, "throttled": 0, "wait_seconds": 0.0, "rate_limited": 0, "header_updates": 0}
+        )
+        if config:
+            self.configure(config)
+    
+    def configure(self, config: Dict[str, Any], workers: int = 1):
+        self.workers = max(1, workers)
+        self._limits = {
+            name: provider.get("rate_limits") or {}
+            for name, provider in config.get("providers", {}).items()
+        }
+        self._buckets.clear()
+    
+    def _limits_for(self, provider: str, model: str) -> Dict[str, Any]:
+        limits = self._limits.get(provider) or {}
+        merged = {key: limits[key] for key in self.RATE_KEYS if key in limits}
+        merged.update((limits.get("models") or {}).get(model) or {})
+        return merged
+    
+    def _get_buckets(self, provider: str, model: str) -> Dict[str, Optional[TokenBucket]]:
+        key = (provider, model)
+        if key not in self._buckets:
+            limits = {name: value / self.workers if value else value
+                      for name, value in self._limits_for(provider, model).items()}
+            rpm, tpm = limits.get("requests_per_minute"), limits.get("tokens_per_minute")
+            self._buckets[key] = {
+                "requests": TokenBucket(rpm, limits.get("burst")) if rpm else None,
+                "tokens": TokenBucket(tpm, limits.get("token_burst")) if tpm else None
+            }
+        return self._buckets[key]
+    
+    async def acquire(self, provider: str, model: str, estimated_tokens: int = 0) -> float:
+        """Attende che la quota del modello consenta una nuova richiesta; restituisce i secondi attesi"""
+        key = (provider, model)
+        buckets = self._get_buckets(provider, model)
+        wait = max(0.0, self._blocked_until.get(key, 0.0) - time.monotonic())
+        if buckets["requests"] is not None:
+            wait = max(wait, buckets["requests"].reserve(1))
+        if buckets["tokens"] is not None and estimated_tokens:
+            wait = max(wait, buckets["tokens"].reserve(estimated_tokens))
+        
+        stats = self._stats[key]
+        stats["requests"] += 1
+        if wait > 0:
+            stats["throttled"] += 1
+            stats["wait_seconds"] += wait
+            logger.debug(f"Richiesta a {provider}/{model} rallentata di {wait:.2f}s per rispettare i limiti")
+            await asyncio.sleep(wait)
+        return wait
+    
+    def record_usage(self, provider: str, model: str, actual_tokens: int, estimated_tokens: int = 0):
+        """Corregge il bucket dei token con il consumo reale riportato dal provider"""
+        bucket = self._get_buckets(provider, model)["tokens"]
+        if bucket is not None and actual_tokens:
+            bucket.debit(actual_tokens - estimated_tokens)
+    
+    @staticmethod
+    def _parse_reset(value: Optional[str]) -> Optional[float]:
+        """Secondi al reset da header nei formati "1.5", "6m0s", "20ms" o timestamp epoch (s o ms)"""
+        if not value:
+            return None
+        value = value.strip()
+        try:
+            number = float(value)
+        except ValueError:
+            seconds = 0.0
+            for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+                seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+            return seconds or None
+        if number > 1e12:
+            return max(0.0, number / 1000 - time.time())
+        if number > 1e9:
+            return max(0.0, number - time.time())
+        return number
+    
+    def observe(self, provider: str, model: str, status: int, headers: Any):
+        """Aggiorna lo stato del modello dagli header di risposta (x-ratelimit-*, Retry-After)"""
+        key = (provider, model)
+        buckets = self._get_buckets(provider, model)
+        updated = False
+        
+        for kind, names in (("requests", ("x-ratelimit-remaining-requests", "x-ratelimit-remaining")),
+                            ("tokens", ("x-ratelimit-remaining-tokens",))):
+            raw = next((headers.get(name) for name in names if headers.get(name) is not None), None)
+            if raw is None:
+                continue
+            try:
+                remaining = float(raw)
+            except ValueError:
+                continue
+            updated = True
+            if buckets[kind] is not None:
+                buckets[kind].limit_remaining(remaining)
+            if remaining <= 0:
+                reset = (self._parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                         or self._parse_reset(headers.get("x-ratelimit-reset")))
+                if reset:
+                    self._blocked_until[key] = max(self._blocked_until.get(key, 0.0), time.monotonic() + reset)
+        
+        if status == 429:
+            self._stats[key]["rate_limited"] += 1
+            retry_after = self._parse_reset(headers.get("retry-after")) or 1.0
+            self._blocked_until[key] = max(self._blocked_until.get(key, 0.0), time.monotonic() + retry_after)
+            logger.warning(f"{provider}/{model} ha risposto 429: nuove richieste sospese per {retry_after:.1f}s")
+        if updated:
+            self._stats[key]["header_updates"] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {}
+        for (provider, model), values in self._stats.items():
+            buckets = self._buckets.get((provider, model)) or {}
+            limits = self._limits_for(provider, model)
+            stats[f"{provider}/{model}"] = {
+                **values,
+                "wait_seconds": round(values["wait_seconds"], 3),
+                "requests_per_minute": limits.get("requests_per_minute"),
+                "tokens_per_minute": limits.get("tokens_per_minute"),
+                "available_requests": round(buckets["requests"].tokens, 2) if buckets.get("requests") else None,
+                "available_tokens": round(buckets["tokens"].tokens) if buckets.get("tokens") else None,
+                "blocked_for": round(max(0.0, self._blocked_until.get((provider, model), 0.0) - time.monotonic()), 2)
+            }
+        return stats
+
+class RateLimitCallbackHandler(AsyncCallbackHandler):
+    """Applica i limiti di frequenza ai modelli LangChain che non espongono gli header HTTP (Gemini)
+    
+    La richiesta attende in on_chat_model_start, prima di partire; il consumo reale
+    arriva da usage_metadata e gli errori di quota sospendono il modello come un 429.
+    """
+    
+    run_inline = True
+    
+    def __init__(self, limiter: ProviderRateLimiter, provider: str, model: str):
+        self.limiter = limiter
+        self.provider = provider
+        self.model = model
+        self._estimates: Dict[Any, int] = {}
+    
+    async def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        estimated = sum(len(str(message.content)) for batch in messages for message in batch) // 4
+        self._estimates[run_id] = estimated
+        await self.limiter.acquire(self.provider, self.model, estimated)
+    
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        estimated = self._estimates.pop(run_id, 0)
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                if usage.get("total_tokens"):
+                    self.limiter.record_usage(self.provider, self.model, usage["total_tokens"], estimated)
+                    return
+    
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        self._estimates.pop(run_id, None)
+        status = ProviderResilience.error_status(error)[0]
+        if status == 429 or "ResourceExhausted" in type(error).__name__ or "RESOURCE_EXHAUSTED" in str(error):
+            self.limiter.observe(self.provider, self.model, 429, {})
+
+rate_limiter = ProviderRateLimiter()
+
+# Resilienza delle chiamate ai provider: retry, richieste hedged e circuit breaker
+class CircuitOpenError(Exception):
+    """Il circuito del modello è aperto: le chiamate vengono rifiutate senza contattare il provider"""
+    
+    def __init__(self, provider: str, model: str, retry_after: float):
+        super().__init__(f"Circuito aperto per {provider}/{model}: troppi errori consecutivi, "
+                         f"nuovo tentativo tra {retry_after:.0f}s")
+        self.provider = provider
+        self.model = model
+        self.retry_after = retry_after
+
+class OpenRouterAPIError(Exception):
+    """Errore riportato da OpenRouter nel corpo della risposta (ad esempio un evento error dello stream)"""
+    
+    def __init__(self, message: str, status: Optional[int] = None, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+class CircuitBreaker:
+    """Circuit breaker a tre stati (closed, open, half_open) su errori consecutivi"""
+    
+    def __init__(self, failure_threshold: int = 5, open_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened_count = 0
+        self._probe_in_flight = False
+    
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+    
+    def allow(self) -> bool:
+        """Se una nuova chiamata può partire; in half_open passa una sola chiamata di prova"""
+        if self.state == "open":
+            if self.retry_after() > 0:
+                return False
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+    
+    def release_probe(self):
+        """Libera la chiamata di prova interrotta senza esito (richiesta annullata)"""
+        self._probe_in_flight = False
+    
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probe_in_flight = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.opened_count += 1
+
+class ProviderResilience:
+    """Retry con backoff e jitter, richieste hedged e circuit breaker per provider e modello
+    
+    I default vengono dalle variabili d'ambiente e si possono sovrascrivere in
+    providers.<nome>.resilience (anche per modello, sotto "models"), ad esempio:
+        "resilience": {"max_retries": 3, "hedge": true, "failure_threshold": 10}
+    
+    Si ritentano solo gli errori transitori (timeout, connessione, 408/425/429/5xx).
+    Con hedge attivo, se la risposta non arriva entro il p95 delle latenze recenti
+    parte una seconda richiesta identica e si usa la prima che risponde.
+    """
+    
+    RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+    SETTING_KEYS = ("max_retries", "backoff_base", "backoff_max", "hedge", "hedge_min_samples",
+                    "hedge_min_delay", "failure_threshold", "open_seconds")
+    
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        self.defaults = {
+            "max_retries": int(os.getenv('LLM_MAX_RETRIES', 2)),
+            "backoff_base": float(os.getenv('LLM_RETRY_BACKOFF_BASE', 0.5)),
+            "backoff_max": float(os.getenv('LLM_RETRY_BACKOFF_MAX', 8)),
+            "hedge": os.getenv('LLM_HEDGE_ENABLED', 'false').lower() == 'true',
+            "hedge_min_samples": int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20)),
+            "hedge_min_delay": float(os.getenv('LLM_HEDGE_MIN_DELAY', 1)),
+            "failure_threshold": int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)),
+            "open_seconds": float(os.getenv('CIRCUIT_OPEN_SECONDS', 30))
+        }
+        self._overrides: Dict[str, Dict[str, Any]] = {}
+        # Funzioni (provider, model, latenza, errore) chiamate a ogni esito, ad esempio dal router
+        self.listeners: List[Any] = []
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+        self._latencies: Dict[Tuple[str, str], deque] = defaultdict(lambda: deque(maxlen=200))
+        self._stats: Dict[Tuple[str, str], Dict[str, int]] = defaultdict(
+            lambda: {"calls": 0, "failures": 0, "retries": 0, "hedged": 0, "hedge_wins": 0, "rejected": 0}
+        )
+        if config:
+            self.configure(config)
+    
+    def configure(self, config: Dict[str, Any]):
+        self._overrides = {
+            name: provider.get("resilience") or {}
+            for name, provider in config.get("providers", {}).items()
+        }
+        self._breakers.clear()
+        self._latencies.clear()
+        self._stats.clear()
+    
+    def settings(self, provider: str, model: str) -> Dict[str, Any]:
+        overrides = self._overrides.get(provider) or {}
+        merged = dict(self.defaults)
+        merged.update((key, overrides[key]) for key in self.SETTING_KEYS if key in overrides)
+        merged.update((overrides.get("models") or {}).get(model) or {})
+        return merged
+    
+    def breaker(self, provider: str, model: str) -> CircuitBreaker:
+        key = (provider, model)
+        if key not in self._breakers:
+            settings = self.settings(provider, model)
+            self._breakers[key] = CircuitBreaker(settings["failure_threshold"], settings["open_seconds"])
+        return self._breakers[key]
+    
+    def check(self, provider: str, model: str):
+        """Solleva CircuitOpenError se il circuito del modello non lascia passare la chiamata"""
+        breaker = self.breaker(provider, model)
+        if not breaker.allow():
+            self._stats[(provider, model)]["rejected"] += 1
+            raise CircuitOpenError(provider, model, breaker.retry_after() or breaker.open_seconds)
+    
+    def record(self, provider: str, model: str, error: Optional[BaseException] = None,
+               latency: Optional[float] = None):
+        """Registra l'esito di una chiamata; solo gli errori transitori aprono il circuito"""
+        key = (provider, model)
+        self._stats[key]["calls"] += 1
+        failed = error is not None and self.is_retryable(error)[0]
+        for listener in self.listeners:
+            listener(provider, model, latency if error is None else None, failed)
+        if failed:
+            self._stats[key]["failures"] += 1
+            self.breaker(provider, model).record_failure()
+            return
+        # Anche un errore non transitorio (400, 401) dimostra che il provider risponde
+        self.breaker(provider, model).record_success()
+        if error is None and latency is not None:
+            self._latencies[key].append(latency)
+    
+    # Eccezioni degli SDK (google.api_core per Gemini) e stati gRPC che indicano un errore transitorio
+    RETRYABLE_ERROR_TYPES = {"ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError",
+                             "TooManyRequests", "BadGateway", "GatewayTimeout"}
+    RETRYABLE_GRPC_STATUS = re.compile(r"\b(RESOURCE_EXHAUSTED|UNAVAILABLE|DEADLINE_EXCEEDED)\b")
+    
+    @staticmethod
+    def error_status(error: BaseException) -> Tuple[Optional[int], Any]:
+        """Status HTTP e header della risposta che ha causato l'errore, se presenti"""
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status, error.headers or {}
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            return error.response.status_code, error.response.headers
+        if isinstance(error, OpenRouterAPIError):
+            return error.status, error.headers
+        # google.api_core.exceptions espone lo status HTTP in code
+        code = getattr(error, "code", None)
+        if isinstance(code, int) and not isinstance(code, bool) and 100 <= code < 600:
+            return code, {}
+        return None, {}
+    
+    @classmethod
+    def is_retryable(cls, error: BaseException) -> Tuple[bool, Optional[float]]:
+        """Se l'errore è transitorio e, quando indicato dal provider, i secondi di Retry-After"""
+        if isinstance(error, CircuitOpenError):
+            return False, None
+        status, headers = cls.error_status(error)
+        if status is not None:
+            retry_after = ProviderRateLimiter._parse_reset(headers.get("Retry-After")) if headers else None
+            return status in cls.RETRYABLE_STATUSES, retry_after
+        if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                              requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True, None
+        # Errori di SDK senza status HTTP: si riconoscono dal tipo o dallo stato gRPC nel messaggio
+        if any(klass.__name__ in cls.RETRYABLE_ERROR_TYPES for klass in type(error).__mro__):
+            return True, None
+        return cls.RETRYABLE_GRPC_STATUS.search(str(error)) is not None, None
+    
+    def hedge_delay(self, provider: str, model: str) -> Optional[float]:
+        """Attesa prima della richiesta hedged (p95 delle latenze recenti), None se disattivata"""
+        settings = self.settings(provider, model)
+        latencies = self._latencies[(provider, model)]
+        if not settings["hedge"] or len(latencies) < settings["hedge_min_samples"]:
+            return None
+        ordered = sorted(latencies)
+        return max(settings["hedge_min_delay"], ordered[int(len(ordered) * 0.95) - 1])
+    
+    def _backoff(self, settings: Dict[str, Any], attempt: int, retry_after: Optional[float]) -> float:
+        # Full jitter: attese casuali evitano che i client ritentino tutti insieme
+        delay = random.uniform(0, min(settings["backoff_max"], settings["backoff_base"] * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+    
+    async def _hedged(self, provider: str, model: str, attempt_fn, delay: Optional[float]):
+        started = time.monotonic()
+        first = asyncio.ensure_future(attempt_fn())
+        pending = {first}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    self._stats[(provider, model)]["hedged"] += 1
+                    logger.debug(f"{provider}/{model} oltre {delay:.2f}s: avvio richiesta hedged")
+                    pending.add(asyncio.ensure_future(attempt_fn()))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._stats[(provider, model)]["hedge_wins"] += 1
+                        return task.result(), time.monotonic() - started
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def call(self, provider: str, model: str, attempt_fn, hedge: bool = True):
+        """Esegue attempt_fn (coroutine factory) con circuit breaker, retry e hedging"""
+        settings = self.settings(provider, model)
+        for attempt in range(settings["max_retries"] + 1):
+            self.check(provider, model)
+            delay = self.hedge_delay(provider, model) if hedge else None
+            try:
+                result, latency = await self._hedged(provider, model, attempt_fn, delay)
+            except asyncio.CancelledError:
+                self.breaker(provider, model).release_probe()
+                raise
+            except Exception as e:
+                self.record(provider, model, e)
+                retryable, retry_after = self.is_retryable(e)
+                if not retryable or attempt == settings["max_retries"]:
+                    raise
+                wait = self._backoff(settings, attempt, retry_after)
+                self._stats[(provider, model)]["retries"] += 1
+                logger.warning(f"{provider}/{model}: errore transitorio ({e}), nuovo tentativo tra {wait:.2f}s")
+                await asyncio.sleep(wait)
+                continue
+            self.record(provider, model, latency=latency)
+            return result
+    
+    def call_sync(self, provider: str, model: str, attempt_fn):
+        """Variante sincrona di call (senza hedging) per il percorso _generate"""
+        settings = self.settings(provider, model)
+        for attempt in range(settings["max_retries"] + 1):
+            self.check(provider, model)
+            started = time.monotonic()
+            try:
+                result = attempt_fn()
+            except Exception as e:
+                self.record(provider, model, e)
+                retryable, retry_after = self.is_retryable(e)
+                if not retryable or attempt == settings["max_retries"]:
+                    raise
+                self._stats[(provider, model)]["retries"] += 1
+                time.sleep(self._backoff(settings, attempt, retry_after))
+                continue
+            self.record(provider, model, latency=time.monotonic() - started)
+            return result
+    
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {}
+        for (provider, model), values in self._stats.items():
+            breaker = self.breaker(provider, model)
+            latencies = sorted(self._latencies[(provider, model)])
+            stats[f"{provider}/{model}"] = {
+                **values,
+                "circuit": breaker.state,
+                "consecutive_failures": breaker.failures,
+                "circuit_opened": breaker.opened_count,
+                "retry_after": round(breaker.retry_after(), 1) if breaker.state == "open" else None,
+                "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1 if len(latencies) > 1 else 0] * 1000, 1) if latencies else None
+            }
+        return stats
+
+class ResilienceCallbackHandler(AsyncCallbackHandler):
+    """Circuit breaker per i modelli LangChain che gestiscono da soli le chiamate HTTP (Gemini)
+    
+    I retry restano quelli dell'SDK (max_retries del modello); il callback rifiuta le
+    chiamate a circuito aperto e registra esiti e latenze.
+    """
+    
+    run_inline = True
+    raise_error = True
+    
+    def __init__(self, resilience: ProviderResilience, provider: str, model: str):
+        self.resilience = resilience
+        self.provider = provider
+        self.model = model
+        self._started: Dict[Any, float] = {}
+    
+    async def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.resilience.check(self.provider, self.model)
+        self._started[run_id] = time.monotonic()
+    
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        self.resilience.record(self.provider, self.model,
+                               latency=time.monotonic() - started if started else None)
+    
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        if self._started.pop(run_id, None) is not None:
+            self.resilience.record(self.provider, self.model, error)
+
+llm_resilience = ProviderResilience()
+
+# Scelta del provider/modello per latenza ed errori, con failover
+class ModelRouter:
+    """Instrada le richieste sul candidato sano più veloce di una lista di preferenza
+    
+    La lista si configura in "routing" di mcp_config.json, con voci "provider/modello"
+    (o {"provider": ..., "model": ...}) in ordine di preferenza:
+        "routing": {"candidates": ["openrouter/openai/gpt-4o-mini", "gemini/gemini-2.5-flash"]}
+    
+    Per ogni modello si tengono medie mobili esponenziali (EWMA) della latenza e del
+    tasso di errore delle chiamate LLM. Un modello è sano se il circuito non è aperto
+    e il tasso di errore è sotto max_error_rate; un candidato meno preferito viene
+    scelto solo se è più veloce di almeno latency_tolerance. Le richieste che
+    indicano il modello non vengono instradate.
+    """
+    
+    def __init__(self, config: Dict[str, Any], resilience: ProviderResilience):
+        routing = config.get("routing") or {}
+        providers = config.get("providers", {})
+        self.config = config
+        self.resilience = resilience
+        self.alpha = float(routing.get("alpha", 0.2))
+        self.max_error_rate = float(routing.get("max_error_rate", 0.5))
+        self.latency_tolerance = float(routing.get("latency_tolerance", 0.2))
+        self.max_attempts = max(1, int(routing.get("max_attempts", 3)))
+        
+        self.candidates: List[Tuple[str, str]] = []
+        for candidate in routing.get("candidates", []):
+            if isinstance(candidate, dict):
+                provider, model = candidate.get("provider"), candidate.get("model")
+            else:
+                provider, _, model = str(candidate).partition("/")
+            if provider not in providers or not model:
+                logger.warning(f"Candidato di routing {candidate} ignorato: provider non configurato o modello mancante")
+                continue
+            if providers[provider].get("disabled", False):
+                continue
+            self.candidates.append((provider, model))
+        
+        self._latency: Dict[Tuple[str, str], float] = {}
+        self._errors: Dict[Tuple[str, str], float] = {}
+        self.stats = {"routed": 0, "failovers": 0}
+        self._chosen: Dict[Tuple[str, str], int] = defaultdict(int)
+        resilience.listeners.append(self.observe)
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.candidates)
+    
+    def observe(self, provider: str, model: str, latency: Optional[float] = None, failed: bool = False):
+        """Aggiorna le medie mobili di latenza ed errori del modello"""
+        key = (provider, model)
+        self._errors[key] = self.alpha * (1.0 if failed else 0.0) + (1 - self.alpha) * self._errors.get(key, 0.0)
+        if latency is not None:
+            previous = self._latency.get(key)
+            self._latency[key] = latency if previous is None else self.alpha * latency + (1 - self.alpha) * previous
+    
+    def healthy(self, provider: str, model: str) -> bool:
+        breaker = self.resilience.breaker(provider, model)
+        if breaker.state == "open" and breaker.retry_after() > 0:
+            return False
+        return self._errors.get((provider, model), 0.0) < self.max_error_rate
+    
+    def rank(self, candidates: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """Ordina i candidati: il più veloce tra i sani, poi gli altri sani in ordine di preferenza, poi i non sani"""
+        healthy = [c for c in candidates if self.healthy(*c)]
+        unhealthy = [c for c in candidates if c not in healthy]
+        if not healthy:
+            return unhealthy
+        # I modelli senza misure hanno latenza 0: vengono provati e misurati
+        best = healthy[0]
+        for candidate in healthy[1:]:
+            if self._latency.get(candidate, 0.0) < self._latency.get(best, 0.0) * (1 - self.latency_tolerance):
+                best = candidate
+        return [best] + [c for c in healthy if c != best] + unhealthy
+    
+    def route(self, provider: Optional[str] = None, model: Optional[str] = None) -> List[Tuple[str, str]]:
+        """Provider e modelli da provare, in ordine, per una richiesta"""
+        if model:
+            return [(provider or self.config.get("default_provider", "unknown"), model)]
+        candidates = [c for c in self.candidates if not provider or c[0] == provider]
+        if not candidates:
+            provider = provider or self.config.get("default_provider", "unknown")
+            return [(provider, self.config.get("providers", {}).get(provider, {}).get("model", "unknown"))]
+        return self.rank(candidates)[:self.max_attempts]
+    
+    def record_choice(self, provider: str, model: str, failover: bool = False):
+        self.stats["routed"] += 1
+        self._chosen[(provider, model)] += 1
+        if failover:
+            self.stats["failovers"] += 1
+    
+    def should_fail_over(self, error: BaseException) -> bool:
+        """Si passa al candidato successivo solo per errori del provider, non della richiesta"""
+        return isinstance(error, CircuitOpenError) or self.resilience.is_retryable(error)[0]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "order": [f"{p}/{m}" for p, m in self.rank(self.candidates)] if self.enabled else [],
+            "models": {
+                f"{p}/{m}": {
+                    "healthy": self.healthy(p, m),
+                    "latency_ms": round(self._latency[(p, m)] * 1000, 1) if (p, m) in self._latency else None,
+                    "error_rate": round(self._errors.get((p, m), 0.0), 3),
+                    "chosen": self._chosen[(p, m)]
+                }
+                for p, m in self.candidates
+            }
+        }
+
 # Implementazione OpenRouter LLM personalizzata
 class OpenRouterLLM(BaseChatModel):
     """Wrapper per OpenRouter API compatibile con LangChain"""
@@ -148,8 +1515,15 @@ class OpenRouterLLM(BaseChatModel):
     base_url: str = Field(default="https://openrouter.ai/api/v1", description="URL base API")
     temperature: float = Field(default=0.7, description="Temperatura per la generazione")
     max_tokens: int = Field(default=4000, description="Numero massimo di token")
+    native_tools: bool = Field(default=True, description="Se inviare i tool come function calling nativo")
     
-    class Config:
+    # Schemi dei tool già convertiti, per insieme di tool legati al modello
+    _tool_schemas: Dict[Tuple[int, ...], List[Dict[str, Any]]] = PrivateAttr(default_factory=dict)
+    
+    # Insiemi di tool diversi conservati per istanza (uno per agent è il caso normale)
+    TOOL_SCHEMA_CACHE_SIZE: ClassVar[int] = 8
+    
+    class Config:
         arbitrary_types_allowed = True
     
     @property
@@ -161,22 +1535,27 @@ class OpenRouterLLM(BaseChatModel):
     def _llm_type(self) -> str:
         return "openrouter"
     
-    def _generate(
-        self,
-        messages: List[BaseMessage],
-        stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
-        **kwargs: Any,
-    ) -> ChatResult:
-        """Genera una risposta usando OpenRouter API"""
-        
-        # Converte i messaggi in formato OpenRouter
+    def _format_messages(self, messages: List[BaseMessage]) -> List[Dict[str, Any]]:
+        """Converte i messaggi LangChain nel formato OpenRouter"""
         formatted_messages = []
         for msg in messages:
             if isinstance(msg, HumanMessage):
                 formatted_messages.append({"role": "user", "content": msg.content})
             elif isinstance(msg, AIMessage):
-                formatted_messages.append({"role": "assistant", "content": msg.content})
+                formatted = {"role": "assistant", "content": msg.content}
+                if msg.tool_calls:
+                    formatted["tool_calls"] = [
+                        {
+                            "id": call["id"],
+                            "type": "function",
+                            "function": {"name": call["name"], "arguments": json.dumps(call["args"])}
+                        }
+                        for call in msg.tool_calls
+                    ]
+                formatted_messages.append(formatted)
+            elif isinstance(msg, ToolMessage):
+                content = msg.content if isinstance(msg.content, str) else json.dumps(msg.content)
+                formatted_messages.append({"role": "tool", "tool_call_id": msg.tool_call_id, "content": content})
             elif isinstance(msg, SystemMessage):
                 formatted_messages.append({"role": "system", "content": msg.content})
             else:
@@ -187,60 +1566,2326 @@ class OpenRouterLLM(BaseChatModel):
                 elif role == 'ai':
                     role = 'assistant'
                 formatted_messages.append({"role": role, "content": msg.content})
-        
-        headers = {
+        return formatted_messages
+    
+    def _build_headers(self) -> Dict[str, str]:
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
             "HTTP-Referer": "http://localhost:8000",
             "X-Title": "MCP Server with OpenRouter"
         }
+    
+    def _build_payload(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        payload = {
+            "model": self.model,
+            "messages": self._format_messages(messages),
+            "max_tokens": kwargs.get("max_tokens", self.max_tokens),
+            "temperature": kwargs.get("temperature", self.temperature)
+        }
+        
+        if stop:
+            payload["stop"] = stop
+        
+        # Tool legati con bind_tools (function calling nativo)
+        if kwargs.get("tools"):
+            payload["tools"] = kwargs["tools"]
+            if kwargs.get("tool_choice") is not None:
+                payload["tool_choice"] = kwargs["tool_choice"]
+        
+        return payload
+    
+    @staticmethod
+    def _estimate_payload_tokens(payload: Dict[str, Any]) -> int:
+        """Stima veloce dei token di input (circa 4 caratteri per token) per il bucket dei token"""
+        return sum(len(str(message.get("content") or "")) for message in payload["messages"]) // 4
+    
+    def _create_chat_result(self, data: Dict[str, Any]) -> ChatResult:
+        """Crea il risultato nel formato LangChain dalla risposta OpenRouter"""
+        choice = data["choices"][0]
+        raw_message = choice["message"]
+        
+        tool_calls, invalid_tool_calls = [], []
+        for raw_call in raw_message.get("tool_calls") or []:
+            try:
+                tool_calls.append(parse_tool_call(raw_call, return_id=True))
+            except Exception as e:
+                invalid_tool_calls.append(make_invalid_tool_call(raw_call, str(e)))
+        
+        usage = data.get("usage") or {}
+        message = AIMessage(
+            content=raw_message.get("content") or "",
+            tool_calls=tool_calls,
+            invalid_tool_calls=invalid_tool_calls,
+            response_metadata={"finish_reason": choice.get("finish_reason"), "model_name": data.get("model", self.model)},
+            usage_metadata={
+                "input_tokens": usage.get("prompt_tokens", 0),
+                "output_tokens": usage.get("completion_tokens", 0),
+                "total_tokens": usage.get("total_tokens", 0)
+            } if usage else None
+        )
+        generation = ChatGeneration(message=message)
+        return ChatResult(generations=[generation])
+    
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Genera una risposta usando OpenRouter API (percorso sincrono)"""
+        payload = self._build_payload(messages, stop, **kwargs)
+        
+        def attempt():
+            response = http_pool.sync_session.post(
+                f"{self.base_url}/chat/completions",
+                json=payload,
+                headers=self._build_headers(),
+                timeout=(http_pool.connect_timeout, http_pool.request_timeout)
+            )
+            response.raise_for_status()
+            return response.json()
+        
+        try:
+            return self._create_chat_result(llm_resilience.call_sync(self._llm_type, self.model, attempt))
+            
+        except requests.exceptions.RequestException as e:
+            # L'eccezione originale conserva status e tipo per retry e failover
+            logger.error(f"OpenRouter API error: {e}")
+            raise
+    
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Genera una risposta usando OpenRouter API senza bloccare l'event loop"""
+        payload = self._build_payload(messages, stop, **kwargs)
+        estimated_tokens = self._estimate_payload_tokens(payload)
+        
+        async def attempt():
+            await rate_limiter.acquire(self._llm_type, self.model, estimated_tokens)
+            async with http_pool.get_session().post(
+                f"{self.base_url}/chat/completions",
+                json=payload,
+                headers=self._build_headers()
+            ) as response:
+                rate_limiter.observe(self._llm_type, self.model, response.status, response.headers)
+                response.raise_for_status()
+                return await response.json()
+        
+        try:
+            data = await llm_resilience.call(self._llm_type, self.model, attempt)
+            usage = data.get("usage") or {}
+            rate_limiter.record_usage(self._llm_type, self.model, usage.get("total_tokens", 0), estimated_tokens)
+            return self._create_chat_result(data)
+            
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"OpenRouter API error: {e!r}")
+            raise
+    
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        """Genera la risposta token per token usando la modalità stream di OpenRouter (SSE)"""
+        payload = self._build_payload(messages, stop, **kwargs)
+        payload["stream"] = True
+        estimated_tokens = self._estimate_payload_tokens(payload)
+        
+        # Retry e circuit breaker valgono per l'apertura dello stream: dopo il primo token
+        # un errore non può essere ritentato senza duplicare l'output già inviato
+        async def attempt():
+            await rate_limiter.acquire(self._llm_type, self.model, estimated_tokens)
+            response = await http_pool.get_session().post(
+                f"{self.base_url}/chat/completions",
+                json=payload,
+                headers=self._build_headers()
+            )
+            rate_limiter.observe(self._llm_type, self.model, response.status, response.headers)
+            try:
+                response.raise_for_status()
+            except aiohttp.ClientResponseError:
+                response.release()
+                raise
+            return response
+        
+        try:
+            async with await llm_resilience.call(self._llm_type, self.model, attempt, hedge=False) as response:
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8").strip()
+                    # Le righe che iniziano con ":" sono commenti keep-alive di OpenRouter
+                    if not line or line.startswith(":") or not line.startswith("data:"):
+                        continue
+                    
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    
+                    try:
+                        event = json.loads(data)
+                    except json.JSONDecodeError:
+                        logger.debug(f"Chunk di streaming non valido ignorato: {data[:100]}")
+                        continue
+                    
+                    if "error" in event:
+                        error = event["error"] if isinstance(event["error"], dict) else {"message": event["error"]}
+                        code = error.get("code")
+                        raise OpenRouterAPIError(f"OpenRouter API error: {error.get('message', error)}",
+                                                 status=code if isinstance(code, int) else None)
+                    
+                    choices = event.get("choices") or []
+                    if not choices:
+                        continue
+                    
+                    delta = choices[0].get("delta") or {}
+                    token = delta.get("content") or ""
+                    # Le chiamate ai tool arrivano a frammenti, ricomposti da LangChain tramite l'indice
+                    tool_call_chunks = [
+                        {
+                            "name": (raw_call.get("function") or {}).get("name"),
+                            "args": (raw_call.get("function") or {}).get("arguments"),
+                            "id": raw_call.get("id"),
+                            "index": raw_call.get("index")
+                        }
+                        for raw_call in delta.get("tool_calls") or []
+                    ]
+                    if not token and not tool_call_chunks:
+                        continue
+                    
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=token, tool_call_chunks=tool_call_chunks))
+                    if run_manager:
+                        await run_manager.on_llm_new_token(token, chunk=chunk)
+                    yield chunk
+                    
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"OpenRouter API error: {e!r}")
+            raise
+    
+    def _convert_tools(self, tools: List[Any]) -> List[Dict[str, Any]]:
+        """Converte i tool nel formato OpenAI, riusando gli schemi già calcolati
+        
+        L'agent chiama bind_tools a ogni passo con gli stessi oggetti tool: la
+        conversione (che serializza lo schema JSON di ogni tool) avviene una volta.
+        """
+        key = tuple(id(tool) for tool in tools)
+        schemas = self._tool_schemas.get(key)
+        if schemas is None:
+            schemas = [tool if isinstance(tool, dict) else convert_to_openai_tool(tool) for tool in tools]
+            if len(self._tool_schemas) >= self.TOOL_SCHEMA_CACHE_SIZE:
+                self._tool_schemas.pop(next(iter(self._tool_schemas)))
+            self._tool_schemas[key] = schemas
+        return schemas
+    
+    def bind_tools(self, tools, *, tool_choice: Optional[Any] = None, **kwargs):
+        """Lega i tool MCP al modello come function calling nativo di OpenRouter
+        
+        Con native_tools disattivato i tool non vengono inviati (comportamento precedente).
+        """
+        if not self.native_tools:
+            return self
+        
+        if tool_choice in ("any", True):
+            tool_choice = "required"
+        elif isinstance(tool_choice, str) and tool_choice not in ("auto", "none", "required"):
+            tool_choice = {"type": "function", "function": {"name": tool_choice}}
+        
+        # Parametri di structured output non supportati dal wrapper
+        kwargs.pop("strict", None)
+        return self.bind(tools=self._convert_tools(tools), tool_choice=tool_choice, **kwargs)
+    
+    @property
+    def _identifying_params(self) -> dict:
+        """Parametri identificativi per il modello"""
+        return {
+            "model": self.model,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "base_url": self.base_url
+        }
+
+# Configurazione immutabile del modello usata per una richiesta
+@dataclass(frozen=True)
+class LLMConfig:
+    """Provider, modello e parametri di generazione di una richiesta
+    
+    È immutabile e fa da chiave del pool: richieste con parametri diversi non
+    condividono mai lo stesso LLM.
+    """
+    provider: str
+    model: str
+    temperature: float
+    max_tokens: int
+
+# Controllo di ammissione delle richieste
+class AdmissionController:
+    """Limita le query in esecuzione, globalmente e per utente, con una coda a priorità
+    
+    Oltre max_concurrent richieste (o max_per_user per lo stesso utente) le nuove
+    attendono in una coda limitata, servita per priorità e poi in ordine di arrivo.
+    Le richieste vengono rifiutate subito con 429 se l'utente ha già troppe
+    richieste in corso o in coda, con 503 se la coda è piena o l'attesa supera
+    queue_timeout; entrambe le risposte indicano Retry-After.
+    """
+    
+    PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+    
+    def __init__(self, max_concurrent: int = 16, max_per_user: int = 2, max_queue: int = 64,
+                 max_queued_per_user: int = 4, queue_timeout: float = 30):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.queue_timeout = queue_timeout
+        
+        self.active = 0
+        self.queued = 0
+        self._user_active: Dict[str, int] = defaultdict(int)
+        self._user_queued: Dict[str, int] = defaultdict(int)
+        # Coda: (priorità, ordine di arrivo, user_id, future risolta all'ammissione, limite per utente)
+        self._queue: List[Tuple[int, int, str, asyncio.Future, bool]] = []
+        self._seq = itertools.count()
+        
+        # In fase di drain (arresto del worker) le nuove richieste vengono rifiutate
+        self.draining = False
+        
+        self.stats = {"admitted": 0, "queued": 0, "rejected_user_limit": 0,
+                      "rejected_queue_full": 0, "rejected_timeout": 0, "rejected_draining": 0}
+        self._waits: deque = deque(maxlen=1000)
+        # Media mobile esponenziale della durata delle richieste, per stimare Retry-After
+        self._service_time: Optional[float] = None
+    
+    def _can_start(self, user_id: str, user_limit: bool = True) -> bool:
+        if self.active >= self.max_concurrent:
+            return False
+        # get() e non [] per non creare voci a zero negli utenti che non vengono ammessi
+        return not user_limit or self.max_per_user <= 0 or self._user_active.get(user_id, 0) < self.max_per_user
+    
+    def _start(self, user_id: str):
+        self.active += 1
+        self._user_active[user_id] += 1
+        self.stats["admitted"] += 1
+    
+    def retry_after(self) -> int:
+        """Secondi suggeriti prima di riprovare, stimati da coda e durata media delle richieste"""
+        if not self._service_time:
+            return 1
+        return max(1, math.ceil(self._service_time * (self.queued + 1) / self.max_concurrent))
+    
+    def _reject(self, status_code: int, reason: str, detail: str):
+        self.stats[f"rejected_{reason}"] += 1
+        ERRORS.inc(stage="admission")
+        raise HTTPException(status_code=status_code, detail=detail,
+                            headers={"Retry-After": str(self.retry_after())})
+    
+    async def acquire(self, user_id: str, priority: str = "normal", user_limit: bool = True) -> float:
+        """Attende il turno della richiesta; restituisce i secondi passati in coda
+        
+        Con user_limit=False non si applicano i limiti per utente (usato dai batch,
+        che hanno un proprio limite di concorrenza); quelli globali restano.
+        """
+        with tracer.span("admission.wait", **{"user.id": user_id, "admission.priority": priority}):
+            return await self._acquire(user_id, priority, user_limit)
+    
+    async def _acquire(self, user_id: str, priority: str, user_limit: bool = True) -> float:
+        if self.draining:
+            self._reject(503, "draining", "Server in arresto: riprovare su un altro worker")
+        if not self._queue and self._can_start(user_id, user_limit):
+            self._start(user_id)
+            self._waits.append(0.0)
+            QUEUE_WAIT.observe(0.0)
+            return 0.0
+        
+        user_pending = self._user_active.get(user_id, 0) + self._user_queued.get(user_id, 0)
+        if user_limit and self.max_per_user > 0 and user_pending >= self.max_per_user + self.max_queued_per_user:
+            self._reject(429, "user_limit", f"Troppe richieste in corso per l'utente {user_id}")
+        if self.queued >= self.max_queue:
+            self._reject(503, "queue_full", "Server sovraccarico: coda delle richieste piena")
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (self.PRIORITIES.get(priority, 1), next(self._seq), user_id, future, user_limit))
+        self.queued += 1
+        self._user_queued[user_id] += 1
+        self.stats["queued"] += 1
+        start = time.monotonic()
+        # Le richieste in coda bloccate solo dal proprio limite per utente non devono fermare
+        # quelle di altri utenti quando ci sono posti liberi
+        self._dispatch()
+        
+        try:
+            await asyncio.wait_for(future, self.queue_timeout if self.queue_timeout > 0 else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Ammessa proprio mentre scadeva l'attesa: il posto va restituito
+                self.release(user_id)
+            else:
+                self.queued -= 1
+                self._user_queued[user_id] -= 1
+                if self._user_queued[user_id] <= 0:
+                    del self._user_queued[user_id]
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject(503, "timeout", f"Server sovraccarico: attesa in coda oltre {self.queue_timeout}s")
+            raise
+        
+        waited = time.monotonic() - start
+        self._waits.append(waited)
+        QUEUE_WAIT.observe(waited)
+        return waited
+    
+    def release(self, user_id: str, service_time: Optional[float] = None):
+        self.active -= 1
+        self._user_active[user_id] -= 1
+        if self._user_active[user_id] <= 0:
+            del self._user_active[user_id]
+        if service_time is not None:
+            self._service_time = service_time if self._service_time is None else 0.8 * self._service_time + 0.2 * service_time
+        self._dispatch()
+    
+    def _dispatch(self):
+        """Ammette le richieste in coda finché ci sono posti, per priorità e arrivo"""
+        self._queue = [item for item in self._queue if not item[3].done()]
+        heapq.heapify(self._queue)
+        for item in sorted(self._queue):
+            if self.active >= self.max_concurrent:
+                break
+            _, _, user_id, future, user_limit = item
+            if not self._can_start(user_id, user_limit):
+                continue
+            self._queue.remove(item)
+            self.queued -= 1
+            self._user_queued[user_id] -= 1
+            if self._user_queued[user_id] <= 0:
+                del self._user_queued[user_id]
+            self._start(user_id)
+            future.set_result(None)
+        heapq.heapify(self._queue)
+    
+    @asynccontextmanager
+    async def admit(self, user_id: str, priority: str = "normal", user_limit: bool = True):
+        """Context manager che occupa un posto per tutta la durata della richiesta"""
+        waited = await self.acquire(user_id, priority, user_limit)
+        start = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self.release(user_id, time.monotonic() - start)
+    
+    async def drain(self, timeout: float) -> bool:
+        """Rifiuta le nuove richieste e attende (al massimo timeout secondi) quelle in corso e in coda"""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while self.active or self.queued:
+            if time.monotonic() >= deadline:
+                logger.warning(f"Drain interrotto dopo {timeout}s: {self.active} query in corso, {self.queued} in coda")
+                return False
+            await asyncio.sleep(0.1)
+        return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        by_priority = defaultdict(int)
+        for priority, _, _, future, _ in self._queue:
+            if not future.done():
+                by_priority[next(name for name, value in self.PRIORITIES.items() if value == priority)] += 1
+        return {
+            **self.stats,
+            "active": self.active,
+            "queue_depth": self.queued,
+            "queue_by_priority": dict(by_priority),
+            "max_concurrent": self.max_concurrent,
+            "max_per_user": self.max_per_user,
+            "max_queue": self.max_queue,
+            "draining": self.draining,
+            "wait_ms": {
+                "avg": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+                "p95": round(waits[int(len(waits) * 0.95) - 1 if len(waits) > 1 else 0] * 1000, 1) if waits else 0.0,
+                "max": round(waits[-1] * 1000, 1) if waits else 0.0
+            },
+            "service_time_ms": round(self._service_time * 1000, 1) if self._service_time else None
+        }
+
+# Pool di agent MCP riutilizzabili
+class AgentPoolEntry:
+    """Agent MCP già inizializzato, dato in uso esclusivo a una richiesta alla volta"""
+    
+    def __init__(self, config: LLMConfig, llm: Any, agent: Any):
+        self.config = config
+        self.llm = llm
+        self.agent = agent
+        self.group: Optional["AgentGroup"] = None
+        self.uses = 0
+    
+    @property
+    def client(self) -> Any:
+        return self.group.client if self.group else None
+
+@dataclass
+class AgentGroup:
+    """Agent e client MCP condiviso per una stessa LLMConfig"""
+    config: LLMConfig
+    client: Any = None
+    idle: List[AgentPoolEntry] = field(default_factory=list)
+    total: int = 0
+    in_use: int = 0
+    uses: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    evicted: bool = False
+    condition: asyncio.Condition = field(default_factory=asyncio.Condition)
+
+class AgentPool:
+    """Pool di agent MCP indicizzato per LLMConfig con eviction LRU e per inattività
+    
+    Ogni agent è dato in leasing a una sola richiesta alla volta, così richieste
+    concorrenti non possono modificare lo stato dell'agent usato da un'altra.
+    Gli agent della stessa configurazione condividono un client MCP (e quindi le
+    sessioni già aperte); fino a max_per_key agent vengono creati in parallelo,
+    oltre il limite le richieste attendono che uno venga rilasciato.
+    Un gruppo rimosso dal pool mentre è in uso viene chiuso solo quando l'ultima
+    richiesta rilascia il suo agent. Con shared_client il client restituito da
+    client_factory è unico per tutto il processo e non viene chiuso dal pool.
+    """
+    
+    def __init__(self, client_factory, agent_factory, max_size: int = 8,
+                 max_per_key: int = 4, idle_ttl: float = 600, shared_client: bool = False):
+        self._client_factory = client_factory
+        self._agent_factory = agent_factory
+        self.shared_client = shared_client
+        self.max_size = max(1, max_size)
+        self.max_per_key = max(1, max_per_key)
+        self.idle_ttl = idle_ttl
+        self._groups: "OrderedDict[LLMConfig, AgentGroup]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    async def acquire(self, config: LLMConfig) -> Optional[AgentPoolEntry]:
+        """Ottiene in uso esclusivo un agent per la configurazione, creandolo se necessario"""
+        self._evict_idle()
+        
+        while True:
+            group = self._groups.get(config)
+            if group is None:
+                group = AgentGroup(config=config)
+                self._groups[config] = group
+                self._evict_overflow()
+            self._groups.move_to_end(config)
+            
+            async with group.condition:
+                while not group.evicted and not group.idle and group.total >= self.max_per_key:
+                    await group.condition.wait()
+                
+                if group.evicted:
+                    # Il gruppo è stato rimosso durante l'attesa: si riparte da uno nuovo
+                    continue
+                
+                if group.idle:
+                    entry = group.idle.pop()
+                    self.hits += 1
+                else:
+                    # Riserva il posto prima di creare l'agent, fuori dal lock
+                    group.total += 1
+                    entry = None
+                group.in_use += 1
+                break
+        
+        if entry is None:
+            self.misses += 1
+            entry = await self._create_entry(group)
+            if entry is None:
+                async with group.condition:
+                    group.total -= 1
+                    group.in_use -= 1
+                    group.condition.notify()
+                return None
+        
+        entry.uses += 1
+        group.uses += 1
+        group.last_used = time.monotonic()
+        return entry
+    
+    async def _create_entry(self, group: AgentGroup) -> Optional[AgentPoolEntry]:
+        config = group.config
+        logger.info(f"Creazione nuovo agent nel pool per provider: {config.provider}, modello: {config.model}")
+        try:
+            if group.client is None:
+                group.client = self._client_factory()
+            entry = await self._agent_factory(config, group.client)
+        except Exception as e:
+            logger.error(f"Errore nella creazione dell'agent per {config}: {e}")
+            return None
+        if entry is not None:
+            entry.group = group
+        return entry
+    
+    async def release(self, entry: AgentPoolEntry):
+        """Restituisce al pool un agent ottenuto con acquire"""
+        group = entry.group
+        async with group.condition:
+            group.in_use = max(0, group.in_use - 1)
+            group.last_used = time.monotonic()
+            if not group.evicted:
+                group.idle.append(entry)
+                group.condition.notify()
+                return
+            group.condition.notify_all()
+        if group.in_use == 0:
+            await self._close_group(group)
+    
+    @asynccontextmanager
+    async def lease(self, config: LLMConfig):
+        """Context manager che acquisisce e rilascia un agent (None se non disponibile)"""
+        entry = await self.acquire(config)
+        try:
+            yield entry
+        finally:
+            if entry is not None:
+                await self.release(entry)
+    
+    def _evict(self, config: LLMConfig, reason: str):
+        group = self._groups.pop(config)
+        group.evicted = True
+        self.evictions += 1
+        logger.info(f"Agent rimossi dal pool ({reason}): provider: {config.provider}, modello: {config.model}")
+        if group.in_use == 0:
+            asyncio.ensure_future(self._close_group(group))
+    
+    def _evict_idle(self):
+        if self.idle_ttl <= 0:
+            return
+        now = time.monotonic()
+        for config, group in list(self._groups.items()):
+            if group.in_use == 0 and now - group.last_used > self.idle_ttl:
+                self._evict(config, "inattività")
+    
+    def _evict_overflow(self):
+        # Rimuove le configurazioni usate meno di recente finché il pool rientra nel limite
+        while len(self._groups) > self.max_size:
+            oldest = next(iter(self._groups))
+            self._evict(oldest, "capacità")
+    
+    async def _close_group(self, group: AgentGroup):
+        async with group.condition:
+            group.idle.clear()
+            # Sveglia le richieste in attesa: ripartiranno da un nuovo gruppo
+            group.condition.notify_all()
+        try:
+            if group.client is not None and not self.shared_client:
+                await group.client.close_all_sessions()
+        except Exception as e:
+            logger.warning(f"Errore nella chiusura degli agent {group.config}: {e}")
+        group.client = None
+    
+    def invalidate(self, reason: str):
+        """Rimuove tutti i gruppi: i nuovi agent verranno creati con i tool aggiornati"""
+        for config in list(self._groups):
+            self._evict(config, reason)
+    
+    async def close(self):
+        """Chiude tutti gli agent del pool"""
+        groups = list(self._groups.values())
+        self._groups.clear()
+        for group in groups:
+            group.evicted = True
+            await self._close_group(group)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "size": len(self._groups),
+            "max_size": self.max_size,
+            "max_per_key": self.max_per_key,
+            "idle_ttl": self.idle_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "agents": [
+                {
+                    "provider": config.provider,
+                    "model": config.model,
+                    "temperature": config.temperature,
+                    "max_tokens": config.max_tokens,
+                    "instances": group.total,
+                    "in_use": group.in_use,
+                    "uses": group.uses,
+                    "idle_seconds": round(now - group.last_used, 1)
+                }
+                for config, group in self._groups.items()
+            ]
+        }
+
+# Client MCP condiviso verso tutti i server configurati
+class MCPClientManager:
+    """Client MCP unico e di lunga durata per tutti i server di mcpServers
+    
+    Carica i server HTTP/SSE (url) e stdio (command) abilitati in un solo
+    MCPClient con una sessione per server, condivisa da tutti gli agent: le
+    richieste MCP vengono multiplexate sulla stessa connessione. Un task di
+    controllo verifica periodicamente le sessioni e ricollega i server caduti
+    con backoff esponenziale; lo stato di ogni server è esposto in /health.
+    """
+    
+    # Chiavi di configurazione passate a mcp_use; le altre sono opzioni del server HTTP
+    SERVER_KEYS = ("url", "headers", "auth", "transport", "timeout", "sse_read_timeout",
+                   "command", "args", "env")
+    
+    def __init__(self, config: Dict[str, Any], backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.servers = {
+            name: {key: value for key, value in server.items() if key in self.SERVER_KEYS}
+            for name, server in config.get("mcpServers", {}).items()
+            if not server.get("disabled", False) and ("url" in server or "command" in server)
+        }
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.client = None
+        # Callback (server, connector) chiamate per ogni nuova sessione
+        self.session_hooks: List[Any] = []
+        # Callback chiamate quando cambia l'insieme delle sessioni (i tool degli agent vanno ricreati)
+        self.change_hooks: List[Any] = []
+        self._locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.health: Dict[str, Dict[str, Any]] = {
+            name: {
+                "transport": "stdio" if "command" in server else "http",
+                "status": "idle",
+                "tools": 0,
+                "failures": 0,
+                "reconnects": 0,
+                "last_error": None,
+                "last_connected": None,
+                "next_retry": 0.0
+            }
+            for name, server in self.servers.items()
+        }
+    
+    def get_client(self):
+        """Restituisce il client condiviso, creandolo alla prima richiesta"""
+        if self.client is None:
+            if not self.servers:
+                logger.warning("Nessun server MCP abilitato in mcpServers")
+            logger.info(f"Creazione client MCP per i server: {', '.join(self.servers) or 'nessuno'}")
+            MCPClient = lazy_imports.load("mcp_use", "MCPClient")
+            self.client = MCPClient.from_dict({"mcpServers": self.servers})
+        return self.client
+    
+    def _backoff(self, failures: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** max(0, failures - 1)))
+        # Jitter per non ricollegare tutti i worker nello stesso istante
+        return delay * random.uniform(0.5, 1.0)
+    
+    async def connect(self, server: str) -> bool:
+        """Apre (o riapre) la sessione verso un server"""
+        health = self.health[server]
+        client = self.get_client()
+        async with self._locks[server]:
+            existing = client.sessions.get(server)
+            if existing is not None and existing.is_connected:
+                # Sessione già aperta (ad esempio dall'inizializzazione di un agent)
+                health.update(status="connected", failures=0, last_error=None, next_retry=0.0)
+                for hook in self.session_hooks:
+                    hook(server, existing.connector)
+                return True
+            
+            reconnect = existing is not None
+            health["status"] = "connecting"
+            try:
+                if reconnect:
+                    try:
+                        await client.close_session(server)
+                    except Exception as e:
+                        logger.debug(f"Chiusura della sessione {server} non riuscita: {e}")
+                with tracer.span("mcp.connect", **{"mcp.server": server, "mcp.reconnect": reconnect}):
+                    session = await client.create_session(server)
+            except Exception as e:
+                health["failures"] += 1
+                health["status"] = "disconnected"
+                health["last_error"] = str(e) or type(e).__name__
+                delay = self._backoff(health["failures"])
+                health["next_retry"] = time.monotonic() + delay
+                logger.warning(f"Connessione al server MCP {server} fallita (tentativo {health['failures']}, "
+                               f"nuovo tentativo tra {delay:.1f}s): {health['last_error']}")
+                return False
+            
+            if reconnect:
+                health["reconnects"] += 1
+            health.update(status="connected", failures=0, last_error=None, next_retry=0.0,
+                          last_connected=datetime.now().isoformat())
+            try:
+                health["tools"] = len(await session.list_tools())
+            except Exception:
+                health["tools"] = 0
+            logger.info(f"Server MCP {server} {'ricollegato' if reconnect else 'collegato'} ({health['tools']} tool)")
+        
+        for hook in self.session_hooks:
+            hook(server, session.connector)
+        for hook in self.change_hooks:
+            hook(server)
+        return True
+    
+    async def connect_all(self):
+        await asyncio.gather(*[self.connect(server) for server in self.servers])
+    
+    async def check(self):
+        """Aggiorna lo stato dei server e ricollega quelli caduti il cui backoff è scaduto"""
+        client = self.get_client()
+        now = time.monotonic()
+        pending = []
+        for server, health in self.health.items():
+            session = client.sessions.get(server)
+            if session is not None and session.is_connected:
+                if health["status"] != "connected":
+                    health.update(status="connected", failures=0, last_error=None,
+                                  last_connected=datetime.now().isoformat())
+                continue
+            if health["status"] == "connected":
+                logger.warning(f"Sessione con il server MCP {server} persa")
+                health["status"] = "disconnected"
+            if now >= health["next_retry"]:
+                pending.append(self.connect(server))
+        if pending:
+            await asyncio.gather(*pending)
+    
+    async def run_monitor(self, interval: float):
+        """Collega i server all'avvio e poi ne controlla periodicamente lo stato"""
+        logger.info(f"Controllo server MCP avviato (intervallo: {interval}s)")
+        await self.connect_all()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Errore nel controllo dei server MCP: {e}")
+    
+    async def close(self):
+        if self.client is not None:
+            try:
+                await self.client.close_all_sessions()
+            except Exception as e:
+                logger.warning(f"Errore nella chiusura del client MCP: {e}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            server: {
+                **{key: value for key, value in health.items() if key != "next_retry"},
+                "next_retry_in": round(max(0.0, health["next_retry"] - now), 1) if health["status"] == "disconnected" else None
+            }
+            for server, health in self.health.items()
+        }
+
+# Limiti di esecuzione delle chiamate ai tool MCP
+class ToolCallLimiter:
+    """Limite di concorrenza per server MCP e timeout per tool
+    
+    Si aggancia a connector.call_tool, il punto da cui passano tutte le chiamate
+    ai tool dell'agent. Le chiamate indipendenti richieste dal modello nello
+    stesso passo vengono già eseguite in parallelo (asyncio.gather nel nodo dei
+    tool dell'agent): qui si limita quante possono essere in corso verso lo
+    stesso server e per quanto tempo può durare ciascuna.
+    
+    Configurazione per server in mcp_config.json:
+        "max_concurrency": 4, "tool_timeout": 60, "tool_timeouts": {"nome_tool": 120}
+    """
+    
+    def __init__(self, config: Dict[str, Any]):
+        self.servers_config = config.get("mcpServers", {})
+        self.default_concurrency = int(os.getenv('TOOL_MAX_CONCURRENCY_PER_SERVER', 4))
+        self.default_timeout = float(os.getenv('TOOL_TIMEOUT_SECONDS', 60))
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"calls": 0, "in_flight": 0, "max_in_flight": 0, "timeouts": 0, "errors": 0}
+        )
+    
+    def concurrency_for(self, server: str) -> int:
+        return int(self.servers_config.get(server, {}).get("max_concurrency", self.default_concurrency))
+    
+    def timeout_for(self, server: str, tool: str) -> float:
+        server_config = self.servers_config.get(server, {})
+        timeouts = server_config.get("tool_timeouts", {})
+        if tool in timeouts:
+            return float(timeouts[tool])
+        return float(server_config.get("tool_timeout", self.default_timeout))
+    
+    def _semaphore(self, server: str) -> Optional[asyncio.Semaphore]:
+        limit = self.concurrency_for(server)
+        if limit <= 0:
+            return None
+        if server not in self._semaphores:
+            self._semaphores[server] = asyncio.Semaphore(limit)
+        return self._semaphores[server]
+    
+    async def call(self, server: str, call_tool, name: str, arguments: Dict[str, Any],
+                   read_timeout_seconds: Optional[timedelta] = None):
+        """Esegue call_tool rispettando il limite del server e il timeout del tool"""
+        timeout = self.timeout_for(server, name)
+        semaphore = self._semaphore(server)
+        stats = self.stats[server]
+        
+        if semaphore is not None:
+            await semaphore.acquire()
+        stats["calls"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            if timeout <= 0:
+                return await call_tool(name, arguments, read_timeout_seconds)
+            return await asyncio.wait_for(
+                call_tool(name, arguments, read_timeout_seconds or timedelta(seconds=timeout)),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            status = "timeout"
+            stats["timeouts"] += 1
+            ERRORS.inc(stage="tool")
+            logger.warning(f"Timeout del tool {name} sul server {server} dopo {timeout}s")
+            # L'errore viene restituito al modello come risultato del tool
+            raise TimeoutError(f"Il tool {name} non ha risposto entro {timeout} secondi")
+        except Exception:
+            status = "error"
+            stats["errors"] += 1
+            ERRORS.inc(stage="tool")
+            raise
+        finally:
+            TOOL_LATENCY.observe(time.perf_counter() - started, server=server, tool=name, status=status)
+            stats["in_flight"] -= 1
+            if semaphore is not None:
+                semaphore.release()
+    
+    def wrap_connector(self, server: str, connector: Any):
+        """Fa passare le chiamate ai tool del connector attraverso il limitatore"""
+        if getattr(connector, "_tool_limiter", None) is self:
+            return
+        original = connector.call_tool
+        
+        async def call_tool(name: str, arguments: Dict[str, Any], read_timeout_seconds: Optional[timedelta] = None):
+            return await self.call(server, original, name, arguments, read_timeout_seconds)
+        
+        connector.call_tool = call_tool
+        connector._tool_limiter = self
+    
+    def wrap_client(self, client: Any):
+        """Aggancia il limitatore a tutte le sessioni aperte del client MCP"""
+        for server, session in getattr(client, "sessions", {}).items():
+            self.wrap_connector(server, session.connector)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            server: {
+                **stats,
+                "max_concurrency": self.concurrency_for(server),
+                "tool_timeout": self.timeout_for(server, "")
+            }
+            for server, stats in self.stats.items()
+        }
+
+# Cache dei risultati dei tool MCP idempotenti
+class ToolResultCache:
+    """Cache LRU con scadenza dei risultati dei tool MCP di sola lettura
+    
+    È attiva solo per i tool indicati in mcp_config.json, per server:
+        "tool_cache": {"tools": {"list_tables": 600, "describe_table": 300}}
+    dove il valore è il TTL in secondi ("*" vale per tutti i tool del server).
+    La chiave comprende server, tool e argomenti; i risultati con errore non
+    vengono salvati. Chiamate identiche contemporanee attendono un'unica
+    esecuzione invece di interrogare il server più volte.
+    """
+    
+    def __init__(self, config: Dict[str, Any], max_entries: int = 512):
+        self.max_entries = max(1, max_entries)
+        self._ttls: Dict[str, Dict[str, float]] = {
+            server: {tool: float(ttl) for tool, ttl in server_config.get("tool_cache", {}).get("tools", {}).items()}
+            for server, server_config in config.get("mcpServers", {}).items()
+            if server_config.get("tool_cache")
+        }
+        # Struttura: {(server, tool, argomenti): (scadenza, risultato)} in ordine LRU
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str, str], asyncio.Future] = {}
+        self.stats = {"hits": 0, "misses": 0, "shared": 0, "stores": 0, "evictions": 0, "expired": 0}
+        self.tool_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0})
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self._ttls)
+    
+    def ttl_for(self, server: str, tool: str) -> float:
+        tools = self._ttls.get(server, {})
+        return tools.get(tool, tools.get("*", 0))
+    
+    def _get(self, key: Tuple[str, str, str]) -> Optional[Any]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        expires_at, result = item
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return result
+    
+    def _put(self, key: Tuple[str, str, str], result: Any, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, result)
+        self._entries.move_to_end(key)
+        self.stats["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+    
+    async def call(self, server: str, call_tool, name: str, arguments: Dict[str, Any],
+                   read_timeout_seconds: Optional[timedelta] = None):
+        ttl = self.ttl_for(server, name)
+        if ttl <= 0:
+            return await call_tool(name, arguments, read_timeout_seconds)
+        
+        key = (server, name, json.dumps(arguments, sort_keys=True, default=str))
+        tool_stats = self.tool_stats[f"{server}/{name}"]
+        
+        result = self._get(key)
+        if result is not None:
+            self.stats["hits"] += 1
+            tool_stats["hits"] += 1
+            CACHE_LOOKUPS.inc(cache="tool", result="hit")
+            return result
+        
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats["shared"] += 1
+            tool_stats["hits"] += 1
+            CACHE_LOOKUPS.inc(cache="tool", result="hit")
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                # Annullata la richiesta che eseguiva la chiamata, non questa: la si esegue qui
+                logger.debug(f"Chiamata condivisa a {server}/{name} annullata dal proprietario, nuova esecuzione")
+                return await self.call(server, call_tool, name, arguments, read_timeout_seconds)
+        
+        self.stats["misses"] += 1
+        tool_stats["misses"] += 1
+        CACHE_LOOKUPS.inc(cache="tool", result="miss")
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await call_tool(name, arguments, read_timeout_seconds)
+            if not getattr(result, "isError", False):
+                self._put(key, result, ttl)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # L'eccezione viene propagata al chiamante: evita l'avviso per future non letta
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+    
+    def wrap_connector(self, server: str, connector: Any):
+        """Mette la cache davanti alle chiamate ai tool del connector"""
+        if server not in self._ttls or getattr(connector, "_tool_cache", None) is self:
+            return
+        original = connector.call_tool
+        
+        async def call_tool(name: str, arguments: Dict[str, Any], read_timeout_seconds: Optional[timedelta] = None):
+            return await self.call(server, original, name, arguments, read_timeout_seconds)
+        
+        connector.call_tool = call_tool
+        connector._tool_cache = self
+    
+    def wrap_client(self, client: Any):
+        for server, session in getattr(client, "sessions", {}).items():
+            self.wrap_connector(server, session.connector)
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "tools": {tool: dict(stats) for tool, stats in self.tool_stats.items()}
+        }
+
+# Archivi per la memoria delle conversazioni
+class MemoryStore:
+    """Interfaccia per l'archivio della memoria delle conversazioni
+    
+    Ogni messaggio è un dizionario {role, content, timestamp}; per ogni utente
+    vengono conservati al massimo `limit` messaggi, i più recenti.
+    """
+    
+    backend = "base"
+    
+    def __init__(self, limit: int, user_ttl: float = 0, max_users: int = 0, max_bytes: int = 0):
+        self.limit = limit
+        # Limiti globali (0 = disabilitato): inattività, numero di utenti, byte totali
+        self.user_ttl = user_ttl
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.evictions = {"ttl": 0, "max_users": 0, "max_bytes": 0}
+    
+    @staticmethod
+    def _message_size(message: Dict[str, str]) -> int:
+        """Stima in byte dello spazio occupato da un messaggio"""
+        return len(message["content"].encode("utf-8")) + len(message["role"]) + len(message["timestamp"])
+    
+    def sweep(self) -> int:
+        """Rimuove gli utenti scaduti o oltre i limiti globali; restituisce gli utenti rimossi"""
+        raise NotImplementedError
+    
+    def get_limits(self) -> Dict[str, Any]:
+        return {
+            "user_ttl_seconds": self.user_ttl,
+            "max_users": self.max_users,
+            "max_bytes": self.max_bytes
+        }
+    
+    def append(self, user_id: str, message: Dict[str, str]):
+        raise NotImplementedError
+    
+    def get_messages(self, user_id: str) -> List[Dict[str, str]]:
+        raise NotImplementedError
+    
+    def clear(self, user_id: Optional[str] = None) -> int:
+        """Pulisce la memoria di un utente o di tutti; restituisce il numero di utenti puliti"""
+        raise NotImplementedError
+    
+    def has_user(self, user_id: str) -> bool:
+        raise NotImplementedError
+    
+    def get_user_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Restituisce {user_id: {message_count, last_message_time}}"""
+        raise NotImplementedError
+    
+    def get_summary(self, user_id: str) -> Optional[Dict[str, str]]:
+        """Restituisce il riassunto dell'utente {text, covered_until, updated_at} se presente
+        
+        covered_until è il timestamp dell'ultimo messaggio già incluso nel riassunto.
+        """
+        raise NotImplementedError
+    
+    def set_summary(self, user_id: str, text: str, covered_until: str):
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+
+class InMemoryMemoryStore(MemoryStore):
+    """Memoria delle conversazioni nel processo corrente (persa al riavvio)
+    
+    Gli utenti sono tenuti in ordine LRU: quando si supera max_users o max_bytes
+    vengono rimossi quelli usati meno di recente, mentre quelli inattivi da più di
+    user_ttl secondi scadono alla lettura successiva o al passaggio dello sweeper.
+    """
+    
+    backend = "memory"
+    
+    def __init__(self, limit: int, user_ttl: float = 0, max_users: int = 0, max_bytes: int = 0):
+        super().__init__(limit, user_ttl, max_users, max_bytes)
+        # Struttura: {user_id: deque([{role, content, timestamp}], maxlen=limit)} in ordine LRU
+        self._conversations: "OrderedDict[str, deque]" = OrderedDict()
+        self._last_access: Dict[str, float] = {}
+        self._bytes: Dict[str, int] = {}
+        self._summaries: Dict[str, Dict[str, str]] = {}
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+    
+    def _touch(self, user_id: str):
+        self._conversations.move_to_end(user_id)
+        self._last_access[user_id] = time.monotonic()
+    
+    def _remove_user(self, user_id: str):
+        self._conversations.pop(user_id, None)
+        self._last_access.pop(user_id, None)
+        self._summaries.pop(user_id, None)
+        self.total_bytes -= self._bytes.pop(user_id, 0)
+    
+    def _is_expired(self, user_id: str, now: float) -> bool:
+        return self.user_ttl > 0 and now - self._last_access.get(user_id, now) > self.user_ttl
+    
+    def _enforce_capacity(self, current_user: str):
+        # Rimuove gli utenti meno recenti, lasciando per ultimo quello appena scritto
+        while self.max_users > 0 and len(self._conversations) > self.max_users:
+            oldest = next(iter(self._conversations))
+            if oldest == current_user:
+                break
+            self._remove_user(oldest)
+            self.evictions["max_users"] += 1
+        
+        while self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._conversations))
+            if oldest != current_user:
+                self._remove_user(oldest)
+                self.evictions["max_bytes"] += 1
+                continue
+            # Resta solo l'utente corrente: si scartano i suoi messaggi più vecchi
+            messages = self._conversations[current_user]
+            if len(messages) <= 1:
+                break
+            size = self._message_size(messages.popleft())
+            self._bytes[current_user] -= size
+            self.total_bytes -= size
+    
+    def append(self, user_id: str, message: Dict[str, str]):
+        size = self._message_size(message)
+        with self._lock:
+            messages = self._conversations.get(user_id)
+            if messages is None:
+                messages = self._conversations[user_id] = deque(maxlen=self.limit)
+                self._bytes[user_id] = 0
+            
+            # La deque scarta da sola il messaggio più vecchio: se ne sottrae la dimensione
+            if len(messages) == messages.maxlen:
+                dropped = self._message_size(messages[0])
+                self._bytes[user_id] -= dropped
+                self.total_bytes -= dropped
+            
+            messages.append(message)
+            self._bytes[user_id] += size
+            self.total_bytes += size
+            self._touch(user_id)
+            self._enforce_capacity(user_id)
+    
+    def get_messages(self, user_id: str) -> List[Dict[str, str]]:
+        with self._lock:
+            if user_id not in self._conversations:
+                return []
+            if self._is_expired(user_id, time.monotonic()):
+                self._remove_user(user_id)
+                self.evictions["ttl"] += 1
+                return []
+            self._touch(user_id)
+            return list(self._conversations[user_id])
+    
+    def clear(self, user_id: Optional[str] = None) -> int:
+        with self._lock:
+            if user_id:
+                if user_id not in self._conversations:
+                    return 0
+                self._remove_user(user_id)
+                return 1
+            users = len(self._conversations)
+            self._conversations.clear()
+            self._last_access.clear()
+            self._bytes.clear()
+            self._summaries.clear()
+            self.total_bytes = 0
+            return users
+    
+    def has_user(self, user_id: str) -> bool:
+        return user_id in self._conversations
+    
+    def sweep(self) -> int:
+        if self.user_ttl <= 0:
+            return 0
+        now = time.monotonic()
+        removed = 0
+        with self._lock:
+            # L'ordine è LRU: ci si ferma al primo utente non ancora scaduto
+            for user_id in list(self._conversations):
+                if not self._is_expired(user_id, now):
+                    break
+                self._remove_user(user_id)
+                removed += 1
+            self.evictions["ttl"] += removed
+        return removed
+    
+    def get_user_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                user_id: {
+                    "message_count": len(messages),
+                    "last_message_time": messages[-1]["timestamp"] if messages else None,
+                    "bytes": self._bytes.get(user_id, 0)
+                }
+                for user_id, messages in self._conversations.items()
+            }
+    
+    def get_summary(self, user_id: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            summary = self._summaries.get(user_id)
+            return dict(summary) if summary else None
+    
+    def set_summary(self, user_id: str, text: str, covered_until: str):
+        with self._lock:
+            # L'utente può essere stato rimosso mentre il riassunto veniva generato
+            if user_id not in self._conversations:
+                return
+            previous = self._summaries.get(user_id)
+            delta = len(text.encode("utf-8")) - (len(previous["text"].encode("utf-8")) if previous else 0)
+            self._summaries[user_id] = {
+                "text": text,
+                "covered_until": covered_until,
+                "updated_at": datetime.now().isoformat()
+            }
+            self._bytes[user_id] += delta
+            self.total_bytes += delta
+
+class SQLiteMemoryStore(MemoryStore):
+    """Memoria delle conversazioni su SQLite, condivisibile tra più worker
+    
+    Il database usa il journal WAL, così le letture non si bloccano durante le
+    scritture. I messaggi nuovi vengono accodati e scritti a blocchi da un thread
+    in background, ogni flush_interval o appena la coda raggiunge batch_size: la
+    scrittura non avviene mai nel percorso della richiesta. Le letture del
+    processo corrente includono anche i messaggi ancora in coda.
+    """
+    
+    backend = "sqlite"
+    
+    def __init__(self, limit: int, path: str = "conversation_memory.db",
+                 batch_size: int = 32, flush_interval: float = 0.05,
+                 user_ttl: float = 0, max_users: int = 0, max_bytes: int = 0):
+        super().__init__(limit, user_ttl, max_users, max_bytes)
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        
+        self._writer = self._connect()
+        self._reader = self._connect()
+        self._writer.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, id);
+            CREATE TABLE IF NOT EXISTS summaries (
+                user_id TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                covered_until TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+        """)
+        self._writer.commit()
+        
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending: List[Tuple[str, Dict[str, str]]] = []
+        
+        self._stop = threading.Event()
+        # Sveglia il thread di scrittura prima di flush_interval quando il blocco è pieno
+        self._wake = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="memory-flusher", daemon=True)
+        self._flusher.start()
+        
+        logger.info(f"Memoria conversazioni su SQLite: {self.path} (batch: {self.batch_size}, "
+                    f"flush ogni {self.flush_interval * 1000:.0f} ms)")
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+    
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Errore nella scrittura della memoria su SQLite: {e}")
+    
+    def flush(self):
+        """Scrive su disco i messaggi in coda e applica il limite per utente"""
+        with self._write_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            
+            self._writer.executemany(
+                "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                [(user_id, m["role"], m["content"], m["timestamp"]) for user_id, m in batch]
+            )
+            for user_id in {user_id for user_id, _ in batch}:
+                self._writer.execute(
+                    "DELETE FROM messages WHERE user_id = ? AND id NOT IN "
+                    "(SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                    (user_id, user_id, self.limit)
+                )
+            self._writer.commit()
+    
+    def append(self, user_id: str, message: Dict[str, str]):
+        with self._pending_lock:
+            self._pending.append((user_id, message))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+    
+    def get_messages(self, user_id: str) -> List[Dict[str, str]]:
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT role, content, timestamp FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, self.limit)
+            ).fetchall()
+        messages = [{"role": r, "content": c, "timestamp": t} for r, c, t in reversed(rows)]
+        
+        with self._pending_lock:
+            messages.extend(m for uid, m in self._pending if uid == user_id)
+        return messages[-self.limit:]
+    
+    def clear(self, user_id: Optional[str] = None) -> int:
+        with self._write_lock:
+            with self._pending_lock:
+                if user_id:
+                    pending_users = {uid for uid, _ in self._pending if uid == user_id}
+                    self._pending = [(uid, m) for uid, m in self._pending if uid != user_id]
+                else:
+                    pending_users = {uid for uid, _ in self._pending}
+                    self._pending = []
+            
+            if user_id:
+                cursor = self._writer.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+                self._writer.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
+                cleared = 1 if cursor.rowcount > 0 or pending_users else 0
+            else:
+                stored_users = {row[0] for row in self._writer.execute("SELECT DISTINCT user_id FROM messages")}
+                self._writer.execute("DELETE FROM messages")
+                self._writer.execute("DELETE FROM summaries")
+                cleared = len(stored_users | pending_users)
+            self._writer.commit()
+        return cleared
+    
+    def has_user(self, user_id: str) -> bool:
+        with self._pending_lock:
+            if any(uid == user_id for uid, _ in self._pending):
+                return True
+        with self._read_lock:
+            row = self._reader.execute("SELECT 1 FROM messages WHERE user_id = ? LIMIT 1", (user_id,)).fetchone()
+        return row is not None
+    
+    def get_user_stats(self) -> Dict[str, Dict[str, Any]]:
+        self.flush()
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT user_id, COUNT(*), MAX(timestamp), "
+                "SUM(LENGTH(CAST(content AS BLOB)) + LENGTH(role) + LENGTH(timestamp)) "
+                "FROM messages GROUP BY user_id"
+            ).fetchall()
+        return {
+            user_id: {"message_count": count, "last_message_time": last, "bytes": size}
+            for user_id, count, last, size in rows
+        }
+    
+    def get_summary(self, user_id: str) -> Optional[Dict[str, str]]:
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT text, covered_until, updated_at FROM summaries WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"text": row[0], "covered_until": row[1], "updated_at": row[2]}
+    
+    def set_summary(self, user_id: str, text: str, covered_until: str):
+        with self._write_lock:
+            self._writer.execute(
+                "INSERT OR REPLACE INTO summaries (user_id, text, covered_until, updated_at) VALUES (?, ?, ?, ?)",
+                (user_id, text, covered_until, datetime.now().isoformat())
+            )
+            self._writer.commit()
+    
+    def _delete_users(self, user_ids: List[str]) -> int:
+        if user_ids:
+            params = [(u,) for u in user_ids]
+            self._writer.executemany("DELETE FROM messages WHERE user_id = ?", params)
+            self._writer.executemany("DELETE FROM summaries WHERE user_id = ?", params)
+        return len(user_ids)
+    
+    def sweep(self) -> int:
+        """Applica TTL e limiti globali sul database
+        
+        L'attività di un utente è data dal timestamp del suo ultimo messaggio,
+        così la scadenza è coerente tra tutti i worker che condividono il file.
+        """
+        self.flush()
+        removed = 0
+        with self._write_lock:
+            if self.user_ttl > 0:
+                cutoff = (datetime.now() - timedelta(seconds=self.user_ttl)).isoformat()
+                expired = [row[0] for row in self._writer.execute(
+                    "SELECT user_id FROM messages GROUP BY user_id HAVING MAX(timestamp) < ?", (cutoff,)
+                )]
+                self.evictions["ttl"] += self._delete_users(expired)
+                removed += len(expired)
+            
+            if self.max_users > 0 or self.max_bytes > 0:
+                # Utenti dal più recente al meno recente con lo spazio occupato
+                users = self._writer.execute(
+                    "SELECT user_id, SUM(LENGTH(CAST(content AS BLOB)) + LENGTH(role) + LENGTH(timestamp)) "
+                    "FROM messages GROUP BY user_id ORDER BY MAX(timestamp) DESC"
+                ).fetchall()
+                over_users, over_bytes = [], []
+                used_bytes = 0
+                for position, (user_id, size) in enumerate(users):
+                    used_bytes += size
+                    if self.max_users > 0 and position >= self.max_users:
+                        over_users.append(user_id)
+                    elif self.max_bytes > 0 and used_bytes > self.max_bytes and position > 0:
+                        over_bytes.append(user_id)
+                self.evictions["max_users"] += self._delete_users(over_users)
+                self.evictions["max_bytes"] += self._delete_users(over_bytes)
+                removed += len(over_users) + len(over_bytes)
+            
+            self._writer.commit()
+        return removed
+    
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self._flusher.join(timeout=2)
+        self.flush()
+        self._writer.close()
+        self._reader.close()
+
+def create_memory_store(limit: int) -> MemoryStore:
+    """Crea l'archivio della memoria in base a MEMORY_BACKEND (memory, sqlite)"""
+    backend = os.getenv('MEMORY_BACKEND', 'memory').lower()
+    limits = {
+        "user_ttl": float(os.getenv('MEMORY_USER_TTL_SECONDS', 86400)),
+        "max_users": int(os.getenv('MEMORY_MAX_USERS', 10000)),
+        "max_bytes": int(os.getenv('MEMORY_MAX_BYTES', 256 * 1024 * 1024))
+    }
+    if backend == "sqlite":
+        return SQLiteMemoryStore(
+            limit=limit,
+            path=os.getenv('MEMORY_SQLITE_PATH', 'conversation_memory.db'),
+            batch_size=int(os.getenv('MEMORY_BATCH_SIZE', 32)),
+            flush_interval=float(os.getenv('MEMORY_FLUSH_INTERVAL_MS', 50)) / 1000,
+            **limits
+        )
+    if backend != "memory":
+        logger.warning(f"Backend memoria {backend} non supportato, uso memoria in-process")
+    return InMemoryMemoryStore(limit, **limits)
+
+# Registro dei prompt di sistema
+class PromptRegistry:
+    """Prompt di sistema della directory prompts/ tenuti in memoria
+    
+    I file *.txt vengono letti all'avvio; refresh() confronta le date di modifica
+    e ricarica solo i file cambiati, aggiunge quelli nuovi e rimuove quelli
+    cancellati. Le richieste leggono solo dalla memoria, senza accessi al disco.
+    """
+    
+    PREVIEW_CHARS = 120
+    
+    def __init__(self, directory: str = "prompts"):
+        self.directory = directory
+        # Struttura: {nome: {content, path, mtime}}
+        self._prompts: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.refresh()
+        logger.info(f"Registro prompt: {len(self._prompts)} prompt caricati da {self.directory}/")
+    
+    def _scan(self) -> Dict[str, Tuple[str, float]]:
+        """Restituisce {nome: (percorso, mtime)} dei file *.txt della directory"""
+        found = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(".txt"):
+                        found[entry.name[:-4]] = (entry.path, entry.stat().st_mtime)
+        except FileNotFoundError:
+            logger.debug(f"Directory prompt non trovata: {self.directory}")
+        return found
+    
+    def refresh(self) -> int:
+        """Allinea il registro ai file su disco; restituisce il numero di prompt cambiati"""
+        found = self._scan()
+        loaded = {}
+        for name, (path, mtime) in found.items():
+            current = self._prompts.get(name)
+            if current and current["mtime"] == mtime:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    loaded[name] = {"content": f.read().strip(), "path": path, "mtime": mtime}
+                logger.info(f"Prompt {'ricaricato' if current else 'caricato'} da file: {path}")
+            except Exception as e:
+                logger.error(f"Errore nel caricamento del prompt da {path}: {e}")
+        
+        with self._lock:
+            removed = [name for name in self._prompts if name not in found]
+            for name in removed:
+                del self._prompts[name]
+                logger.info(f"Prompt rimosso: {name}")
+            self._prompts.update(loaded)
+            changed = len(loaded) + len(removed)
+        return changed
+    
+    def get(self, name: str) -> Optional[str]:
+        prompt = self._prompts.get(name)
+        return prompt["content"] if prompt else None
+    
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            prompts = sorted(self._prompts.items())
+        return [
+            {
+                "name": name,
+                "file": prompt["path"],
+                "characters": len(prompt["content"]),
+                "modified": datetime.fromtimestamp(prompt["mtime"]).isoformat(),
+                "preview": prompt["content"][:self.PREVIEW_CHARS]
+            }
+            for name, prompt in prompts
+        ]
+    
+    async def run_watcher(self, interval: float):
+        """Controlla periodicamente le modifiche ai file dei prompt"""
+        logger.info(f"Controllo modifiche prompt avviato (intervallo: {interval}s)")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.error(f"Errore nel controllo dei prompt: {e}")
+
+# Cache delle risposte per query ripetute
+class ResponseCache:
+    """Cache LRU con scadenza delle risposte alle query senza contesto
+    
+    La chiave è l'hash di provider, modello, parametri di generazione effettivi
+    (temperatura, max_tokens, max_steps), prompt di sistema e prompt con gli spazi
+    compattati; le maiuscole contano (nomi di file, identificatori). Con disk_path
+    le risposte vengono salvate anche su SQLite: sopravvivono ai riavvii, sono
+    condivise tra worker e alla lettura tornano nella cache in memoria.
+    """
+    
+    def __init__(self, max_entries: int = 1000, ttl: float = 300, disk_path: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.disk_path = disk_path
+        # Struttura: {key: (scadenza, {response, provider, model, steps})} in ordine LRU
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+        
+        self._disk = None
+        self._disk_lock = threading.Lock()
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False, timeout=5.0)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._disk.commit()
+    
+    @staticmethod
+    def make_key(provider: str, model: str, system_prompt: Optional[str], prompt: str,
+                 temperature: float, max_tokens: int, max_steps: int) -> str:
+        normalized = {
+            "provider": provider,
+            "model": model,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "max_steps": max_steps,
+            "system_prompt": " ".join((system_prompt or "").split()),
+            "prompt": " ".join(prompt.split())
+        }
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    def _get_memory(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at > now:
+            self._entries.move_to_end(key)
+            return value
+        del self._entries[key]
+        self.stats["expired"] += 1
+        return None
+    
+    def _get_disk(self, key: str, now: float) -> Optional[Tuple[Dict[str, Any], float]]:
+        with self._disk_lock:
+            if self._disk is None:
+                return None
+            row = self._disk.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else None
+    
+    def _put_disk(self, key: str, value: Dict[str, Any], expires_at: float):
+        data = json.dumps(value)
+        with self._disk_lock:
+            if self._disk is None:
+                return
+            self._disk.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, data, expires_at)
+            )
+            self._disk.commit()
+    
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        # Il tempo di sistema (non monotonic) è confrontabile tra processi sul tier su disco
+        now = time.time()
+        with self._lock:
+            value = self._get_memory(key, now)
+            if value is not None:
+                self.stats["hits"] += 1
+                return value
+        
+        if self._disk is not None:
+            # Le query SQLite vengono eseguite fuori dall'event loop
+            found = await asyncio.to_thread(self._get_disk, key, now)
+            if found is not None:
+                value, expires_at = found
+                with self._lock:
+                    self._store_memory(key, value, expires_at)
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                return value
+        
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+    
+    def _store_memory(self, key: str, value: Dict[str, Any], expires_at: float):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+    
+    async def put(self, key: str, value: Dict[str, Any]):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store_memory(key, value, expires_at)
+            self.stats["stores"] += 1
+        if self._disk is not None:
+            await asyncio.to_thread(self._put_disk, key, value, expires_at)
+    
+    def sweep(self) -> int:
+        """Elimina dal tier su disco le risposte scadute (eseguito periodicamente, fuori dall'event loop)"""
+        with self._disk_lock:
+            if self._disk is None:
+                return 0
+            removed = self._disk.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),)).rowcount
+            self._disk.commit()
+        return removed
+    
+    async def run_sweeper(self, interval: float):
+        """Rimuove periodicamente le righe scadute dal tier su disco"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await asyncio.to_thread(self.sweep)
+                if removed:
+                    logger.debug(f"Cache risposte: rimosse {removed} voci scadute dal disco")
+            except Exception as e:
+                logger.error(f"Errore nella pulizia della cache delle risposte: {e}")
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        with self._disk_lock:
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM responses")
+                self._disk.commit()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "disk": self.disk_path,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+        }
+    
+    def close(self):
+        with self._disk_lock:
+            if self._disk is not None:
+                self._disk.close()
+                self._disk = None
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """Crea la cache delle risposte se RESPONSE_CACHE_ENABLED è attivo"""
+    if os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() != 'true':
+        return None
+    cache = ResponseCache(
+        max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+        ttl=float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', 300)),
+        disk_path=os.getenv('RESPONSE_CACHE_DISK_PATH') or None
+    )
+    logger.info(f"Cache risposte attiva (max {cache.max_entries} voci, TTL {cache.ttl}s"
+                f"{', su disco: ' + cache.disk_path if cache.disk_path else ''})")
+    return cache
+
+def create_admission_controller() -> AdmissionController:
+    """Crea il controllo di ammissione con i limiti letti dalle variabili d'ambiente"""
+    controller = AdmissionController(
+        max_concurrent=int(os.getenv('ADMISSION_MAX_CONCURRENT', 16)),
+        max_per_user=int(os.getenv('ADMISSION_MAX_PER_USER', 2)),
+        max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', 64)),
+        max_queued_per_user=int(os.getenv('ADMISSION_MAX_QUEUED_PER_USER', 4)),
+        queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 30))
+    )
+    logger.info(f"Controllo ammissione: {controller.max_concurrent} query in parallelo, "
+                f"{controller.max_per_user} per utente, coda di {controller.max_queue}")
+    return controller
+
+# Costruzione del contesto conversazione entro un budget di token
+@dataclass
+class ConversationContext:
+    """Contesto conversazione selezionato per un prompt"""
+    prompt: str
+    messages_used: int = 0
+    truncated_messages: int = 0
+    tokens: int = 0
+    summary_used: bool = False
+
+class ContextBuilder:
+    """Seleziona i messaggi precedenti da includere nel prompt entro un budget di token
+    
+    I messaggi vengono scelti dal più recente al più vecchio finché il budget del
+    modello lo consente; un messaggio che supera max_message_tokens viene troncato.
+    Il conteggio usa tiktoken se disponibile, altrimenti una stima di ~4 caratteri
+    per token.
+    """
+    
+    TRUNCATION_MARKER = " [...troncato]"
+    # Sotto questa soglia non conviene includere un messaggio troncato
+    MIN_USEFUL_TOKENS = 32
+    
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.default_budget = int(os.getenv('CONTEXT_TOKEN_BUDGET', 2000))
+        self.max_message_tokens = int(os.getenv('CONTEXT_MAX_MESSAGE_TOKENS', 500))
+        self._encoding = None
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.debug(f"tiktoken non disponibile, stima dei token per caratteri: {e}")
+    
+    def estimate_tokens(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return len(text) // 4 + 1
+    
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Tronca il testo a circa max_tokens token"""
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text
+            return self._encoding.decode(tokens[:max_tokens]) + self.TRUNCATION_MARKER
+        max_chars = max_tokens * 4
+        if len(text) <= max_chars:
+            return text
+        return text[:max_chars] + self.TRUNCATION_MARKER
+    
+    def budget_for(self, provider: str, model: str) -> int:
+        """Budget di token del contesto per il modello
+        
+        Letto da providers.<provider>.context_budgets.<model>, poi da
+        providers.<provider>.context_tokens, infine da CONTEXT_TOKEN_BUDGET.
+        """
+        provider_config = self.config.get("providers", {}).get(provider, {})
+        budgets = provider_config.get("context_budgets", {})
+        if model in budgets:
+            return int(budgets[model])
+        return int(provider_config.get("context_tokens", self.default_budget))
+    
+    def build(self, messages: List[Dict[str, str]], current_prompt: str, budget: int,
+              summary: Optional[str] = None) -> ConversationContext:
+        """Costruisce il prompt includendo il contesto che rientra nel budget
+        
+        Se presente, il riassunto dei turni precedenti occupa al massimo metà del
+        budget; il resto va ai messaggi più recenti.
+        """
+        selected: List[str] = []
+        used_tokens = 0
+        truncated = 0
+        
+        summary_line = None
+        if summary:
+            summary_line = self.truncate(f"RIASSUNTO: {summary}", budget // 2)
+            used_tokens += self.estimate_tokens(summary_line)
+        
+        # Dal più recente al più vecchio: i messaggi recenti sono i più rilevanti
+        for msg in reversed(messages):
+            role_label = "UTENTE" if msg["role"] == "user" else "ASSISTENTE"
+            content = msg["content"]
+            
+            if self.estimate_tokens(content) > self.max_message_tokens:
+                content = self.truncate(content, self.max_message_tokens)
+                truncated += 1
+            
+            line = f"{role_label}: {content}"
+            line_tokens = self.estimate_tokens(line)
+            remaining = budget - used_tokens
+            
+            if line_tokens > remaining:
+                # Il messaggio non entra: se lo spazio residuo è utile lo si tronca, poi ci si ferma
+                if remaining >= self.MIN_USEFUL_TOKENS:
+                    line = self.truncate(line, remaining - self.estimate_tokens(self.TRUNCATION_MARKER))
+                    line_tokens = self.estimate_tokens(line)
+                    selected.append(line)
+                    used_tokens += line_tokens
+                    truncated += 1
+                break
+            
+            selected.append(line)
+            used_tokens += line_tokens
+        
+        if not selected and not summary_line:
+            return ConversationContext(prompt=current_prompt)
+        
+        context_parts = ["=== CONTESTO CONVERSAZIONE PRECEDENTE ==="]
+        if summary_line:
+            context_parts.append(summary_line)
+        context_parts.extend(reversed(selected))
+        context_parts.extend([
+            "=== FINE CONTESTO ===",
+            "",
+            f"DOMANDA CORRENTE: {current_prompt}"
+        ])
+        
+        return ConversationContext(
+            prompt="\n".join(context_parts),
+            messages_used=len(selected),
+            truncated_messages=truncated,
+            tokens=used_tokens,
+            summary_used=summary_line is not None
+        )
+
+class ConversationSummarizer:
+    """Riassunto incrementale delle conversazioni lunghe, eseguito in background
+    
+    Quando i messaggi non ancora riassunti di un utente superano
+    keep_recent + fold_batch, tutti tranne gli ultimi keep_recent vengono fusi nel
+    riassunto corrente con una chiamata al modello. Le richieste si limitano ad
+    accodare l'utente: il lavoro avviene in un task separato, fuori dal percorso
+    della richiesta. Con fold_batch + keep_recent sotto il limite di messaggi per
+    utente, i turni vengono riassunti prima di essere scartati dalla memoria.
+    """
+    
+    def __init__(self, store: MemoryStore, summarize_fn, keep_recent: int = 6, fold_batch: int = 10):
+        self.store = store
+        # summarize_fn(previous_summary, messages) -> nuovo riassunto (coroutine)
+        self.summarize_fn = summarize_fn
+        self.keep_recent = max(1, keep_recent)
+        self.fold_batch = max(1, fold_batch)
+        self.stats = {"runs": 0, "folded_messages": 0, "errors": 0}
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._queued: set = set()
+        self._worker: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def unsummarized(messages: List[Dict[str, str]], summary: Optional[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Messaggi successivi a quelli già inclusi nel riassunto"""
+        if not summary:
+            return messages
+        return [m for m in messages if m["timestamp"] > summary["covered_until"]]
+    
+    def schedule(self, user_id: str):
+        """Accoda l'utente per un eventuale aggiornamento del riassunto"""
+        if self._worker is None or user_id in self._queued:
+            return
+        self._queued.add(user_id)
+        self._queue.put_nowait(user_id)
+    
+    async def summarize_user(self, user_id: str) -> bool:
+        """Fonde i turni più vecchi nel riassunto dell'utente se ce ne sono abbastanza"""
+        messages, summary = await asyncio.to_thread(
+            lambda: (self.store.get_messages(user_id), self.store.get_summary(user_id))
+        )
+        pending = self.unsummarized(messages, summary)
+        if len(pending) < self.keep_recent + self.fold_batch:
+            return False
+        
+        to_fold = pending[:-self.keep_recent]
+        text = await self.summarize_fn(summary["text"] if summary else None, to_fold)
+        await asyncio.to_thread(self.store.set_summary, user_id, text, to_fold[-1]["timestamp"])
+        
+        self.stats["runs"] += 1
+        self.stats["folded_messages"] += len(to_fold)
+        logger.debug(f"Riassunto aggiornato per utente {user_id} ({len(to_fold)} messaggi)")
+        return True
+    
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
+            self._queued.discard(user_id)
+            try:
+                await self.summarize_user(user_id)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Errore nel riassunto della conversazione per utente {user_id}: {e}")
+    
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+            logger.info(f"Riassunto conversazioni attivo (ultimi {self.keep_recent} messaggi integrali, "
+                        f"blocchi da {self.fold_batch})")
+    
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "queued": self._queue.qsize()}
+
+# Job asincroni: query lunghe eseguite in background con risultato da interrogare
+class JobManager:
+    """Coda di job eseguiti da un pool di worker in background, con stato consultabile
+    
+    submit restituisce subito il job in stato queued; i worker (task asyncio)
+    prendono i job dalla coda ed eseguono run_fn. Stati: queued, running,
+    succeeded, failed, cancelled. I job terminati restano consultabili per
+    retention secondi e al più max_retained alla volta (i più vecchi vengono
+    rimossi per primi). Ogni utente ha al più max_running_per_user job in
+    esecuzione: gli altri suoi job restano in coda, senza occupare worker, finché
+    uno non termina, così un utente non può prendersi tutto il pool. Con store_path lo stato è salvato anche su SQLite: ogni
+    worker del server può leggerlo e richiedere l'annullamento di un job eseguito
+    da un altro processo, che lo raccoglie al controllo successivo.
+    """
+    
+    FINAL_STATES = ("succeeded", "failed", "cancelled")
+    
+    def __init__(self, run_fn, workers: int = 4, max_queue: int = 1000, retention: float = 3600,
+                 max_retained: int = 1000, store_path: Optional[str] = None, cancel_poll_interval: float = 1.0,
+                 max_running_per_user: int = 2):
+        # run_fn(request) -> MCPQueryResponse (coroutine)
+        self.run_fn = run_fn
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.retention = retention
+        self.max_retained = max(1, max_retained)
+        self.store_path = store_path
+        self.cancel_poll_interval = cancel_poll_interval
+        self.max_running_per_user = max_running_per_user
+        
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._requests: Dict[str, MCPQueryRequest] = {}
+        self._running: Dict[str, asyncio.Task] = {}
+        # Job terminati in ordine di completamento: {job_id: istante di fine (time.time())}
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # Job in esecuzione per utente e job rimandati perché l'utente era al limite
+        self._user_running: Dict[str, int] = defaultdict(int)
+        self._deferred: Dict[str, deque] = defaultdict(deque)
+        self._tasks: List[asyncio.Task] = []
+        self.accepting = True
+        self.stats = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "rejected": 0, "expired": 0}
+        
+        self._store = None
+        self._store_lock = threading.Lock()
+        if store_path:
+            self._store = sqlite3.connect(store_path, check_same_thread=False, timeout=5.0)
+            self._store.execute("PRAGMA journal_mode=WAL")
+            self._store.execute("PRAGMA synchronous=NORMAL")
+            self._store.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                "cancel_requested INTEGER NOT NULL DEFAULT 0, expires_at REAL)"
+            )
+            self._store.commit()
+    
+    @property
+    def pending(self) -> int:
+        """Job accodati o in esecuzione in questo worker"""
+        return len(self._requests)
+    
+    def _save(self, job: Dict[str, Any]):
+        if self._store is None:
+            return
+        expires_at = time.time() + self.retention if job["status"] in self.FINAL_STATES else None
+        with self._store_lock:
+            self._store.execute(
+                "INSERT INTO jobs (job_id, data, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (job["job_id"], json.dumps(job, default=str), expires_at)
+            )
+            self._store.commit()
+    
+    def _load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if self._store is None:
+            return None
+        with self._store_lock:
+            row = self._store.execute(
+                "SELECT data FROM jobs WHERE job_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (job_id, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _expire(self):
+        """Rimuove i job terminati oltre la retention o in eccesso rispetto a max_retained"""
+        cutoff = time.time() - self.retention
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if finished_at > cutoff and len(self._finished) <= self.max_retained:
+                break
+            self._finished.popitem(last=False)
+            self._jobs.pop(job_id, None)
+            self.stats["expired"] += 1
+        
+        if self._store is not None:
+            with self._store_lock:
+                self._store.execute("DELETE FROM jobs WHERE expires_at <= ?", (time.time(),))
+                self._store.execute(
+                    "DELETE FROM jobs WHERE expires_at IS NOT NULL AND job_id NOT IN "
+                    "(SELECT job_id FROM jobs WHERE expires_at IS NOT NULL ORDER BY expires_at DESC LIMIT ?)",
+                    (self.max_retained,)
+                )
+                self._store.commit()
+    
+    def _finish(self, job: Dict[str, Any], status: str, **fields):
+        job.update(status=status, finished_at=datetime.now().isoformat(), **fields)
+        self._requests.pop(job["job_id"], None)
+        self._finished[job["job_id"]] = time.time()
+        self.stats[status] += 1
+        JOBS.inc(status=status)
+        self._save(job)
+        self._expire()
+    
+    def submit(self, request: MCPQueryRequest) -> Dict[str, Any]:
+        """Accoda la query e restituisce subito il job; 503 con Retry-After se la coda è piena"""
+        self._expire()
+        if not self.accepting:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail="Server in arresto: nuovi job non accettati",
+                                headers={"Retry-After": "5"})
+        if self.pending >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail=f"Coda dei job piena ({self.max_queue} job in attesa)",
+                                headers={"Retry-After": "5"})
         
-        payload = {
-            "model": self.model,
-            "messages": formatted_messages,
-            "max_tokens": kwargs.get("max_tokens", self.max_tokens),
-            "temperature": kwargs.get("temperature", self.temperature)
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "execution_time": None,
+            "user_id": request.user_id or "default",
+            "worker_pid": os.getpid(),
+            "result": None,
+            "error": None,
+            "status_code": None
         }
+        self._jobs[job["job_id"]] = job
+        self._requests[job["job_id"]] = request
+        self.stats["submitted"] += 1
+        self._save(job)
+        self._queue.put_nowait(job["job_id"])
+        return dict(job)
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Stato del job, anche se eseguito da un altro worker quando lo stato è su SQLite"""
+        self._expire()
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else self._load(job_id)
+    
+    async def cancel(self, job_id: str, wait: float = 5.0) -> Optional[Dict[str, Any]]:
+        """Annulla un job in coda o in esecuzione; None se il job non esiste
         
-        if stop:
-            payload["stop"] = stop
+        Un job in esecuzione viene interrotto e si attende al massimo wait secondi
+        che passi a cancelled. Per un job di un altro worker l'annullamento viene
+        solo richiesto e lo stato restituito è quello attuale.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = self._load(job_id)
+            if job is not None and job["status"] not in self.FINAL_STATES:
+                with self._store_lock:
+                    self._store.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,))
+                    self._store.commit()
+                job["cancel_requested"] = True
+            return job
+        
+        if job["status"] == "queued":
+            self._finish(job, "cancelled", error="Job annullato prima dell'esecuzione")
+        elif job["status"] == "running":
+            task = self._running.get(job_id)
+            if task is not None:
+                task.cancel()
+                await asyncio.wait({task}, timeout=wait)
+        return dict(job)
+    
+    async def _execute(self, job: Dict[str, Any]):
+        request = self._requests[job["job_id"]]
+        job.update(status="running", started_at=datetime.now().isoformat())
+        self._save(job)
+        started = time.perf_counter()
         
+        status, fields = "failed", {}
         try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                json=payload,
-                headers=headers,
-                timeout=int(os.getenv('REQUEST_TIMEOUT', 30))
-            )
-            response.raise_for_status()
-            
-            data = response.json()
-            content = data["choices"][0]["message"]["content"]
-            
-            # Crea il risultato nel formato LangChain
-            message = AIMessage(content=content)
-            generation = ChatGeneration(message=message)
-            return ChatResult(generations=[generation])
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"OpenRouter API error: {e}")
-            raise Exception(f"OpenRouter API error: {str(e)}")
+            with tracer.span("mcp.job", **{"job.id": job["job_id"], "user.id": job["user_id"]}):
+                response = await self.run_fn(request)
+            status, fields = "succeeded", {"result": response.model_dump()}
+        except asyncio.CancelledError:
+            status, fields = "cancelled", {"error": "Job annullato durante l'esecuzione"}
+        except HTTPException as e:
+            fields = {"status_code": e.status_code, "error": e.detail}
+        except Exception as e:
+            logger.error(f"Errore nel job {job['job_id']}: {e}")
+            fields = {"status_code": 500, "error": str(e)}
+        finally:
+            fields["execution_time"] = round(time.perf_counter() - started, 3)
+            self._finish(job, status, **fields)
     
-    def bind_tools(self, tools, **kwargs):
-        """Implementa bind_tools per compatibilità MCP"""
-        return self
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            # Job annullato mentre era in coda o già rimosso
+            if job is None or job["status"] != "queued":
+                continue
+            if not self.accepting:
+                self._finish(job, "cancelled", error="Server in arresto prima dell'esecuzione")
+                continue
+            user_id = job["user_id"]
+            if self.max_running_per_user > 0 and self._user_running.get(user_id, 0) >= self.max_running_per_user:
+                # Rimesso in coda quando termina un job dello stesso utente
+                self._deferred[user_id].append(job_id)
+                continue
+            self._user_running[user_id] += 1
+            task = asyncio.create_task(self._execute(job))
+            self._running[job_id] = task
+            try:
+                # asyncio.wait non propaga l'annullamento del job al worker
+                await asyncio.wait({task})
+            finally:
+                self._running.pop(job_id, None)
+                self._user_running[user_id] -= 1
+                if self._user_running[user_id] <= 0:
+                    del self._user_running[user_id]
+                self._resume_deferred(user_id)
     
-    @property
-    def _identifying_params(self) -> dict:
-        """Parametri identificativi per il modello"""
+    def _resume_deferred(self, user_id: str):
+        """Rimette in coda il primo job rimandato dell'utente ancora da eseguire"""
+        deferred = self._deferred.get(user_id)
+        while deferred:
+            job_id = deferred.popleft()
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] == "queued":
+                self._queue.put_nowait(job_id)
+                break
+        if deferred is not None and not deferred:
+            del self._deferred[user_id]
+    
+    async def _watch_cancellations(self):
+        """Raccoglie le richieste di annullamento fatte da altri worker tramite SQLite"""
+        while True:
+            await asyncio.sleep(self.cancel_poll_interval)
+            if not self._requests:
+                continue
+            ids = list(self._requests)
+            with self._store_lock:
+                rows = self._store.execute(
+                    f"SELECT job_id FROM jobs WHERE cancel_requested = 1 AND job_id IN ({','.join('?' * len(ids))})",
+                    ids
+                ).fetchall()
+            for (job_id,) in rows:
+                logger.info(f"Annullamento del job {job_id} richiesto da un altro worker")
+                await self.cancel(job_id, wait=0)
+    
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            if self._store is not None:
+                self._tasks.append(asyncio.create_task(self._watch_cancellations()))
+            logger.info(f"Job asincroni attivi ({self.workers} worker, coda di {self.max_queue}, "
+                        f"retention {self.retention}s{', stato su ' + self.store_path if self.store_path else ''})")
+    
+    def stop_accepting(self):
+        """Primo passo dell'arresto: nessun nuovo job e i job ancora in coda vengono annullati"""
+        self.accepting = False
+        for job_id in list(self._requests):
+            job = self._jobs[job_id]
+            if job["status"] == "queued":
+                self._finish(job, "cancelled", error="Server in arresto prima dell'esecuzione")
+    
+    async def stop(self):
+        """Interrompe i job ancora in esecuzione (dopo il drain) e i worker"""
+        self.stop_accepting()
+        running = list(self._running.values())
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.wait(running)
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._store is not None:
+            with self._store_lock:
+                self._store.close()
+            self._store = None
+    
+    def get_stats(self) -> Dict[str, Any]:
         return {
-            "model": self.model,
-            "temperature": self.temperature,
-            "max_tokens": self.max_tokens,
-            "base_url": self.base_url
+            **self.stats,
+            "queued": sum(1 for job_id in self._requests if job_id not in self._running),
+            "running": len(self._running),
+            "deferred": sum(len(jobs) for jobs in self._deferred.values()),
+            "retained": len(self._finished),
+            "workers": self.workers,
+            "max_running_per_user": self.max_running_per_user,
+            "max_queue": self.max_queue,
+            "retention_seconds": self.retention,
+            "store": self.store_path
         }
 
-# Servizio MCP principale
+def create_job_manager(run_fn) -> JobManager:
+    """Crea il gestore dei job asincroni con i limiti letti dalle variabili d'ambiente"""
+    return JobManager(
+        run_fn,
+        workers=int(os.getenv('JOBS_WORKERS', 4)),
+        max_queue=int(os.getenv('JOBS_MAX_QUEUE', 1000)),
+        retention=float(os.getenv('JOBS_RETENTION_SECONDS', 3600)),
+        max_retained=int(os.getenv('JOBS_MAX_RETAINED', 1000)),
+        store_path=os.getenv('JOBS_STORE_PATH') or None,
+        cancel_poll_interval=float(os.getenv('JOBS_CANCEL_POLL_INTERVAL', 1)),
+        max_running_per_user=int(os.getenv('JOBS_MAX_RUNNING_PER_USER', os.getenv('ADMISSION_MAX_PER_USER', 2)))
+    )
+
+@dataclass
+class PreparedQuery:
+    """Testo della query pronto per l'agent con le informazioni sul contesto"""
+    text: str
+    system_prompt: Optional[str] = None
+    context_used: bool = False
+    context_messages_count: int = 0
+    context_tokens: int = 0
+    prompt_tokens: int = 0
+    summary_used: bool = False
 
 # Servizio MCP principale
 class MCPService:
@@ -254,16 +3899,66 @@ class MCPService:
         self.config_file = config_file
         self.config = self._load_config()
         self.start_time = datetime.now()
+        self.prompts = PromptRegistry(os.getenv('PROMPTS_DIR', 'prompts'))
+        self.response_cache = create_response_cache()
+        self.admission = create_admission_controller()
+        rate_limiter.configure(self.config, worker_count())
+        llm_resilience.configure(self.config)
+        self.router = ModelRouter(self.config, llm_resilience)
+        self.tool_limiter = ToolCallLimiter(self.config)
+        self.tool_cache = ToolResultCache(self.config, max_entries=int(os.getenv('TOOL_CACHE_MAX_ENTRIES', 512)))
         
         # Sistema di memoria per conversazioni per utente
-        # Struttura: {user_id: deque([{role, content, timestamp}], maxlen=limit)}
-        self.conversation_memory = defaultdict(lambda: deque(
-            maxlen=int(os.getenv('CONVERSATION_MEMORY_LIMIT', 30))
-        ))
         self.memory_limit = int(os.getenv('CONVERSATION_MEMORY_LIMIT', 30))
         self.default_user_id = os.getenv('DEFAULT_USER_ID', 'default')
+        self.memory_store = create_memory_store(self.memory_limit)
+        self.context_builder = ContextBuilder(self.config)
+        
+        # Riassunto incrementale delle conversazioni lunghe (opzionale)
+        self.summary_enabled = os.getenv('SUMMARY_ENABLED', 'false').lower() == 'true'
+        self.summarizer = ConversationSummarizer(
+            self.memory_store,
+            self._summarize_messages,
+            keep_recent=int(os.getenv('SUMMARY_KEEP_RECENT', 6)),
+            fold_batch=int(os.getenv('SUMMARY_FOLD_BATCH', 10))
+        )
+        
+        # Job asincroni per le query lunghe (POST /api/v1/jobs)
+        self.jobs = create_job_manager(self._run_job)
+        self._summary_llm = None
         
-        logger.info(f"Sistema memoria conversazioni inizializzato - Limite: {self.memory_limit} messaggi per utente")
+        logger.info(f"Sistema memoria conversazioni inizializzato - Backend: {self.memory_store.backend}, "
+                    f"Limite: {self.memory_limit} messaggi per utente")
+        
+        # Client MCP unico verso tutti i server, condiviso dagli agent del pool
+        self.mcp_clients = MCPClientManager(
+            self.config,
+            backoff_base=float(os.getenv('MCP_RECONNECT_BACKOFF_BASE', 1)),
+            backoff_max=float(os.getenv('MCP_RECONNECT_BACKOFF_MAX', 60))
+        )
+        self.mcp_clients.session_hooks.append(self.tool_limiter.wrap_connector)
+        self.mcp_clients.session_hooks.append(self.tool_cache.wrap_connector)
+        
+        # Pool di agent caldi riutilizzati tra le richieste
+        self.agent_pool = AgentPool(
+            client_factory=self._create_mcp_client,
+            agent_factory=self._create_agent,
+            max_size=int(os.getenv('AGENT_POOL_MAX_SIZE', 8)),
+            max_per_key=int(os.getenv('AGENT_POOL_MAX_PER_KEY', 4)),
+            idle_ttl=float(os.getenv('AGENT_POOL_IDLE_TTL', 600)),
+            shared_client=True
+        )
+        # Quando una sessione viene (ri)aperta i tool degli agent esistenti puntano alla vecchia
+        self.mcp_clients.change_hooks.append(
+            lambda server: self.agent_pool.invalidate(f"sessione MCP {server} riaperta")
+        )
+        
+        # Readiness: il worker riceve traffico solo dopo il warm-up dell'agent di default
+        self.ready = False
+        self.warmup_seconds: Optional[float] = None
+        # Durata delle fasi del warm-up: import differiti, sessioni MCP, agent di default
+        self.warmup_timings: Dict[str, float] = {}
+        self.tools_count: Optional[int] = None
         
     def _load_config(self) -> Dict[str, Any]:
         """Carica la configurazione dal file JSON"""
@@ -278,20 +3973,11 @@ class MCPService:
             return {}
     
     def _load_prompt_from_file(self, prompt_name: str) -> Optional[str]:
-        """Carica un prompt da file nella directory prompts/"""
-        prompt_file = f"prompts/{prompt_name}.txt"
-        try:
-            if os.path.exists(prompt_file):
-                with open(prompt_file, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    logger.info(f"Prompt caricato da file: {prompt_file}")
-                    return content
-            else:
-                logger.debug(f"File prompt non trovato: {prompt_file}")
-                return None
-        except Exception as e:
-            logger.error(f"Errore nel caricamento del prompt da {prompt_file}: {e}")
-            return None
+        """Restituisce un prompt della directory prompts/ dal registro in memoria"""
+        content = self.prompts.get(prompt_name)
+        if content is None:
+            logger.debug(f"Prompt non trovato nel registro: {prompt_name}")
+        return content
     
     def _add_message_to_memory(self, user_id: str, role: str, content: str):
         """Aggiunge un messaggio alla memoria dell'utente"""
@@ -304,76 +3990,143 @@ class MCPService:
             "timestamp": datetime.now().isoformat()
         }
         
-        # Aggiunge alla deque che automaticamente mantiene il limite
-        self.conversation_memory[user_id].append(message)
+        # L'archivio mantiene automaticamente il limite per utente
+        self.memory_store.append(user_id, message)
         
-        logger.debug(f"Messaggio aggiunto alla memoria per utente {user_id}. "
-                    f"Messaggi totali: {len(self.conversation_memory[user_id])}")
+        logger.debug(f"Messaggio aggiunto alla memoria per utente {user_id}")
     
     def _get_conversation_context(self, user_id: str) -> List[Dict[str, str]]:
         """Recupera il contesto delle conversazioni per un utente"""
         if not user_id:
             user_id = self.default_user_id
             
-        messages = list(self.conversation_memory.get(user_id, []))
+        messages = self.memory_store.get_messages(user_id)
         
         logger.debug(f"Recuperati {len(messages)} messaggi dal contesto per utente {user_id}")
         return messages
     
-    def _build_context_prompt(self, user_id: str, current_prompt: str) -> str:
-        """Costruisce un prompt includendo il contesto delle conversazioni precedenti"""
-        context_messages = self._get_conversation_context(user_id)
-        
-        if not context_messages:
-            logger.debug("Nessun contesto precedente trovato")
-            return current_prompt
-        
-        # Costruisce il contesto
-        context_parts = ["=== CONTESTO CONVERSAZIONE PRECEDENTE ==="]
-        
-        for msg in context_messages:
-            role_label = "UTENTE" if msg["role"] == "user" else "ASSISTENTE"
-            context_parts.append(f"{role_label}: {msg['content']}")
+    def clear_user_memory(self, user_id: str = None) -> int:
+        """Pulisce la memoria delle conversazioni per un utente specifico o tutti
         
-        context_parts.extend([
-            "=== FINE CONTESTO ===",
-            "",
-            f"DOMANDA CORRENTE: {current_prompt}"
-        ])
-        
-        context_prompt = "\n".join(context_parts)
-        
-        logger.debug(f"Contesto costruito con {len(context_messages)} messaggi precedenti")
-        return context_prompt
-    
-    def clear_user_memory(self, user_id: str = None):
-        """Pulisce la memoria delle conversazioni per un utente specifico o tutti"""
+        Returns:
+            Numero di utenti le cui conversazioni sono state pulite
+        """
+        users_cleared = self.memory_store.clear(user_id)
         if user_id:
-            if user_id in self.conversation_memory:
-                self.conversation_memory[user_id].clear()
+            if users_cleared:
                 logger.info(f"Memoria cancellata per utente: {user_id}")
             else:
                 logger.info(f"Nessuna memoria trovata per utente: {user_id}")
         else:
-            self.conversation_memory.clear()
             logger.info("Memoria di tutte le conversazioni cancellata")
+        return users_cleared
     
     def get_memory_stats(self) -> Dict[str, Any]:
         """Restituisce statistiche sulla memoria delle conversazioni"""
-        stats = {
+        users = self.memory_store.get_user_stats()
+        return {
             "memory_limit": self.memory_limit,
             "default_user_id": self.default_user_id,
-            "active_users": len(self.conversation_memory),
-            "users": {}
+            "backend": self.memory_store.backend,
+            "active_users": len(users),
+            "total_bytes": sum(user.get("bytes", 0) for user in users.values()),
+            "limits": self.memory_store.get_limits(),
+            "evictions": dict(self.memory_store.evictions),
+            "summaries": {"enabled": self.summary_enabled, **self.summarizer.get_stats()},
+            "users": users
         }
+    
+    async def warm_up(self, retry_max: float = 60):
+        """Riscalda l'agent di default (sessioni MCP, tool, client LLM) prima di segnalare il worker pronto
         
-        for user_id, messages in self.conversation_memory.items():
-            stats["users"][user_id] = {
-                "message_count": len(messages),
-                "last_message_time": messages[-1]["timestamp"] if messages else None
-            }
+        Importa prima, in un thread, mcp_use e i pacchetti dei soli provider abilitati.
+        In caso di errore ritenta con backoff esponenziale: finché non riesce /ready risponde 503.
+        """
+        started = time.perf_counter()
+        if MCP_AVAILABLE:
+            await asyncio.to_thread(lazy_imports.preload, lazy_imports.modules_for(self.config))
+            self.warmup_timings["imports"] = round(time.perf_counter() - started, 3)
+        delay = 1.0
+        while MCP_AVAILABLE:
+            try:
+                # Sessioni aperte prima dell'agent: una sessione aperta dopo invaliderebbe l'agent appena creato
+                phase = time.perf_counter()
+                await self.mcp_clients.connect_all()
+                self.warmup_timings["mcp_connect"] = round(time.perf_counter() - phase, 3)
+                phase = time.perf_counter()
+                if await self.initialize():
+                    self.warmup_timings["agent"] = round(time.perf_counter() - phase, 3)
+                    break
+            except Exception as e:
+                logger.warning(f"Warm-up dell'agent fallito: {e}")
+            logger.warning(f"Warm-up non riuscito, nuovo tentativo tra {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(retry_max, delay * 2)
+        self.warmup_seconds = time.perf_counter() - started
+        self.ready = True
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.warmup_timings.items()) or "nessuna fase"
+        logger.info(f"Worker {os.getpid()} pronto - import modulo: {IMPORT_SECONDS:.2f}s, "
+                    f"warm-up: {self.warmup_seconds:.2f}s ({phases}), "
+                    f"tool: {self.tools_count if self.tools_count is not None else 'n/d'}")
+    
+    def readiness(self) -> Dict[str, Any]:
+        """Stato per la readiness probe: starting durante il warm-up, draining durante l'arresto"""
+        if self.admission.draining:
+            status = "draining"
+        else:
+            status = "ready" if self.ready else "starting"
+        return {
+            "status": status,
+            "worker_pid": os.getpid(),
+            "workers": worker_count(),
+            "import_seconds": IMPORT_SECONDS,
+            "lazy_imports": dict(lazy_imports.timings),
+            "warmup_seconds": round(self.warmup_seconds, 3) if self.warmup_seconds is not None else None,
+            "warmup_timings": dict(self.warmup_timings),
+            "tools": self.tools_count,
+            "active": self.admission.active,
+            "queued": self.admission.queued
+        }
+    
+    async def run_memory_sweeper(self, interval: float):
+        """Applica periodicamente TTL e limiti globali alla memoria delle conversazioni"""
+        logger.info(f"Sweeper memoria conversazioni avviato (intervallo: {interval}s)")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # Lo sweep di SQLite fa I/O su disco: viene eseguito fuori dall'event loop
+                removed = await asyncio.to_thread(self.memory_store.sweep)
+                if removed:
+                    logger.info(f"Sweeper memoria: rimossi {removed} utenti")
+            except Exception as e:
+                logger.error(f"Errore nello sweeper della memoria: {e}")
+    
+    async def _summarize_messages(self, previous_summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+        """Aggiorna il riassunto della conversazione con i messaggi indicati
         
-        return stats
+        Usa SUMMARY_PROVIDER/SUMMARY_MODEL se configurati, altrimenti il modello di default.
+        """
+        if self._summary_llm is None:
+            defaults = self._default_llm_config(os.getenv('SUMMARY_PROVIDER'), os.getenv('SUMMARY_MODEL'))
+            self._summary_llm = self._create_llm(LLMConfig(
+                provider=defaults.provider,
+                model=defaults.model,
+                temperature=0.2,
+                max_tokens=int(os.getenv('SUMMARY_MAX_TOKENS', 400))
+            ))
+            if self._summary_llm is None:
+                raise RuntimeError(f"Impossibile creare il modello per i riassunti ({defaults.provider})")
+        
+        lines = [f"{'UTENTE' if m['role'] == 'user' else 'ASSISTENTE'}: {m['content']}" for m in messages]
+        prompt = (
+            "Aggiorna il riassunto di una conversazione tra un utente e un assistente. "
+            "Conserva fatti, decisioni, preferenze e richieste ancora aperte; "
+            f"rispondi solo con il riassunto, in al massimo {os.getenv('SUMMARY_MAX_WORDS', 150)} parole.\n\n"
+            f"RIASSUNTO ATTUALE: {previous_summary or '(nessuno)'}\n\n"
+            "NUOVI MESSAGGI:\n" + "\n".join(lines)
+        )
+        result = await self._summary_llm.ainvoke([HumanMessage(content=prompt)])
+        return str(result.content).strip()
     
     def get_available_providers(self) -> List[ProviderInfo]:
         """Restituisce la lista dei provider disponibili"""
@@ -400,122 +4153,324 @@ class MCPService:
         return providers
     
     def _create_mcp_client(self):
-        """Crea il client MCP appropriato basato sulla configurazione"""
-        try:
-            # Controlla se ci sono server con URL (per 1MCP Agent)
-            mcp_servers = self.config.get("mcpServers", {})
-            
-            # Cerca server con URL (connessioni HTTP/SSE)
-            for server_name, server_config in mcp_servers.items():
-                if server_config.get("disabled", False):
-                    continue
-                    
-                if "url" in server_config:
-                    url = server_config["url"]
-                    
-                    logger.info(f"Configurando client HTTP per server: {server_name} -> {url}")
-                    
-                    # Usa il formato corretto per mcp-use con HTTP/SSE
-                    config_dict = {
-                        "mcpServers": {
-                            server_name: {
-                                "url": url
-                            }
-                        }
-                    }
-                    
-                    # Aggiungi headers se presenti
-                    if "headers" in server_config:
-                        config_dict["mcpServers"][server_name]["headers"] = server_config["headers"]
-                    
-                    logger.info(f"Creando client MCP con configurazione: {config_dict}")
-                    return MCPClient.from_dict(config_dict)
-            
-            # Se non ci sono server con URL, usa il client tradizionale
-            if not os.path.exists(self.config_file):
-                logger.warning(f"File di configurazione MCP non trovato: {self.config_file}")
-                return MCPClient()
-            else:
-                logger.info("Usando client MCP tradizionale")
-                return MCPClient.from_config_file(self.config_file)
-                
-        except Exception as e:
-            logger.error(f"Errore nella creazione del client MCP: {e}")
-            return MCPClient()  # Fallback a client vuoto
+        """Restituisce il client MCP condiviso con tutti i server HTTP/SSE e stdio configurati"""
+        with tracer.span("mcp.create_client"):
+            return self.mcp_clients.get_client()
     
-    async def initialize(self, provider: str = None, model: str = None):
-        """Inizializza il servizio MCP con provider e modello specificati"""
-        if not MCP_AVAILABLE:
-            logger.error("MCP non disponibile. Installare con: pip install mcp-use langchain-openai langchain-google-genai")
-            return False
-            
-        try:
-            # Usa provider e modello dalla configurazione o dai parametri
-            provider = provider or self.config.get("default_provider", "gemini")
-            
-            if provider not in self.config.get("providers", {}):
-                logger.error(f"Provider {provider} non configurato")
-                return False
-                
-            provider_config = self.config["providers"][provider]
-            model = model or provider_config.get("model")
+    def _create_llm(self, config: LLMConfig):
+        """Crea il modello LLM per la configurazione specificata"""
+        provider, model = config.provider, config.model
+        if provider not in self.config.get("providers", {}):
+            logger.error(f"Provider {provider} non configurato")
+            return None
+        
+        provider_config = self.config["providers"][provider]
+        
+        # Configura il modello LLM in base al provider
+        logger.debug(f"Configurazione LLM per provider: {provider}")
+        
+        if provider == "openrouter":
+            api_key = os.getenv('OPENROUTER_API_KEY') or provider_config.get('api_key')
+            if not api_key:
+                logger.error("OPENROUTER_API_KEY richiesta per OpenRouter")
+                return None
             
-            # Inizializza il client MCP
-            self.client = self._create_mcp_client()
+            logger.debug(f"Creazione OpenRouterLLM con modello: {model}")
+            llm = OpenRouterLLM(
+                model=model,
+                api_key=api_key,
+                base_url=provider_config.get('base_url', 'https://openrouter.ai/api/v1'),
+                temperature=config.temperature,
+                max_tokens=config.max_tokens,
+                native_tools=provider_config.get('native_tools', True)
+            )
+            logger.debug(f"OpenRouterLLM creato. Modello configurato: {llm.model}")
+            return llm
             
-            # Configura il modello LLM in base al provider
-            logger.debug(f"Configurazione LLM per provider: {provider}")
+        elif provider == "gemini":
+            api_key = os.getenv('GOOGLE_API_KEY') or provider_config.get('api_key')
+            if not api_key:
+                logger.error("GOOGLE_API_KEY richiesta per Gemini")
+                return None
             
-            if provider == "openrouter":
-                api_key = os.getenv('OPENROUTER_API_KEY') or provider_config.get('api_key')
-                if not api_key:
-                    logger.error("OPENROUTER_API_KEY richiesta per OpenRouter")
-                    return False
-                
-                logger.debug(f"Creazione OpenRouterLLM con modello: {model}")
-                self.llm = OpenRouterLLM(
-                    model=model,
-                    api_key=api_key,
-                    base_url=provider_config.get('base_url', 'https://openrouter.ai/api/v1'),
-                    temperature=float(os.getenv('DEFAULT_TEMPERATURE', 0.7)),
-                    max_tokens=int(os.getenv('MAX_TOKENS', 4000))
-                )
-                logger.debug(f"OpenRouterLLM creato. Modello configurato: {self.llm.model}")
-                
-            elif provider == "gemini":
-                api_key = os.getenv('GOOGLE_API_KEY') or provider_config.get('api_key')
-                if not api_key:
-                    logger.error("GOOGLE_API_KEY richiesta per Gemini")
-                    return False
-                
-                logger.debug(f"Creazione ChatGoogleGenerativeAI con modello: {model}")
-                self.llm = ChatGoogleGenerativeAI(
-                    model=model,
-                    google_api_key=api_key,
-                    temperature=float(os.getenv('DEFAULT_TEMPERATURE', 0.7)),
-                    max_tokens=int(os.getenv('MAX_TOKENS', 4000))
-                )
-                logger.debug(f"ChatGoogleGenerativeAI creato. Modello configurato: {model}")
-            else:
-                logger.error(f"Provider {provider} non supportato")
-                return False
+            logger.debug(f"Creazione ChatGoogleGenerativeAI con modello: {model}")
+            ChatGoogleGenerativeAI = lazy_imports.load("langchain_google_genai", "ChatGoogleGenerativeAI")
+            llm = ChatGoogleGenerativeAI(
+                model=model,
+                google_api_key=api_key,
+                temperature=config.temperature,
+                max_tokens=config.max_tokens,
+                max_retries=llm_resilience.settings(provider, model)["max_retries"],
+                callbacks=[ResilienceCallbackHandler(llm_resilience, provider, model),
+                           RateLimitCallbackHandler(rate_limiter, provider, model)]
+            )
+            logger.debug(f"ChatGoogleGenerativeAI creato. Modello configurato: {model}")
+            return llm
+        
+        logger.error(f"Provider {provider} non supportato")
+        return None
+    
+    async def _create_agent(self, config: LLMConfig, client: Any) -> Optional[AgentPoolEntry]:
+        """Crea e riscalda un agent MCP per il pool (handshake e discovery dei tool inclusi)"""
+        try:
+            llm = self._create_llm(config)
+            if llm is None:
+                return None
             
-            # Inizializza l'agent MCP
+            # La memoria interna dell'agent è disabilitata: l'agent è riutilizzato tra utenti
+            # e il contesto delle conversazioni è gestito dal servizio
             logger.debug("Creazione MCPAgent con LLM configurato")
-            self.agent = MCPAgent(llm=self.llm, client=self.client)
-            self.initialized = True
+            MCPAgent = lazy_imports.load("mcp_use", "MCPAgent")
+            agent = MCPAgent(llm=llm, client=client, memory_enabled=False)
+            # Aggiunti ai callback di osservabilità già configurati (ad esempio Langfuse)
+            agent.callbacks = [*agent.callbacks, MetricsCallbackHandler(config.provider, config.model)]
+            if tracer.enabled:
+                agent.callbacks.append(TracingCallbackHandler(tracer, config.provider, config.model))
+            with tracer.span("mcp.agent.initialize", **{"llm.provider": config.provider, "llm.model": config.model}):
+                await agent.initialize()
+            # La cache avvolge il limitatore: i risultati in cache non occupano posti di concorrenza
+            self.tool_limiter.wrap_client(client)
+            self.tool_cache.wrap_client(client)
             
-            logger.info(f"MCP Service inizializzato con provider: {provider}, model: {model}")
-            logger.debug(f"Tipo LLM finale: {type(self.llm).__name__}")
-            return True
+            logger.info(f"Agent MCP pronto per provider: {config.provider}, model: {config.model}")
+            logger.debug(f"Tipo LLM finale: {type(llm).__name__}")
+            return AgentPoolEntry(config, llm, agent)
             
         except Exception as e:
             logger.error(f"Errore durante l'inizializzazione: {e}")
             logger.error(traceback.format_exc())
+            return None
+    
+    def _default_llm_config(self, provider: str = None, model: str = None) -> LLMConfig:
+        """Configurazione LLM con i parametri di generazione di default"""
+        provider = provider or self.config.get("default_provider", "gemini")
+        model = model or self.config.get("providers", {}).get(provider, {}).get("model")
+        return LLMConfig(
+            provider=provider,
+            model=model,
+            temperature=float(os.getenv('DEFAULT_TEMPERATURE', 0.7)),
+            max_tokens=int(os.getenv('MAX_TOKENS', 4000))
+        )
+    
+    async def initialize(self, provider: str = None, model: str = None):
+        """Inizializza il servizio MCP con provider e modello specificati
+        
+        Riscalda un agent nel pool con i parametri di default. I riferimenti
+        client/llm/agent esposti dal servizio sono solo informativi: le query
+        usano sempre un agent preso in leasing dal pool.
+        """
+        if not MCP_AVAILABLE:
+            logger.error("MCP non disponibile. Installare con: pip install mcp-use langchain-openai langchain-google-genai")
             return False
+        
+        config = self._default_llm_config(provider, model)
+        
+        with tracer.span("mcp.initialize", **{"llm.provider": config.provider, "llm.model": config.model}):
+            async with self.agent_pool.lease(config) as entry:
+                if entry is None:
+                    return False
+                self.client = entry.client
+                self.llm = entry.llm
+                self.agent = entry.agent
+                self.tools_count = len(getattr(entry.agent, "_tools", None) or [])
+        self.initialized = True
+        
+        logger.info(f"MCP Service inizializzato con provider: {config.provider}, model: {config.model}")
+        return True
+    
+    def _resolve_target(self, request: MCPQueryRequest) -> Tuple[str, str]:
+        """Determina provider e modello che verranno utilizzati per la richiesta (primo candidato del router)"""
+        return self.router.route(request.provider, request.model)[0]
+    
+    def _resolve_llm_config(self, request: MCPQueryRequest, target: Optional[Tuple[str, str]] = None) -> LLMConfig:
+        """Costruisce la configurazione LLM immutabile della richiesta"""
+        target_provider, target_model = target or self._resolve_target(request)
+        defaults = self._default_llm_config(target_provider, target_model)
+        return LLMConfig(
+            provider=target_provider,
+            model=target_model,
+            temperature=request.temperature if request.temperature is not None else defaults.temperature,
+            max_tokens=request.max_tokens if request.max_tokens is not None else defaults.max_tokens
+        )
+    
+    async def _acquire_agent(self, request: MCPQueryRequest, target: Optional[Tuple[str, str]] = None) -> AgentPoolEntry:
+        """Ottiene dal pool l'agent per provider e modello della richiesta (o per target, se indicato)
+        
+        L'agent va restituito con agent_pool.release al termine dell'esecuzione.
+        """
+        if not MCP_AVAILABLE:
+            logger.error("MCP non disponibile. Installare con: pip install mcp-use langchain-openai langchain-google-genai")
+            raise HTTPException(status_code=500, detail="Impossibile inizializzare il servizio MCP")
+        
+        config = self._resolve_llm_config(request, target)
+        
+        logger.debug(f"Provider target: {config.provider}")
+        logger.debug(f"Modello target: {config.model}")
+        
+        entry = await self.agent_pool.acquire(config)
+        if entry is None:
+            logger.error("Fallita l'inizializzazione del servizio MCP")
+            raise HTTPException(status_code=500, detail="Impossibile inizializzare il servizio MCP")
+        
+        logger.debug(f"Agent dal pool: {config} (utilizzi: {entry.uses})")
+        return entry
+    
+    def _prepare_query_text(self, request: MCPQueryRequest, user_id: str) -> PreparedQuery:
+        """Prepara il testo della query con prompt di sistema e contesto conversazione"""
+        started = time.perf_counter()
+        # Prepara il prompt di sistema
+        system_prompt = request.system_prompt
+        
+        # Se è specificato un file di prompt, caricalo
+        if request.prompt_file:
+            file_prompt = self._load_prompt_from_file(request.prompt_file)
+            if file_prompt:
+                system_prompt = file_prompt
+                logger.debug(f"Utilizzando prompt da file: {request.prompt_file}.txt")
+            else:
+                logger.warning(f"File prompt {request.prompt_file}.txt non trovato, uso prompt di default")
+        
+        # Se non c'è un prompt di sistema specificato, prova a caricare il prompt di default
+        elif not system_prompt:
+            default_prompt = self._load_prompt_from_file("default")
+            if default_prompt:
+                system_prompt = default_prompt
+                logger.debug("Utilizzando prompt di default da file")
+        
+        # Gestione del contesto delle conversazioni
+        prepared = PreparedQuery(text=request.prompt, system_prompt=system_prompt)
+        
+        if request.use_context:
+            # Costruisce il prompt con i messaggi precedenti che rientrano nel budget del modello
+            context_messages = self._get_conversation_context(user_id)
+            summary = self.memory_store.get_summary(user_id) if self.summary_enabled else None
+            if summary:
+                # I turni già riassunti sono rappresentati dal riassunto
+                context_messages = ConversationSummarizer.unsummarized(context_messages, summary)
+            if context_messages or summary:
+                provider, model = self._resolve_target(request)
+                budget = self.context_builder.budget_for(provider, model)
+                context = self.context_builder.build(
+                    context_messages, request.prompt, budget,
+                    summary=summary["text"] if summary else None
+                )
+                if context.messages_used or context.summary_used:
+                    prepared.text = context.prompt
+                    prepared.context_used = True
+                    prepared.context_messages_count = context.messages_used
+                    prepared.context_tokens = context.tokens
+                    prepared.summary_used = context.summary_used
+                    logger.info(f"Utilizzando contesto conversazione con {context.messages_used}/{len(context_messages)} "
+                                f"messaggi precedenti ({context.tokens}/{budget} token) per utente {user_id}")
+        
+        # Aggiungi il system prompt se specificato
+        if system_prompt:
+            prepared.text = f"System: {system_prompt}\n\nUser: {prepared.text}"
+            logger.debug("System prompt aggiunto alla query")
+        
+        prepared.prompt_tokens = self.context_builder.estimate_tokens(prepared.text)
+        logger.debug(f"Query finale preparata (lunghezza: {len(prepared.text)} caratteri, ~{prepared.prompt_tokens} token)")
+        CONTEXT_BUILD_LATENCY.observe(time.perf_counter() - started)
+        return prepared
     
     async def query(self, request: MCPQueryRequest) -> MCPQueryResponse:
         """Esegue una query usando MCP"""
+        started = time.perf_counter()
+        status = "error"
+        # I passi reali vengono contati dai callback dell'agent tramite il contesto della richiesta
+        token = request_counters.set({"steps": 0})
+        try:
+            with tracer.span("mcp.query", **{"user.id": request.user_id or self.default_user_id}) as span:
+                response = await self._execute_query(request)
+                if span is not None:
+                    span.attributes.update({"llm.provider": response.provider, "llm.model": response.model,
+                                            "agent.steps": response.steps, "cache.hit": response.cached})
+            status = "cached" if response.cached else "ok"
+            return response
+        finally:
+            request_counters.reset(token)
+            REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint="query", status=status)
+    
+    async def _run_job(self, request: MCPQueryRequest) -> MCPQueryResponse:
+        """Esegue la query di un job: il limite per utente lo applica il JobManager prima di avviarlo"""
+        async with self.admission.admit(request.user_id or self.default_user_id, request.priority, user_limit=False):
+            return await self.query(request)
+    
+    async def query_batch(self, requests: List[MCPQueryRequest], concurrency: int) -> AsyncIterator[Dict[str, Any]]:
+        """Esegue query indipendenti con al massimo concurrency in parallelo, restituendo i risultati man mano che terminano
+        
+        Ogni query passa dal controllo di ammissione senza i limiti per utente (vale il
+        limite del batch) e un errore su una query non interrompe le altre. L'ultimo
+        evento riassume esiti e tempi del batch.
+        """
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        
+        async def run(index: int, request: MCPQueryRequest) -> Dict[str, Any]:
+            async with semaphore:
+                item_started = time.perf_counter()
+                event: Dict[str, Any] = {"type": "result", "index": index}
+                try:
+                    async with self.admission.admit(request.user_id or self.default_user_id, request.priority,
+                                                    user_limit=False):
+                        response = await self.query(request)
+                    event.update(status="ok", result=response.model_dump())
+                except HTTPException as e:
+                    event.update(status="error", status_code=e.status_code, error=e.detail)
+                except Exception as e:
+                    logger.error(f"Errore nella query {index} del batch: {e}")
+                    event.update(status="error", status_code=500, error=str(e))
+                event["seconds"] = round(time.perf_counter() - item_started, 3)
+                return event
+        
+        # Lo span del batch è il padre delle query (i task copiano il contesto alla creazione);
+        # non resta corrente tra uno yield e l'altro del generatore
+        span = tracer.start_span("mcp.batch", **{"batch.items": len(requests), "batch.concurrency": concurrency})
+        token = current_span.set(span) if span is not None else None
+        try:
+            tasks = [asyncio.create_task(run(index, request)) for index, request in enumerate(requests)]
+        finally:
+            if token is not None:
+                current_span.reset(token)
+        
+        durations, failed, cached = [], 0, 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                event = await next_done
+                durations.append(event["seconds"])
+                if event["status"] != "ok":
+                    failed += 1
+                elif event["result"].get("cached"):
+                    cached += 1
+                yield event
+        finally:
+            # Client disconnesso: le query non ancora terminate vengono annullate
+            for task in tasks:
+                task.cancel()
+            tracer.end_span(span)
+        
+        wall = time.perf_counter() - started
+        REQUEST_LATENCY.observe(wall, endpoint="batch", status="ok" if not failed else "partial")
+        durations.sort()
+        yield {
+            "type": "summary",
+            "total": len(requests),
+            "succeeded": len(requests) - failed,
+            "failed": failed,
+            "cached": cached,
+            "concurrency": concurrency,
+            "wall_seconds": round(wall, 3),
+            "items_seconds_total": round(sum(durations), 3),
+            "item_seconds": {
+                "avg": round(sum(durations) / len(durations), 3) if durations else 0.0,
+                "p50": durations[len(durations) // 2] if durations else 0.0,
+                "p95": durations[max(0, math.ceil(len(durations) * 0.95) - 1)] if durations else 0.0,
+                "max": durations[-1] if durations else 0.0
+            },
+            "throughput_per_second": round(len(requests) / wall, 2) if wall > 0 else 0.0
+        }
+    
+    async def _execute_query(self, request: MCPQueryRequest) -> MCPQueryResponse:
         start_time = datetime.now()
         
         # Determina user_id (usa default se non specificato)
@@ -534,92 +4489,62 @@ class MCPService:
         logger.debug(f"Use context: {request.use_context}")
         logger.debug(f"System prompt: {request.system_prompt[:100] + '...' if request.system_prompt and len(request.system_prompt) > 100 else request.system_prompt}")
         
-        # Determina provider e modello che verranno utilizzati
-        target_provider = request.provider or self.config.get("default_provider", "unknown")
-        target_model = request.model or self.config.get("providers", {}).get(target_provider, {}).get("model", "unknown")
-        
-        logger.debug(f"Provider target: {target_provider}")
-        logger.debug(f"Modello target: {target_model}")
-        logger.debug(f"Servizio già inizializzato: {self.initialized}")
-        
-        # Reinizializza se necessario con il provider richiesto
-        if not self.initialized or request.provider:
-            logger.debug(f"Reinizializzazione richiesta per provider: {target_provider}, modello: {target_model}")
-            success = await self.initialize(request.provider, request.model)
-            if not success:
-                logger.error("Fallita l'inizializzazione del servizio MCP")
-                raise HTTPException(status_code=500, detail="Impossibile inizializzare il servizio MCP")
-        
-        # Log del modello LLM attualmente configurato
-        if hasattr(self.llm, 'model'):
-            logger.debug(f"Modello LLM configurato: {self.llm.model}")
-        elif hasattr(self.llm, 'model_name'):
-            logger.debug(f"Modello LLM configurato: {self.llm.model_name}")
-        else:
-            logger.debug(f"Tipo LLM configurato: {type(self.llm).__name__}")
+        with tracer.span("context.build"):
+            prepared = self._prepare_query_text(request, user_id)
+        candidates = self.router.route(request.provider, request.model)
+        used_provider, used_model = candidates[0]
+        max_steps = request.max_steps or self.config.get("max_steps", 3)
+        
+        # Le query senza contesto possono essere servite dalla cache delle risposte
+        cache_key = None
+        if self.response_cache and not request.use_context and request.use_cache:
+            # Con il routing la risposta vale per tutta la lista di candidati, non per il modello scelto ora
+            key_provider, key_model = (used_provider, used_model) if len(candidates) == 1 else ("routing", "auto")
+            # Risposte generate con budget o temperatura diversi non sono intercambiabili
+            llm_config = self._resolve_llm_config(request, candidates[0])
+            cache_key = ResponseCache.make_key(key_provider, key_model, prepared.system_prompt, request.prompt,
+                                               llm_config.temperature, llm_config.max_tokens, max_steps)
+            cached = await self.response_cache.get(cache_key)
+            CACHE_LOOKUPS.inc(cache="response", result="miss" if cached is None else "hit")
+            if cached is not None:
+                logger.debug(f"Risposta servita dalla cache (chiave: {cache_key[:12]})")
+                self._add_message_to_memory(user_id, "user", request.prompt)
+                self._add_message_to_memory(user_id, "assistant", cached["response"])
+                return MCPQueryResponse(
+                    response=cached["response"],
+                    provider=cached.get("provider", used_provider),
+                    model=cached.get("model", used_model),
+                    steps=cached["steps"],
+                    timestamp=datetime.now().isoformat(),
+                    execution_time=(datetime.now() - start_time).total_seconds(),
+                    conversation_id=user_id,
+                    context_used=False,
+                    context_messages_count=0,
+                    prompt_tokens=prepared.prompt_tokens,
+                    cached=True
+                )
         
         try:
-            # Prepara il prompt di sistema
-            system_prompt = request.system_prompt
-            
-            # Se è specificato un file di prompt, caricalo
-            if request.prompt_file:
-                file_prompt = self._load_prompt_from_file(request.prompt_file)
-                if file_prompt:
-                    system_prompt = file_prompt
-                    logger.info(f"Utilizzando prompt da file: {request.prompt_file}.txt")
-                else:
-                    logger.warning(f"File prompt {request.prompt_file}.txt non trovato, uso prompt di default")
-            
-            # Se non c'è un prompt di sistema specificato, prova a caricare il prompt di default
-            elif not system_prompt:
-                default_prompt = self._load_prompt_from_file("default")
-                if default_prompt:
-                    system_prompt = default_prompt
-                    logger.info("Utilizzando prompt di default da file")
-            
-            # Gestione del contesto delle conversazioni
-            context_used = False
-            context_messages_count = 0
-            query_text = request.prompt
-            
-            if request.use_context:
-                # Costruisce il prompt con il contesto delle conversazioni precedenti
-                context_messages = self._get_conversation_context(user_id)
-                if context_messages:
-                    query_text = self._build_context_prompt(user_id, request.prompt)
-                    context_used = True
-                    context_messages_count = len(context_messages)
-                    logger.info(f"Utilizzando contesto conversazione con {context_messages_count} messaggi precedenti per utente {user_id}")
-            
-            # Aggiungi il system prompt se specificato
-            if system_prompt:
-                query_text = f"System: {system_prompt}\n\nUser: {query_text}"
-                logger.debug("System prompt aggiunto alla query")
-            
-            logger.debug(f"Query finale preparata (lunghezza: {len(query_text)} caratteri)")
-            
             # Salva la domanda dell'utente nella memoria
             self._add_message_to_memory(user_id, "user", request.prompt)
             
             # Esegue la query
             logger.debug("Invio query al modello AI...")
-            result = await self.agent.run(
-                query=query_text,
-                max_steps=request.max_steps or self.config.get("max_steps", 3)
-            )
+            result, used_provider, used_model = await self._run_with_failover(request, candidates, prepared.text, max_steps)
+            steps = (request_counters.get() or {}).get("steps", 0)
             
             # Salva la risposta dell'assistente nella memoria
             self._add_message_to_memory(user_id, "assistant", result)
+            if self.summary_enabled:
+                self.summarizer.schedule(user_id)
+            if cache_key:
+                await self.response_cache.put(cache_key, {"response": result, "steps": steps,
+                                                          "provider": used_provider, "model": used_model})
             
             execution_time = (datetime.now() - start_time).total_seconds()
             logger.debug(f"Query completata in {execution_time:.2f} secondi")
             logger.debug(f"Risposta ricevuta (lunghezza: {len(result)} caratteri)")
             
-            # Determina provider e modello utilizzati
-            used_provider = request.provider or self.config.get("default_provider", "unknown")
-            used_model = request.model or self.config.get("providers", {}).get(used_provider, {}).get("model", "unknown")
-            
             logger.debug(f"Provider utilizzato: {used_provider}")
             logger.debug(f"Modello utilizzato: {used_model}")
             logger.debug("=== FINE RICHIESTA MCP ===")
@@ -628,29 +4553,324 @@ class MCPService:
                 response=result,
                 provider=used_provider,
                 model=used_model,
-                steps=request.max_steps or self.config.get("max_steps", 3),
+                steps=steps,
                 timestamp=datetime.now().isoformat(),
                 execution_time=execution_time,
                 conversation_id=user_id,
-                context_used=context_used,
-                context_messages_count=context_messages_count
+                context_used=prepared.context_used,
+                context_messages_count=prepared.context_messages_count,
+                context_tokens=prepared.context_tokens,
+                prompt_tokens=prepared.prompt_tokens,
+                summary_used=prepared.summary_used
             )
             
+        except CircuitOpenError as e:
+            ERRORS.inc(stage="query")
+            logger.warning(f"Query rifiutata: {e}")
+            raise HTTPException(status_code=503, detail=str(e),
+                                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
         except Exception as e:
+            ERRORS.inc(stage="query")
             logger.error(f"Errore durante l'esecuzione della query: {e}")
             logger.error(f"Request ID: {id(request)}")
             logger.error(traceback.format_exc())
             logger.debug("=== FINE RICHIESTA MCP (CON ERRORE) ===")
             raise HTTPException(status_code=500, detail=f"Errore durante l'esecuzione: {str(e)}")
+    
+    async def _run_with_failover(self, request: MCPQueryRequest, candidates: List[Tuple[str, str]],
+                                 text: str, steps: int) -> Tuple[str, str, str]:
+        """Esegue la query sul primo candidato, passando al successivo se il provider fallisce
+        
+        Restituisce risposta, provider e modello effettivamente usati.
+        """
+        for attempt, (provider, model) in enumerate(candidates):
+            last = attempt == len(candidates) - 1
+            try:
+                entry = await self._acquire_agent(request, (provider, model))
+            except HTTPException:
+                if last:
+                    raise
+                logger.warning(f"Agent per {provider}/{model} non disponibile, passo al candidato successivo")
+                continue
+            
+            self.router.record_choice(provider, model, failover=attempt > 0)
+            # Contano solo i passi del tentativo che produce la risposta
+            counters = request_counters.get()
+            if counters is not None:
+                counters["steps"] = 0
+            try:
+                with tracer.span("agent.run", **{"llm.provider": provider, "llm.model": model,
+                                                 "routing.attempt": attempt + 1}):
+                    result = await entry.agent.run(query=text, max_steps=steps)
+                return result, provider, model
+            except Exception as e:
+                if last or not self.router.should_fail_over(e):
+                    raise
+                logger.warning(f"{provider}/{model} ha fallito ({e!r}), passo al candidato successivo")
+            finally:
+                await self.agent_pool.release(entry)
+    
+    @staticmethod
+    def _chunk_text(chunk: Any) -> str:
+        """Estrae il testo da un chunk di streaming LangChain"""
+        content = getattr(chunk, "content", chunk) if chunk is not None else ""
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list):
+            return "".join(
+                block.get("text", "") if isinstance(block, dict) else str(block)
+                for block in content
+            )
+        return ""
+    
+    async def acquire_first_agent(self, request: MCPQueryRequest,
+                                  candidates: List[Tuple[str, str]]) -> AgentPoolEntry:
+        """Agent del primo candidato del router disponibile (da rilasciare con agent_pool.release)"""
+        for attempt, (provider, model) in enumerate(candidates):
+            try:
+                return await self._acquire_agent(request, (provider, model))
+            except HTTPException:
+                if attempt == len(candidates) - 1:
+                    raise
+                logger.warning(f"Agent per {provider}/{model} non disponibile, passo al candidato successivo")
+    
+    async def query_stream(self, request: MCPQueryRequest, entry: AgentPoolEntry,
+                           candidates: Optional[List[Tuple[str, str]]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Esegue una query usando MCP emettendo eventi man mano che l'agent procede
+        
+        Eventi emessi (campo "type"): start, failover, token, tool_call, tool_result,
+        final, error. L'agent va ottenuto prima con acquire_first_agent, così
+        eventuali errori di inizializzazione possono ancora essere restituiti come
+        risposta HTTP; viene rilasciato al termine dello stream. Come per
+        /api/v1/query, se il provider fallisce la query passa al candidato
+        successivo di candidates (evento failover), ma solo finché non è stato
+        emesso nessun token o passo: l'output già inviato non può essere ritirato.
+        """
+        candidates = candidates or [(entry.config.provider, entry.config.model)]
+        current = (entry.config.provider, entry.config.model)
+        attempt = candidates.index(current) if current in candidates else 0
+        start_time = datetime.now()
+        user_id = request.user_id or self.default_user_id
+
+        try:
+            with tracer.span("context.build"):
+                prepared = self._prepare_query_text(request, user_id)
+            self._add_message_to_memory(user_id, "user", request.prompt)
+
+            yield {
+                "type": "start",
+                "provider": current[0],
+                "model": current[1],
+                "conversation_id": user_id,
+                "context_used": prepared.context_used,
+                "context_messages_count": prepared.context_messages_count,
+                "context_tokens": prepared.context_tokens,
+                "prompt_tokens": prepared.prompt_tokens,
+                "summary_used": prepared.summary_used
+            }
+        except BaseException:
+            # Anche se lo stream viene chiuso subito dopo l'evento start l'agent va restituito
+            await self.agent_pool.release(entry)
+            raise
+
+        answer_chunks: List[str] = []
+        steps = 0
+        try:
+            while True:
+                used_provider, used_model = entry.config.provider, entry.config.model
+                self.router.record_choice(used_provider, used_model, failover=attempt > 0)
+                emitted = False
+                try:
+                    async for event in self._run_stream(request, entry, prepared.text, answer_chunks):
+                        if event["type"] == "tool_call":
+                            steps = event["step"]
+                        emitted = True
+                        yield event
+                    break
+                except Exception as e:
+                    fallbacks = candidates[attempt + 1:]
+                    if emitted or not fallbacks or not self.router.should_fail_over(e):
+                        logger.error(f"Errore durante lo streaming della query: {e!r}")
+                        logger.error(traceback.format_exc())
+                        ERRORS.inc(stage="query")
+                        REQUEST_LATENCY.observe((datetime.now() - start_time).total_seconds(),
+                                                endpoint="stream", status="error")
+                        yield {"type": "error", "detail": f"Errore durante l'esecuzione: {str(e) or repr(e)}"}
+                        return
+                    
+                    logger.warning(f"{used_provider}/{used_model} ha fallito ({e!r}), passo al candidato successivo")
+                    await self.agent_pool.release(entry)
+                    entry = None
+                    try:
+                        entry = await self.acquire_first_agent(request, fallbacks)
+                    except HTTPException as acquire_error:
+                        yield {"type": "error", "detail": acquire_error.detail}
+                        return
+                    attempt = candidates.index((entry.config.provider, entry.config.model))
+                    yield {"type": "failover", "failed": f"{used_provider}/{used_model}",
+                           "provider": entry.config.provider, "model": entry.config.model}
+        finally:
+            if entry is not None:
+                await self.agent_pool.release(entry)
+        
+        result = "".join(answer_chunks) or "No output generated"
+        self._add_message_to_memory(user_id, "assistant", result)
+        if self.summary_enabled:
+            self.summarizer.schedule(user_id)
+        
+        execution_time = (datetime.now() - start_time).total_seconds()
+        REQUEST_LATENCY.observe(execution_time, endpoint="stream", status="ok")
+        logger.debug(f"Query in streaming completata in {execution_time:.2f} secondi")
+        
+        final = MCPQueryResponse(
+            response=result,
+            provider=used_provider,
+            model=used_model,
+            steps=steps,
+            timestamp=datetime.now().isoformat(),
+            execution_time=execution_time,
+            conversation_id=user_id,
+            context_used=prepared.context_used,
+            context_messages_count=prepared.context_messages_count,
+            context_tokens=prepared.context_tokens,
+            prompt_tokens=prepared.prompt_tokens,
+            summary_used=prepared.summary_used
+        )
+        yield {"type": "final", **final.model_dump()}
+    
+    async def _run_stream(self, request: MCPQueryRequest, entry: AgentPoolEntry, query_text: str,
+                          answer_chunks: List[str]) -> AsyncIterator[Dict[str, Any]]:
+        """Eventi dell'agent su un singolo candidato; gli errori vengono propagati a query_stream
+        
+        In answer_chunks restano solo i token dell'ultima chiamata LLM: è quella
+        che produce la risposta finale.
+        """
+        steps = 0
+        async for event in entry.agent.stream_events(
+            query=query_text,
+            max_steps=request.max_steps or self.config.get("max_steps", 3)
+        ):
+            kind = event.get("event")
+            data = event.get("data") or {}
+            
+            if kind == "on_chat_model_start":
+                answer_chunks.clear()
+            elif kind == "on_chat_model_stream":
+                token = self._chunk_text(data.get("chunk"))
+                if token:
+                    answer_chunks.append(token)
+                    yield {"type": "token", "content": token}
+            elif kind == "on_chat_model_end" and not answer_chunks:
+                # Il modello non ha fornito token incrementali: emette la risposta intera
+                text = self._chunk_text(data.get("output"))
+                if text:
+                    answer_chunks.append(text)
+                    yield {"type": "token", "content": text}
+            elif kind == "on_tool_start":
+                steps += 1
+                yield {"type": "tool_call", "step": steps, "tool": event.get("name"), "input": data.get("input")}
+            elif kind == "on_tool_end":
+                yield {"type": "tool_result", "step": steps, "tool": event.get("name"), "output": self._chunk_text(data.get("output")) or str(data.get("output"))}
+
+# Servizio MCP, creato al primo uso nel processo che serve le richieste: con più worker
+# il processo principale si limita a supervisionarli e non lo istanzia
+mcp_service: Optional[MCPService] = None
+
+def get_service() -> MCPService:
+    """Restituisce il servizio MCP del processo, creandolo se necessario"""
+    global mcp_service
+    if mcp_service is None:
+        mcp_service = MCPService(os.getenv('MCP_CONFIG_FILE', 'mcp_config.json'))
+    return mcp_service
+
+def _collect_admission_metrics():
+    if mcp_service is None:
+        return
+    ADMISSION_ACTIVE.set(mcp_service.admission.active)
+    ADMISSION_QUEUE_DEPTH.set(mcp_service.admission.queued)
 
-# Inizializza il servizio MCP
-mcp_service = MCPService()
+metrics.collectors.append(_collect_admission_metrics)
+
+# Gestione del ciclo di vita dell'applicazione
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    service = get_service()
+    
+    sweeper = None
+    sweep_interval = float(os.getenv('MEMORY_SWEEP_INTERVAL', 60))
+    if sweep_interval > 0:
+        sweeper = asyncio.create_task(service.run_memory_sweeper(sweep_interval))
+    
+    prompt_watcher = None
+    prompt_reload_interval = float(os.getenv('PROMPT_RELOAD_INTERVAL', 5))
+    if prompt_reload_interval > 0:
+        prompt_watcher = asyncio.create_task(service.prompts.run_watcher(prompt_reload_interval))
+    if service.summary_enabled:
+        service.summarizer.start()
+    service.jobs.start()
+    
+    cache_sweeper = None
+    if service.response_cache and service.response_cache.disk_path:
+        cache_sweeper = asyncio.create_task(
+            service.response_cache.run_sweeper(float(os.getenv('RESPONSE_CACHE_SWEEP_INTERVAL', 60)))
+        )
+    
+    # Collega i server MCP in background e ne controlla lo stato
+    mcp_monitor = None
+    if MCP_AVAILABLE and service.mcp_clients.servers:
+        mcp_monitor = asyncio.create_task(
+            service.mcp_clients.run_monitor(float(os.getenv('MCP_HEALTH_INTERVAL', 15)))
+        )
+    
+    # Warm-up dell'agent di default: fino al termine /ready risponde 503
+    warmup = None
+    if os.getenv('MCP_WARMUP', 'true').lower() == 'true':
+        warmup = asyncio.create_task(service.warm_up())
+    else:
+        service.ready = True
+    
+    metrics_sync = None
+    if metrics.shared_dir:
+        metrics_sync = asyncio.create_task(metrics.run_sync(float(os.getenv('METRICS_SYNC_INTERVAL', 5))))
+    
+    yield
+    
+    # Drain: nuove query rifiutate con 503, attesa di quelle in corso prima di chiudere pool e sessioni.
+    # I job in coda vengono annullati, quelli in esecuzione rientrano nel drain come le altre query
+    service.jobs.stop_accepting()
+    drained = await service.admission.drain(float(os.getenv('MCP_SERVER_DRAIN_TIMEOUT', 30)))
+    logger.info(f"Worker {os.getpid()} in arresto ({'drain completato' if drained else 'drain interrotto'})")
+    if warmup:
+        warmup.cancel()
+    if metrics_sync:
+        metrics_sync.cancel()
+        metrics.write_snapshot()
+    if sweeper:
+        sweeper.cancel()
+    if cache_sweeper:
+        cache_sweeper.cancel()
+    if prompt_watcher:
+        prompt_watcher.cancel()
+    if mcp_monitor:
+        mcp_monitor.cancel()
+    await service.summarizer.stop()
+    await service.jobs.stop()
+    # Chiude gli agent del pool, le sessioni MCP e le connessioni persistenti verso i provider
+    await service.agent_pool.close()
+    await service.mcp_clients.close()
+    if tracer.exporter is not None:
+        await tracer.exporter.close()
+    await http_pool.close()
+    service.memory_store.close()
+    if service.response_cache:
+        service.response_cache.close()
 
 # Crea l'app FastAPI
 app = FastAPI(
     title="MCP Server",
     description="Server HTTP per interagire con MCP usando Gemini e OpenRouter",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Aggiungi CORS middleware
@@ -660,11 +4880,47 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
 
+class TracingMiddleware:
+    """Middleware ASGI che apre lo span radice della richiesta HTTP e restituisce l'header X-Trace-Id
+    
+    Un X-Trace-Id valido (32 caratteri esadecimali) nella richiesta viene riusato,
+    così le trace del chiamante e del server coincidono. Lo span termina dopo
+    l'ultimo byte della risposta, streaming compreso.
+    """
+    
+    EXCLUDED_PATHS = ("/health", "/ready", "/metrics")
+    
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.enabled or scope["path"] in self.EXCLUDED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        incoming = dict(scope.get("headers") or []).get(b"x-trace-id", b"").decode("latin-1").lower()
+        trace_id = incoming if re.fullmatch(r"[0-9a-f]{32}", incoming) else None
+        with self.tracer.span(f"{scope['method']} {scope['path']}", trace_id=trace_id, kind="server",
+                              **{"http.method": scope["method"], "http.target": scope["path"]}) as span:
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                    if message["status"] >= 500:
+                        span.error = f"HTTP {message['status']}"
+                    message["headers"] = [*message.get("headers", []), (b"x-trace-id", span.trace_id.encode())]
+                await send(message)
+            
+            await self.app(scope, receive, send_with_trace_id)
+
+app.add_middleware(TracingMiddleware, tracer=tracer)
+
 # Dependency per verificare lo stato del servizio
 async def get_mcp_service():
-    return mcp_service
+    return get_service()
 
 # Endpoint per lo stato di salute
 @app.get("/health", response_model=ServerStatus)
@@ -677,9 +4933,33 @@ async def health_check(service: MCPService = Depends(get_mcp_service)):
         version="1.0.0",
         mcp_available=MCP_AVAILABLE,
         providers=service.get_available_providers(),
-        uptime=str(uptime)
+        uptime=str(uptime),
+        agent_pool=service.agent_pool.get_stats(),
+        response_cache=service.response_cache.get_stats() if service.response_cache else None,
+        tool_calls=service.tool_limiter.get_stats(),
+        tool_cache=service.tool_cache.get_stats() if service.tool_cache.enabled else None,
+        mcp_servers=service.mcp_clients.get_stats(),
+        admission=service.admission.get_stats(),
+        rate_limits=rate_limiter.get_stats(),
+        llm_calls=llm_resilience.get_stats(),
+        routing=service.router.get_stats(),
+        tracing=tracer.get_stats() if tracer.enabled else None,
+        jobs=service.jobs.get_stats()
     )
 
+# Readiness probe per load balancer e orchestratori
+@app.get("/ready")
+async def readiness_probe(service: MCPService = Depends(get_mcp_service)):
+    """200 quando il worker ha completato il warm-up, 503 durante l'avvio e il drain"""
+    status = service.readiness()
+    return JSONResponse(status_code=200 if status["status"] == "ready" else 503, content=status)
+
+# Endpoint per le metriche in formato Prometheus
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Metriche del server nel formato testuale di Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Endpoint per i provider disponibili
 @app.get("/api/v1/providers", response_model=List[ProviderInfo])
 async def list_providers(service: MCPService = Depends(get_mcp_service)):
@@ -706,7 +4986,147 @@ async def list_models(provider: str, service: MCPService = Depends(get_mcp_servi
 async def mcp_query(request: MCPQueryRequest, service: MCPService = Depends(get_mcp_service)):
     """Esegue una query usando MCP"""
     logger.info(f"Ricevuta query: {request.prompt[:100]}...")
-    return await service.query(request)
+    async with service.admission.admit(request.user_id or service.default_user_id, request.priority):
+        return await service.query(request)
+
+# Endpoint per molte query indipendenti in una sola chiamata (risultati in NDJSON)
+@app.post("/api/v1/query/batch")
+async def mcp_query_batch(batch: MCPBatchRequest, service: MCPService = Depends(get_mcp_service)):
+    """Esegue un batch di query con concorrenza limitata inviando ogni risultato appena pronto
+    
+    Ogni riga NDJSON è un evento result (con index, status e result o error) e
+    l'ultima è il riepilogo summary con esiti e tempi aggregati.
+    """
+    max_items = int(os.getenv('BATCH_MAX_ITEMS', 500))
+    if len(batch.items) > max_items:
+        raise HTTPException(status_code=413, detail=f"Batch troppo grande: massimo {max_items} query")
+    concurrency = min(batch.concurrency or int(os.getenv('BATCH_CONCURRENCY', 4)),
+                      int(os.getenv('BATCH_MAX_CONCURRENCY', 16)))
+    logger.info(f"Ricevuto batch di {len(batch.items)} query (concorrenza: {concurrency})")
+    
+    async def ndjson_body():
+        async for event in service.query_batch(batch.items, concurrency):
+            yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+    
+    return StreamingResponse(ndjson_body(), media_type="application/x-ndjson")
+
+# Job asincroni per le query lunghe: risposta immediata con l'id, risultato da interrogare
+@app.post("/api/v1/jobs", response_model=JobInfo, status_code=202)
+async def create_job(request: MCPQueryRequest, http_request: Request, response: Response,
+                     service: MCPService = Depends(get_mcp_service)):
+    """Accoda la query come job e restituisce subito l'id; 503 con Retry-After se la coda è piena"""
+    job = service.jobs.submit(request)
+    logger.info(f"Job {job['job_id']} accodato: {request.prompt[:100]}...")
+    response.headers["Location"] = str(http_request.url_for("get_job", job_id=job["job_id"]))
+    return job
+
+@app.get("/api/v1/jobs/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str, service: MCPService = Depends(get_mcp_service)):
+    """Stato del job e, al termine, risultato o errore"""
+    job = service.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} non trovato o scaduto")
+    return job
+
+@app.delete("/api/v1/jobs/{job_id}", response_model=JobInfo)
+async def cancel_job(job_id: str, service: MCPService = Depends(get_mcp_service)):
+    """Annulla un job in coda o in esecuzione; sui job già terminati non ha effetto"""
+    job = await service.jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} non trovato o scaduto")
+    logger.info(f"Annullamento del job {job_id}: stato {job['status']}")
+    return job
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """StreamingResponse che restituisce slot di ammissione e agent in ogni caso
+    
+    Il background di Starlette non viene eseguito se il client si disconnette e il
+    finally del generatore non scatta se il body non è mai partito: on_close viene
+    invece chiamato sempre, alla fine della risposta, e deve essere idempotente.
+    """
+    
+    def __init__(self, content: Any, on_close: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+    
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+# Endpoint per le query MCP in streaming (Server-Sent Events o NDJSON)
+@app.post("/api/v1/query/stream")
+async def mcp_query_stream(
+    request: MCPQueryRequest,
+    http_request: Request,
+    format: Optional[str] = None,
+    service: MCPService = Depends(get_mcp_service)
+):
+    """Esegue una query usando MCP inviando passi intermedi e token man mano che arrivano
+    
+    Il formato si sceglie con il parametro `format` (sse, ndjson) oppure tramite
+    l'header Accept: application/x-ndjson. Il default è SSE.
+    """
+    logger.info(f"Ricevuta query in streaming: {request.prompt[:100]}...")
+    
+    stream_format = (format or "").lower()
+    if not stream_format:
+        accept = http_request.headers.get("accept", "")
+        stream_format = "ndjson" if "application/x-ndjson" in accept else "sse"
+    if stream_format not in ("sse", "ndjson"):
+        raise HTTPException(status_code=400, detail=f"Formato di streaming {stream_format} non supportato (usa sse o ndjson)")
+    
+    # Ammissione e agent vengono ottenuti prima di aprire lo stream, così gli errori
+    # (compresi 429/503 con Retry-After) arrivano come risposta HTTP
+    user_id = request.user_id or service.default_user_id
+    await service.admission.acquire(user_id, request.priority)
+    admitted_at = time.monotonic()
+    try:
+        candidates = service.router.route(request.provider, request.model)
+        entry = await service.acquire_first_agent(request, candidates)
+    except BaseException:
+        service.admission.release(user_id)
+        raise
+    
+    stream = service.query_stream(request, entry, candidates)
+    state = {"started": False, "released": False}
+    
+    async def events():
+        state["started"] = True
+        async for event in stream:
+            yield event
+    
+    async def release_admitted():
+        if state["released"]:
+            return
+        state["released"] = True
+        if state["started"]:
+            # Lo stream rilascia da sé l'agent in uso (anche dopo un failover)
+            await stream.aclose()
+        else:
+            # Client disconnesso prima che il body partisse: l'agent non è mai passato allo stream
+            await service.agent_pool.release(entry)
+        service.admission.release(user_id, time.monotonic() - admitted_at)
+    
+    if stream_format == "ndjson":
+        async def ndjson_body():
+            async for event in events():
+                yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+        
+        return AdmittedStreamingResponse(ndjson_body(), release_admitted, media_type="application/x-ndjson")
+    
+    async def sse_body():
+        async for event in events():
+            payload = json.dumps(event, ensure_ascii=False, default=str)
+            yield f"event: {event['type']}\ndata: {payload}\n\n"
+    
+    return AdmittedStreamingResponse(
+        sse_body(),
+        release_admitted,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Endpoint per test rapido
 @app.get("/api/v1/test")
@@ -732,7 +5152,14 @@ async def get_config(service: MCPService = Depends(get_mcp_service)):
     
     return config
 
+# Endpoint per elencare i prompt di sistema disponibili
+@app.get("/api/v1/prompts", response_model=List[PromptInfo])
+async def list_prompts(service: MCPService = Depends(get_mcp_service)):
+    """Elenca i prompt caricati dalla directory prompts/ utilizzabili con prompt_file"""
+    return [PromptInfo(**prompt) for prompt in service.prompts.list()]
+
 # Endpoint per le statistiche della memoria delle conversazioni
+
 @app.get("/api/v1/memory/stats", response_model=MemoryStatsResponse)
 async def get_memory_stats(service: MCPService = Depends(get_mcp_service)):
     """Restituisce le statistiche della memoria delle conversazioni"""
@@ -749,16 +5176,13 @@ async def clear_conversation_memory(
     """Pulisce la memoria delle conversazioni per un utente specifico o tutti gli utenti"""
     try:
         user_id = request.user_id
-        users_before = len(service.conversation_memory)
         
         if user_id:
             # Pulisci memoria per utente specifico
-            user_existed = user_id in service.conversation_memory
-            service.clear_user_memory(user_id)
-            users_cleared = 1 if user_existed else 0
+            users_cleared = service.clear_user_memory(user_id)
             
             message = f"Memoria conversazione pulita per utente: {user_id}"
-            if not user_existed:
+            if not users_cleared:
                 message += " (utente non aveva conversazioni attive)"
                 
             logger.info(f"Memoria pulita per utente: {user_id}")
@@ -771,8 +5195,7 @@ async def clear_conversation_memory(
             )
         else:
             # Pulisci memoria per tutti gli utenti
-            service.clear_user_memory()  # Senza parametri pulisce tutto
-            users_cleared = users_before
+            users_cleared = service.clear_user_memory()  # Senza parametri pulisce tutto
             
             message = f"Memoria di tutte le conversazioni pulita. Utenti interessati: {users_cleared}"
             logger.info("Memoria di tutte le conversazioni pulita")
@@ -791,20 +5214,41 @@ async def clear_conversation_memory(
             detail=f"Errore nella pulizia della memoria: {str(e)}"
         )
 
+# Tempo di import del modulo (senza mcp_use e pacchetti dei provider, importati nel warm-up)
+IMPORT_SECONDS = round(time.perf_counter() - _IMPORT_STARTED, 3)
+
 if __name__ == "__main__":
     # Configurazione del server
     host = os.getenv('MCP_SERVER_HOST', '0.0.0.0')
     port = int(os.getenv('MCP_SERVER_PORT', 8000))
-    debug = os.getenv('MCP_SERVER_DEBUG', 'true').lower() == 'true'
+    debug = os.getenv('MCP_SERVER_DEBUG', 'false').lower() == 'true'
+    workers = worker_count()
+    
+    if debug and workers > 1:
+        logger.warning("MCP_SERVER_DEBUG ignorato con più worker: il reload automatico richiede un solo processo")
+        debug = False
+    if workers > 1:
+        # Ogni worker è un processo separato: pool, code e cache in memoria non sono condivisi
+        if os.getenv('MEMORY_BACKEND', 'memory').lower() != 'sqlite':
+            logger.warning("Con più worker la memoria delle conversazioni va condivisa: impostare MEMORY_BACKEND=sqlite")
+        if not metrics.shared_dir:
+            logger.warning("Con più worker /metrics riporta solo il worker che risponde: impostare METRICS_SHARED_DIR")
+        if not os.getenv('JOBS_STORE_PATH'):
+            logger.warning("Con più worker lo stato dei job è visibile solo dal worker che li esegue: impostare JOBS_STORE_PATH")
+    metrics.reset_shared_dir()
     
-    logger.info(f"Avvio MCP Server su {host}:{port}")
+    logger.info(f"Avvio MCP Server su {host}:{port} ({workers} worker, {'sviluppo con reload' if debug else 'produzione'})")
     logger.info(f"MCP disponibile: {MCP_AVAILABLE}")
     
-    # Avvia il server
+    # Avvia il server: allo stop uvicorn smette di accettare connessioni e attende quelle aperte.
+    # Con un solo processo l'app già importata viene passata direttamente (il modulo non viene
+    # importato una seconda volta); reload e worker richiedono invece il percorso di import
     uvicorn.run(
-        "mcp_server:app",
+        "mcp_server:app" if debug or workers > 1 else app,
         host=host,
         port=port,
         reload=debug,
+        workers=workers,
+        timeout_graceful_shutdown=int(os.getenv('MCP_SERVER_DRAIN_TIMEOUT', 30)),
         log_level="info" if debug else "warning"
     )
@@ -0,0 +1,756 @@
+#!/usr/bin/env python3
+"""
+Test di isolamento delle richieste concorrenti su MCPService
+
+Usa un LLM stub e un agent stub (nessuna chiave API né server MCP richiesti) e
+verifica che richieste parallele con provider, modelli e parametri diversi
+ricevano sempre la propria risposta e che un agent non sia mai usato da due
+richieste contemporaneamente.
+"""
+
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional
+
+import httpx
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MCP_USE_ANONYMIZED_TELEMETRY", "false")
+
+import mcp_server
+from fastapi import HTTPException
+
+from mcp_server import (MCPService, MCPQueryRequest, AgentPoolEntry, LLMConfig, ResponseCache, AdmissionController,
+                        ModelRouter, MetricsRegistry, OpenRouterLLM)
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# Modelli stub ("provider/modello") che rispondono come un provider non disponibile
+FAILING_MODELS = set()
+
+
+class StubLLM(BaseChatModel):
+    """LLM che risponde con i propri parametri e il prompt ricevuto"""
+
+    model: str
+    temperature: float
+    max_tokens: int
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        raise NotImplementedError("Usare il percorso asincrono")
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        # Latenza casuale per mescolare l'ordine di completamento
+        await asyncio.sleep(random.uniform(0.001, 0.02))
+        if self.model in FAILING_MODELS:
+            raise mcp_server.OpenRouterAPIError("OpenRouter API error: Service Unavailable", status=503)
+        prompt = messages[-1].content.rsplit("User: ", 1)[-1]
+        content = f"{self.model}|{self.temperature}|{self.max_tokens}|{prompt}"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+
+class StubAgent:
+    """Agent minimale che segnala se viene usato da più richieste in parallelo"""
+
+    overlaps = 0
+    runs = 0
+
+    def __init__(self, llm: StubLLM):
+        self.llm = llm
+        self.active = 0
+
+    async def run(self, query: str, max_steps: int = None) -> str:
+        self.active += 1
+        StubAgent.runs += 1
+        if self.active > 1:
+            StubAgent.overlaps += 1
+        try:
+            result = await self.llm.ainvoke(query)
+            return result.content
+        finally:
+            self.active -= 1
+
+    async def stream_events(self, query: str, max_steps: int = None):
+        """Eventi nel formato di MCPAgent.stream_events: la risposta arriva a pezzi separati da |"""
+        yield {"event": "on_chat_model_start", "data": {}}
+        content = (await self.llm.ainvoke(query)).content
+        for index, piece in enumerate(content.split("|")):
+            if index == 1 and self.llm.model.endswith("interrotto"):
+                raise mcp_server.OpenRouterAPIError("OpenRouter API error: connessione persa", status=502)
+            yield {"event": "on_chat_model_stream", "data": {"chunk": AIMessageChunk(content=piece + "|")}}
+
+
+class StubClient:
+    async def close_all_sessions(self):
+        pass
+
+
+def _make_service() -> MCPService:
+    mcp_server.MCP_AVAILABLE = True
+    service = MCPService(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_config.json"))
+    service.config.setdefault("providers", {}).setdefault("stub", {"model": "stub-default"})
+
+    async def create_agent(config: LLMConfig, client: Any) -> AgentPoolEntry:
+        llm = StubLLM(model=f"{config.provider}/{config.model}",
+                      temperature=config.temperature, max_tokens=config.max_tokens)
+        return AgentPoolEntry(config, llm, StubAgent(llm))
+
+    service.agent_pool._client_factory = StubClient
+    service.agent_pool.max_size = 64
+    service.agent_pool._agent_factory = create_agent
+    return service
+
+
+async def _run_concurrent_queries(total: int = 200):
+    service = _make_service()
+    StubAgent.overlaps = 0
+
+    requests = []
+    for i in range(total):
+        requests.append(MCPQueryRequest(
+            prompt=f"domanda-{i}",
+            user_id=f"user-{i % 7}",
+            provider=random.choice(["openrouter", "stub"]),
+            model=random.choice(["model-a", "model-b", "model-c"]),
+            temperature=random.choice([0.0, 0.5, 1.0]),
+            max_tokens=random.choice([128, 256]),
+            use_context=False
+        ))
+
+    responses = await asyncio.gather(*[service.query(r) for r in requests])
+    return service, requests, responses
+
+
+def test_concurrent_queries_never_cross_over():
+    service, requests, responses = asyncio.run(_run_concurrent_queries())
+
+    for request, response in zip(requests, responses):
+        expected = f"{request.provider}/{request.model}|{request.temperature}|{request.max_tokens}|{request.prompt}"
+        assert response.response == expected, f"{response.response} != {expected}"
+        assert response.provider == request.provider
+        assert response.model == request.model
+
+    assert StubAgent.overlaps == 0, f"Agent usato in parallelo {StubAgent.overlaps} volte"
+
+    stats = service.agent_pool.get_stats()
+    assert stats["hits"] > 0
+    for group in stats["agents"]:
+        assert group["in_use"] == 0
+        assert group["instances"] <= service.agent_pool.max_per_key
+
+
+def test_response_cache_serves_repeated_queries():
+    with tempfile.TemporaryDirectory() as tmp:
+        disk_path = os.path.join(tmp, "responses.db")
+        service = _make_service()
+        service.response_cache = ResponseCache(max_entries=10, ttl=60, disk_path=disk_path)
+        StubAgent.runs = 0
+
+        async def scenario():
+            first = await service.query(MCPQueryRequest(prompt="Quanti record?", provider="stub", use_context=False))
+            # Spazi diversi producono la stessa chiave
+            second = await service.query(MCPQueryRequest(prompt="  Quanti   record? ", provider="stub", use_context=False))
+            # Maiuscole, budget di token e passi diversi no: la risposta potrebbe essere diversa o troncata
+            others = [
+                await service.query(MCPQueryRequest(prompt="quanti RECORD?", provider="stub", use_context=False)),
+                await service.query(MCPQueryRequest(prompt="Quanti record?", provider="stub", use_context=False,
+                                                    max_tokens=50)),
+                await service.query(MCPQueryRequest(prompt="Quanti record?", provider="stub", use_context=False,
+                                                    max_steps=1)),
+                await service.query(MCPQueryRequest(prompt="Quanti record?", provider="stub", use_context=False,
+                                                    temperature=0.0))
+            ]
+            # Con il contesto o con use_cache false la cache viene ignorata
+            await service.query(MCPQueryRequest(prompt="Quanti record?", provider="stub", use_context=True))
+            await service.query(MCPQueryRequest(prompt="Quanti record?", provider="stub", use_context=False, use_cache=False))
+            return first, second, others
+
+        first, second, others = asyncio.run(scenario())
+        assert not first.cached and second.cached
+        assert second.response == first.response
+        assert not any(response.cached for response in others)
+        assert others[1].response.split("|")[2] == "50"
+        assert StubAgent.runs == 7
+        assert service.response_cache.get_stats()["hits"] == 1
+        service.response_cache.close()
+
+        # Il tier su disco serve la risposta anche a una nuova istanza (riavvio o altro worker)
+        restarted = ResponseCache(max_entries=10, ttl=60, disk_path=disk_path)
+        defaults = service._default_llm_config("stub")
+        key = ResponseCache.make_key("stub", "stub-default", service.prompts.get("default"), "Quanti record?",
+                                     defaults.temperature, defaults.max_tokens, 3)
+        assert asyncio.run(restarted.get(key))["response"] == first.response
+        assert restarted.get_stats()["disk_hits"] == 1
+
+        # Le voci scadute restano su disco fino allo sweep periodico, ma non vengono più servite
+        restarted.ttl = -1
+        asyncio.run(restarted.put("scaduta", {"response": "x", "steps": 1}))
+        assert asyncio.run(ResponseCache(disk_path=disk_path).get("scaduta")) is None
+        assert restarted.sweep() == 1
+        restarted.close()
+
+
+def test_response_cache_lru_and_ttl():
+    async def scenario():
+        cache = ResponseCache(max_entries=2, ttl=60)
+        for key in ("a", "b", "c"):
+            await cache.put(key, {"response": key, "steps": 1})
+        assert await cache.get("a") is None
+        assert (await cache.get("c"))["response"] == "c"
+        assert cache.get_stats()["evictions"] == 1
+
+        cache.ttl = -1
+        await cache.put("d", {"response": "d", "steps": 1})
+        assert await cache.get("d") is None
+        assert cache.get_stats()["expired"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_admission_control_limits_and_priorities():
+    async def scenario():
+        admission = AdmissionController(max_concurrent=2, max_per_user=1, max_queue=3,
+                                        max_queued_per_user=1, queue_timeout=0.3)
+        order = []
+        release = asyncio.Event()
+
+        async def request(user_id, priority="normal"):
+            async with admission.admit(user_id, priority):
+                order.append(user_id)
+                await release.wait()
+
+        # a e b occupano i due posti; le altre richieste restano in coda
+        running = [asyncio.create_task(request("a")), asyncio.create_task(request("b"))]
+        await asyncio.sleep(0)
+        queued = [asyncio.create_task(request("c", "low")), asyncio.create_task(request("d", "high")),
+                  asyncio.create_task(request("a"))]
+        await asyncio.sleep(0)
+        assert admission.get_stats()["queue_depth"] == 3
+
+        # Limite per utente (in corso + in coda) e coda piena rispondono subito
+        rejected = []
+        for user_id in ("a", "e"):
+            try:
+                await admission.acquire(user_id)
+            except HTTPException as e:
+                rejected.append((e.status_code, "Retry-After" in e.headers))
+        assert rejected == [(429, True), (503, True)]
+
+        release.set()
+        await asyncio.gather(*running, *queued)
+        # Servite per priorità: d (high) prima di a (normal) e c (low)
+        assert order == ["a", "b", "d", "a", "c"]
+
+        # Attesa oltre queue_timeout: 503
+        release.clear()
+        blockers = [asyncio.create_task(request("x")), asyncio.create_task(request("y"))]
+        await asyncio.sleep(0)
+        try:
+            await admission.acquire("z")
+            assert False, "eccezione attesa oltre il timeout"
+        except HTTPException as e:
+            assert e.status_code == 503
+        # Anche le attese annullate dal client non lasciano contatori per utente
+        waiting = [asyncio.create_task(admission.acquire(f"utente-{i}")) for i in range(3)]
+        await asyncio.sleep(0.01)
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        release.set()
+        await asyncio.gather(*blockers)
+        # Nessuna voce residua per gli utenti usciti dalla coda senza essere ammessi
+        assert not admission._user_queued and not admission._user_active
+
+        stats = admission.get_stats()
+        assert stats["active"] == 0 and stats["queue_depth"] == 0
+        assert stats["rejected_user_limit"] == 1 and stats["rejected_queue_full"] == 1
+        assert stats["rejected_timeout"] == 1
+        assert stats["admitted"] == 7
+        assert stats["wait_ms"]["max"] > 0
+
+    asyncio.run(scenario())
+
+
+def test_admission_user_blocked_in_queue_does_not_hold_up_other_users():
+    async def scenario():
+        admission = AdmissionController(max_concurrent=4, max_per_user=1, max_queue=10,
+                                        max_queued_per_user=2, queue_timeout=1)
+        await admission.acquire("a")
+        # La seconda richiesta di a resta in coda per il limite per utente...
+        second = asyncio.create_task(admission.acquire("a"))
+        await asyncio.sleep(0)
+        assert admission.queued == 1
+        # ...ma b entra subito: 1 posto su 4 occupato
+        waited = await asyncio.wait_for(admission.acquire("b"), 0.2)
+        assert waited < 0.1 and admission.active == 2 and admission.queued == 1
+        admission.release("b")
+        admission.release("a")
+        await second
+        assert admission.active == 1 and admission.queued == 0
+        admission.release("a")
+
+    asyncio.run(scenario())
+
+
+def test_routing_prefers_fastest_healthy_model_and_fails_over():
+    service = _make_service()
+    service.config["routing"] = {"candidates": ["stub/lento", "stub/veloce", {"provider": "stub", "model": "riserva"}]}
+    service.router = ModelRouter(service.config, mcp_server.ProviderResilience())
+    router = service.router
+
+    # Senza misure vale l'ordine di preferenza; poi vince il modello più veloce oltre la tolleranza
+    assert router.route() == [("stub", "lento"), ("stub", "veloce"), ("stub", "riserva")]
+    router.observe("stub", "lento", latency=2.0)
+    router.observe("stub", "veloce", latency=0.5)
+    router.observe("stub", "riserva", latency=1.9)
+    assert router.route()[0] == ("stub", "veloce")
+    # Un modello esplicito nella richiesta non viene instradato
+    assert router.route("stub", "lento") == [("stub", "lento")]
+
+    async def scenario():
+        FAILING_MODELS.add("stub/veloce")
+        try:
+            return await service.query(MCPQueryRequest(prompt="ciao", use_context=False))
+        finally:
+            FAILING_MODELS.clear()
+
+    response = asyncio.run(scenario())
+    # Il modello preferito fallisce: la risposta arriva dal successivo e lo riporta
+    assert response.response.startswith("stub/lento|")
+    assert (response.provider, response.model) == ("stub", "lento")
+
+    # Errori ripetuti rendono il modello non sano finché le medie non si riprendono
+    for _ in range(5):
+        router.observe("stub", "veloce", failed=True)
+    assert router.route()[0] == ("stub", "lento")
+
+    stats = router.get_stats()
+    assert stats["failovers"] == 1 and stats["routed"] == 2
+    assert stats["models"]["stub/veloce"]["healthy"] is False
+    assert stats["order"][-1] == "stub/veloce"
+
+
+def test_routing_fails_over_on_connection_errors_and_timeouts():
+    async def scenario():
+        # Un provider che non risponde entro il timeout e uno su una porta chiusa
+        async def hang(request):
+            await asyncio.sleep(1)
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_post("/chat/completions", hang)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        hanging_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            closed_url = f"http://127.0.0.1:{probe.getsockname()[1]}"
+
+        service = _make_service()
+        service.config["routing"] = {"candidates": ["stub/irraggiungibile", "stub/bloccato", "stub/riserva"]}
+        service.router = ModelRouter(service.config, mcp_server.ProviderResilience())
+        mcp_server.llm_resilience.configure({"providers": {"openrouter": {"resilience": {"max_retries": 0}}}})
+        stub_factory = service.agent_pool._agent_factory
+
+        async def create_agent(config: LLMConfig, client: Any) -> AgentPoolEntry:
+            if config.model == "riserva":
+                return await stub_factory(config, client)
+            # Il percorso reale di OpenRouterLLM._agenerate, con retry e timeout del pool HTTP
+            base_url = closed_url if config.model == "irraggiungibile" else hanging_url
+            llm = OpenRouterLLM(model=config.model, api_key="test", base_url=base_url)
+            return AgentPoolEntry(config, llm, StubAgent(llm))
+
+        service.agent_pool._agent_factory = create_agent
+        try:
+            return await service.query(MCPQueryRequest(prompt="ciao", use_context=False)), service.router
+        finally:
+            await mcp_server.http_pool.close()
+            await runner.cleanup()
+
+    request_timeout = mcp_server.http_pool.request_timeout
+    mcp_server.http_pool.request_timeout = 0.2
+    try:
+        response, router = asyncio.run(scenario())
+    finally:
+        mcp_server.http_pool.request_timeout = request_timeout
+        mcp_server.llm_resilience.configure({})
+
+    # Errore di connessione e timeout sono errori del provider: si passa al candidato successivo
+    assert (response.provider, response.model) == ("stub", "riserva")
+    assert response.response.startswith("stub/riserva|")
+    assert router.get_stats()["failovers"] == 2 and router.get_stats()["routed"] == 3
+
+
+async def _post_stream(service: MCPService, payload: dict, **params) -> "httpx.Response":
+    """Chiama /api/v1/query/stream sull'app ASGI con il servizio di test (senza lifespan)"""
+    mcp_server.app.dependency_overrides[mcp_server.get_mcp_service] = lambda: service
+    try:
+        transport = httpx.ASGITransport(app=mcp_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/api/v1/query/stream", json=payload, params=params)
+    finally:
+        mcp_server.app.dependency_overrides.clear()
+
+
+def test_stream_endpoint_formats_and_failover_before_first_token():
+    service = _make_service()
+    service.config["routing"] = {"candidates": ["stub/veloce", "stub/lento"]}
+    service.router = ModelRouter(service.config, mcp_server.ProviderResilience())
+
+    async def scenario():
+        sse = await _post_stream(service, {"prompt": "ciao", "provider": "stub", "model": "a", "use_context": False})
+        FAILING_MODELS.add("stub/veloce")
+        try:
+            failover = await _post_stream(service, {"prompt": "ciao", "use_context": False}, format="ndjson")
+        finally:
+            FAILING_MODELS.clear()
+        routing = service.router.get_stats()
+        # Dopo i primi token l'errore non può passare a un altro modello: chiude lo stream con error
+        service.router = ModelRouter({"routing": {"candidates": ["stub/interrotto", "stub/lento"]},
+                                      "providers": service.config["providers"]}, mcp_server.ProviderResilience())
+        broken = await _post_stream(service, {"prompt": "ciao", "use_context": False}, format="ndjson")
+        return sse, failover, broken, routing
+
+    sse, failover, broken, routing = asyncio.run(scenario())
+
+    # SSE: un blocco "event: <tipo>" + "data: <json>" per evento, dalla partenza alla risposta finale
+    assert sse.status_code == 200 and sse.headers["content-type"].startswith("text/event-stream")
+    blocks = [block.split("\n") for block in sse.text.strip().split("\n\n")]
+    types = [lines[0][len("event: "):] for lines in blocks]
+    events = [json.loads(lines[1][len("data: "):]) for lines in blocks]
+    assert types[0] == "start" and types[-1] == "final" and set(types[1:-1]) == {"token"}
+    assert "".join(e["content"] for e in events if e["type"] == "token") == events[-1]["response"]
+    assert events[-1]["response"].startswith("stub/a|") and events[-1]["response"].endswith("|ciao|")
+
+    # Il candidato preferito fallisce prima di emettere token: stesso failover di /api/v1/query
+    assert failover.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in failover.text.splitlines()]
+    assert [e["type"] for e in events[:2]] == ["start", "failover"]
+    assert events[1] == {"type": "failover", "failed": "stub/veloce", "provider": "stub", "model": "lento"}
+    assert events[-1]["type"] == "final" and events[-1]["model"] == "lento"
+    assert events[-1]["response"].startswith("stub/lento|")
+    assert routing["failovers"] == 1 and routing["models"]["stub/lento"]["chosen"] == 1
+
+    events = [json.loads(line) for line in broken.text.splitlines()]
+    assert [e["type"] for e in events] == ["start", "token", "error"]
+    assert "connessione persa" in events[-1]["detail"]
+    # Gli agent vengono restituiti al pool anche dopo failover ed errori
+    assert sum(agent["in_use"] for agent in service.agent_pool.get_stats()["agents"]) == 0
+
+
+
+def test_stream_releases_slot_and_agent_when_client_disconnects():
+    """Slot di ammissione e agent tornano liberi anche se il client se ne va prima del body"""
+    service = _make_service()
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+             "method": "POST", "path": "/api/v1/query/stream", "headers": []}
+
+    async def disconnected(sent_before_disconnect: int):
+        request = MCPQueryRequest(prompt="ciao", provider="stub", model="a", use_context=False)
+        response = await mcp_server.mcp_query_stream(request, mcp_server.Request(scope), "ndjson", service)
+        assert service.admission.active == 1
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(10)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if len(sent) == sent_before_disconnect:
+                raise OSError("client disconnesso")
+            sent.append(message)
+
+        try:
+            await response(scope, receive, send)
+        except Exception:
+            pass
+        return sent
+
+    async def scenario():
+        # Disconnessione sugli header: il body non parte mai. Poi dopo il primo evento
+        return [await disconnected(0), await disconnected(2)]
+
+    before_body, after_start = asyncio.run(scenario())
+
+    assert before_body == [] and len(after_start) == 2
+    assert json.loads(after_start[1]["body"])["type"] == "start"
+    assert service.admission.active == 0 and service.admission.stats["admitted"] == 2
+    assert sum(agent["in_use"] for agent in service.agent_pool.get_stats()["agents"]) == 0
+
+def test_batch_runs_items_concurrently_and_isolates_errors():
+    async def scenario():
+        service = _make_service()
+        query = service.query
+        running = peak = 0
+
+        async def counting_query(request):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            try:
+                await asyncio.sleep(0.01)
+                return await query(request)
+            finally:
+                running -= 1
+
+        service.query = counting_query
+        items = [MCPQueryRequest(prompt=f"ticket-{i}", user_id="classificatore", provider="stub",
+                                 model="rotto" if i == 7 else "a", use_context=False) for i in range(30)]
+        FAILING_MODELS.add("stub/rotto")
+        try:
+            events = [event async for event in service.query_batch(items, concurrency=8)]
+        finally:
+            FAILING_MODELS.clear()
+        return events, peak
+
+    events, peak = asyncio.run(scenario())
+    results, summary = events[:-1], events[-1]
+
+    # Un risultato per query, nell'ordine di completamento; l'errore non ferma il batch
+    assert sorted(event["index"] for event in results) == list(range(30))
+    for event in results:
+        if event["index"] == 7:
+            assert event["status"] == "error" and event["status_code"] >= 500
+        else:
+            assert event["status"] == "ok"
+            assert event["result"]["response"].endswith(f"|ticket-{event['index']}")
+
+    # Stesso utente ma oltre il limite per utente dell'ammissione: vale la concorrenza del batch
+    assert 2 < peak <= 8
+    assert summary["type"] == "summary"
+    assert (summary["total"], summary["succeeded"], summary["failed"]) == (30, 29, 1)
+    assert summary["items_seconds_total"] > summary["wall_seconds"] > 0
+    assert summary["item_seconds"]["max"] >= summary["item_seconds"]["p95"] >= summary["item_seconds"]["p50"]
+
+
+def test_jobs_run_in_background_with_cancellation_and_retention():
+    async def scenario():
+        service = _make_service()
+        service.jobs.max_retained = 3
+        query = service.query
+
+        async def slow_query(request):
+            if request.prompt == "lenta":
+                await asyncio.sleep(30)
+            return await query(request)
+
+        service.query = slow_query
+        service.jobs.workers = 2
+        service.jobs.start()
+        try:
+            # La risposta è immediata, il risultato arriva interrogando il job
+            job = service.jobs.submit(MCPQueryRequest(prompt="report", user_id="analista", provider="stub",
+                                                      model="a", use_context=False))
+            assert job["status"] == "queued"
+            while service.jobs.get(job["job_id"])["status"] in ("queued", "running"):
+                await asyncio.sleep(0.01)
+            done = service.jobs.get(job["job_id"])
+            assert done["status"] == "succeeded" and done["result"]["response"].endswith("|report")
+            assert done["execution_time"] is not None
+
+            # Un job lento occupa un worker e viene interrotto; uno in coda viene annullato prima di partire
+            slow = [service.jobs.submit(MCPQueryRequest(prompt="lenta", user_id="analista", provider="stub",
+                                                        use_context=False)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            assert [service.jobs.get(j["job_id"])["status"] for j in slow] == ["running", "running", "queued"]
+            assert (await service.jobs.cancel(slow[2]["job_id"]))["status"] == "cancelled"
+            assert (await service.jobs.cancel(slow[0]["job_id"]))["status"] == "cancelled"
+            assert await service.jobs.cancel("inesistente") is None
+
+            # Le query fallite restano consultabili con il codice di errore
+            FAILING_MODELS.add("stub/rotto")
+            failed = service.jobs.submit(MCPQueryRequest(prompt="x", provider="stub", model="rotto",
+                                                         use_context=False))
+            while service.jobs.get(failed["job_id"])["status"] in ("queued", "running"):
+                await asyncio.sleep(0.01)
+            assert service.jobs.get(failed["job_id"])["status_code"] >= 500
+
+            # Retention: oltre max_retained i job terminati più vecchi vengono rimossi
+            assert service.jobs.get(job["job_id"]) is None
+            stats = service.jobs.get_stats()
+            assert stats["retained"] == 3 and stats["expired"] == 1 and stats["running"] == 1
+        finally:
+            FAILING_MODELS.clear()
+            await service.jobs.stop()
+        assert service.jobs.get(slow[1]["job_id"])["status"] == "cancelled"
+
+        # Dopo l'arresto i nuovi job vengono rifiutati con 503
+        try:
+            service.jobs.submit(MCPQueryRequest(prompt="tardi", use_context=False))
+            assert False, "job accettato dopo l'arresto"
+        except HTTPException as e:
+            assert e.status_code == 503 and "Retry-After" in e.headers
+
+    asyncio.run(scenario())
+
+
+
+def test_jobs_limit_running_jobs_per_user():
+    """I job di un utente oltre il limite aspettano senza togliere worker agli altri utenti"""
+    async def scenario():
+        service = _make_service()
+        query = service.query
+        proceed = asyncio.Event()
+        running: Dict[str, int] = {}
+        peak: Dict[str, int] = {}
+
+        async def gated_query(request):
+            running[request.user_id] = running.get(request.user_id, 0) + 1
+            peak[request.user_id] = max(peak.get(request.user_id, 0), running[request.user_id])
+            try:
+                await proceed.wait()
+                return await query(request)
+            finally:
+                running[request.user_id] -= 1
+
+        service.query = gated_query
+        service.jobs.workers = 3
+        service.jobs.max_running_per_user = 1
+        service.jobs.start()
+        try:
+            def submit(user_id):
+                return service.jobs.submit(MCPQueryRequest(prompt="report", user_id=user_id, provider="stub",
+                                                           model="a", use_context=False))["job_id"]
+
+            heavy = [submit("massivo") for _ in range(3)]
+            other = submit("occasionale")
+            await asyncio.sleep(0.05)
+            statuses = [service.jobs.get(job_id)["status"] for job_id in heavy]
+            assert statuses == ["running", "queued", "queued"]
+            assert service.jobs.get(other)["status"] == "running"
+            stats = service.jobs.get_stats()
+            assert stats["running"] == 2 and stats["deferred"] == 2
+
+            # Un job rimandato annullato non blocca quelli successivi dello stesso utente
+            await service.jobs.cancel(heavy[1])
+            proceed.set()
+            while any(service.jobs.get(job_id)["status"] in ("queued", "running") for job_id in heavy + [other]):
+                await asyncio.sleep(0.01)
+            statuses = [service.jobs.get(job_id)["status"] for job_id in heavy]
+            assert statuses == ["succeeded", "cancelled", "succeeded"]
+            assert service.jobs.get_stats()["deferred"] == 0
+        finally:
+            await service.jobs.stop()
+        return peak
+
+    peak = asyncio.run(scenario())
+    assert peak == {"massivo": 1, "occasionale": 1}
+
+def test_warm_up_readiness_and_graceful_drain():
+    async def scenario():
+        service = _make_service()
+        assert service.readiness()["status"] == "starting"
+        await service.warm_up()
+        ready = service.readiness()
+        assert ready["status"] == "ready" and ready["warmup_seconds"] is not None
+        # Il warm-up importa mcp_use, non i pacchetti dei provider disabilitati (gemini)
+        assert "mcp_use" in ready["lazy_imports"] and "langchain_google_genai" not in ready["lazy_imports"]
+        assert service.agent_pool.get_stats()["size"] == 1
+
+        # Il drain attende la query in corso e rifiuta le nuove con 503
+        await service.admission.acquire("in-corso")
+        drain = asyncio.create_task(service.admission.drain(timeout=5))
+        await asyncio.sleep(0.05)
+        assert service.readiness()["status"] == "draining"
+        try:
+            await service.admission.acquire("nuova")
+            assert False, "richiesta accettata durante il drain"
+        except HTTPException as e:
+            assert e.status_code == 503
+        assert not drain.done()
+        service.admission.release("in-corso")
+        assert await drain is True
+
+    asyncio.run(scenario())
+
+
+def test_import_does_not_load_mcp_use_or_provider_packages():
+    # Nemmeno il servizio viene creato all'import: con più worker il processo principale non lo usa
+    code = ("import sys, mcp_server; "
+            "print(sorted(m for m in ('mcp_use', 'langchain_google_genai', 'langchain_openai') if m in sys.modules), "
+            "mcp_server.mcp_service)")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == "[] None"
+
+
+def test_metrics_shared_between_workers():
+    with tempfile.TemporaryDirectory() as shared_dir:
+        def worker_registry():
+            registry = MetricsRegistry(shared_dir)
+            return (registry, registry.counter("richieste_total", "Richieste", ("esito",)),
+                    registry.gauge("attive", "Richieste attive"), registry.histogram("durata_seconds", "Durata", buckets=(1, 5)))
+
+        registry, requests_total, active, duration = worker_registry()
+        requests_total.inc(3, esito="ok")
+        active.set(2)
+        duration.observe(0.5)
+
+        # Snapshot di un worker vivo (il processo padre) e di uno terminato
+        other, other_requests, other_active, other_duration = worker_registry()
+        other_requests.inc(4, esito="ok")
+        other_active.set(5)
+        other_duration.observe(3)
+        for pid in (os.getppid(), 2 ** 22 + 1):
+            with open(os.path.join(shared_dir, f"metrics_{pid}.json"), "w", encoding="utf-8") as f:
+                json.dump({name: metric.dump() for name, metric in other._metrics.items()}, f)
+
+        text = registry.render()
+        assert 'richieste_total{esito="ok"} 11' in text
+        # Il gauge del worker terminato non viene sommato
+        assert "attive 7" in text
+        assert 'durata_seconds_bucket{le="1"} 1' in text and 'durata_seconds_bucket{le="5"} 3' in text
+        assert "durata_seconds_count 3" in text
+        assert os.path.exists(os.path.join(shared_dir, f"metrics_{os.getpid()}.json"))
+
+        registry.reset_shared_dir()
+        assert not os.listdir(shared_dir)
+
+
+if __name__ == "__main__":
+    print("🧪 Test isolamento richieste concorrenti")
+    print("=" * 50)
+    try:
+        test_concurrent_queries_never_cross_over()
+        print("✅ Nessuna risposta scambiata tra richieste concorrenti")
+        test_response_cache_serves_repeated_queries()
+        test_response_cache_lru_and_ttl()
+        print("✅ Cache delle risposte")
+        test_admission_control_limits_and_priorities()
+        test_admission_user_blocked_in_queue_does_not_hold_up_other_users()
+        print("✅ Controllo di ammissione")
+        test_routing_prefers_fastest_healthy_model_and_fails_over()
+        test_routing_fails_over_on_connection_errors_and_timeouts()
+        test_stream_endpoint_formats_and_failover_before_first_token()
+        test_stream_releases_slot_and_agent_when_client_disconnects()
+        print("✅ Routing e failover tra modelli")
+        test_batch_runs_items_concurrently_and_isolates_errors()
+        print("✅ Batch di query con concorrenza limitata")
+        test_jobs_run_in_background_with_cancellation_and_retention()
+        test_jobs_limit_running_jobs_per_user()
+        print("✅ Job asincroni con annullamento e retention")
+        test_warm_up_readiness_and_graceful_drain()
+        test_import_does_not_load_mcp_use_or_provider_packages()
+        test_metrics_shared_between_workers()
+        print("✅ Readiness, drain e metriche condivise tra worker")
+    except AssertionError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
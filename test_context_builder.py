@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Test della selezione del contesto conversazione entro il budget di token
+
+Non richiede il server in esecuzione.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MCP_USE_ANONYMIZED_TELEMETRY", "false")
+
+from mcp_server import (ContextBuilder, ConversationSummarizer, InMemoryMemoryStore, PromptRegistry,
+                        SQLiteMemoryStore)
+
+
+def _history(count: int, words: int = 50):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join([f"m{i}"] * words)}
+        for i in range(count)
+    ]
+
+
+def test_context_respects_budget_and_keeps_recent_messages():
+    builder = ContextBuilder({})
+    history = _history(40)
+    context = builder.build(history, "domanda", budget=600)
+
+    assert 0 < context.messages_used < len(history)
+    assert context.tokens <= 600
+    # L'ultimo messaggio è sempre il più recente, subito prima della fine del contesto
+    assert context.prompt.index("m39") > context.prompt.index("m38")
+    assert "m0 " not in context.prompt
+    assert context.prompt.endswith("DOMANDA CORRENTE: domanda")
+
+
+def test_long_message_is_truncated():
+    builder = ContextBuilder({})
+    builder.max_message_tokens = 20
+    context = builder.build(_history(1, words=500), "domanda", budget=1000)
+
+    assert context.messages_used == 1
+    assert context.truncated_messages == 1
+    assert ContextBuilder.TRUNCATION_MARKER in context.prompt
+    assert context.tokens < 60
+
+
+def test_budget_per_model_from_config():
+    builder = ContextBuilder({"providers": {"openrouter": {
+        "context_tokens": 1500,
+        "context_budgets": {"openai/gpt-4o-mini": 8000}
+    }}})
+
+    assert builder.budget_for("openrouter", "openai/gpt-4o-mini") == 8000
+    assert builder.budget_for("openrouter", "altro/modello") == 1500
+    assert builder.budget_for("gemini", "gemini-2.0-flash") == builder.default_budget
+
+
+def _fill(store, user_id: str, first: int, last: int):
+    start = datetime(2024, 1, 1)
+    for i in range(first, last):
+        store.append(user_id, {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"turno-{i}",
+            "timestamp": (start + timedelta(seconds=i)).isoformat()
+        })
+
+
+def _check_summarizer(store):
+    folded = []
+
+    async def fake_summarize(previous, messages):
+        folded.append([m["content"] for m in messages])
+        return f"{previous or ''}|{messages[0]['content']}..{messages[-1]['content']}"
+
+    summarizer = ConversationSummarizer(store, fake_summarize, keep_recent=4, fold_batch=6)
+
+    _fill(store, "u1", 0, 9)
+    assert asyncio.run(summarizer.summarize_user("u1")) is False
+    assert store.get_summary("u1") is None
+
+    _fill(store, "u1", 9, 10)
+    assert asyncio.run(summarizer.summarize_user("u1")) is True
+    summary = store.get_summary("u1")
+    assert summary["text"] == "|turno-0..turno-5"
+
+    # Solo gli ultimi turni non riassunti restano integrali nel prompt
+    recent = ConversationSummarizer.unsummarized(store.get_messages("u1"), summary)
+    assert [m["content"] for m in recent] == ["turno-6", "turno-7", "turno-8", "turno-9"]
+
+    context = ContextBuilder({}).build(recent, "domanda", budget=1000, summary=summary["text"])
+    assert context.summary_used and context.messages_used == 4
+    assert "RIASSUNTO: |turno-0..turno-5" in context.prompt
+
+    store.clear("u1")
+    assert store.get_summary("u1") is None
+
+
+def test_rolling_summary_in_memory():
+    _check_summarizer(InMemoryMemoryStore(limit=30))
+
+
+def test_rolling_summary_sqlite():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteMemoryStore(limit=30, path=os.path.join(tmp, "memory.db"))
+        try:
+            _check_summarizer(store)
+        finally:
+            store.close()
+
+
+def test_prompt_registry_reloads_changed_files():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "coding.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("prima versione\n")
+        registry = PromptRegistry(tmp)
+        assert registry.get("coding") == "prima versione"
+        assert registry.refresh() == 0
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("seconda versione")
+        os.utime(path, (0, os.stat(path).st_mtime + 10))
+        with open(os.path.join(tmp, "nuovo.txt"), "w", encoding="utf-8") as f:
+            f.write("nuovo prompt")
+
+        assert registry.refresh() == 2
+        assert registry.get("coding") == "seconda versione"
+        assert [p["name"] for p in registry.list()] == ["coding", "nuovo"]
+
+        os.remove(path)
+        assert registry.refresh() == 1
+        assert registry.get("coding") is None
+
+
+if __name__ == "__main__":
+    test_context_respects_budget_and_keeps_recent_messages()
+    test_long_message_is_truncated()
+    test_budget_per_model_from_config()
+    test_rolling_summary_in_memory()
+    test_rolling_summary_sqlite()
+    test_prompt_registry_reloads_changed_files()
+    print("✅ Test contesto completati")
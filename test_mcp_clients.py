@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Test del client MCP condiviso verso più server
+
+Avvia due server MCP stdio locali (FastMCP del pacchetto mcp) e verifica che
+entrambi finiscano nello stesso client, che un server irraggiungibile venga
+riprovato con backoff senza bloccare gli altri e che una sessione caduta
+venga ricollegata.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MCP_USE_ANONYMIZED_TELEMETRY", "false")
+
+from mcp_server import MCPClientManager
+
+SERVER_SCRIPT = '''
+import sys
+from mcp.server.fastmcp import FastMCP
+
+name = sys.argv[1]
+mcp = FastMCP(name)
+
+@mcp.tool()
+def ping(valore: int) -> str:
+    """Restituisce il nome del server e il valore ricevuto"""
+    return f"{name}:{valore}"
+
+mcp.run()
+'''
+
+
+async def _scenario(script: str):
+    config = {"mcpServers": {
+        "primo": {"command": sys.executable, "args": [script, "primo"], "max_concurrency": 2},
+        "secondo": {"command": sys.executable, "args": [script, "secondo"]},
+        "spento": {"url": "http://127.0.0.1:9/sse"},
+        "disattivato": {"url": "http://127.0.0.1:9/sse", "disabled": True}
+    }}
+    manager = MCPClientManager(config, backoff_base=0.05, backoff_max=0.1)
+    wrapped, changes = [], []
+    manager.session_hooks.append(lambda server, connector: wrapped.append(server))
+    manager.change_hooks.append(changes.append)
+
+    try:
+        await manager.connect_all()
+        client = manager.get_client()
+        first = await client.sessions["primo"].connector.call_tool("ping", {"valore": 1})
+        second = await client.sessions["secondo"].connector.call_tool("ping", {"valore": 2})
+        stats_after_connect = manager.get_stats()
+
+        # Sessione chiusa: il controllo successivo la riapre
+        await client.sessions["primo"].disconnect()
+        await asyncio.sleep(0.15)
+        await manager.check()
+        again = await client.sessions["primo"].connector.call_tool("ping", {"valore": 3})
+        return (first.content[0].text, second.content[0].text, again.content[0].text,
+                stats_after_connect, manager.get_stats(), wrapped, changes, client.config["mcpServers"])
+    finally:
+        await manager.close()
+
+
+def test_shared_client_connects_all_servers_and_reconnects():
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "server.py")
+        with open(script, "w", encoding="utf-8") as f:
+            f.write(SERVER_SCRIPT)
+        first, second, again, before, after, wrapped, changes, configured = asyncio.run(_scenario(script))
+
+    assert (first, second, again) == ("primo:1", "secondo:2", "primo:3")
+    assert set(configured) == {"primo", "secondo", "spento"}
+    # Le opzioni proprie del server (limiti, cache) non vengono passate a mcp_use
+    assert "max_concurrency" not in configured["primo"]
+
+    assert before["primo"]["status"] == "connected" and before["primo"]["tools"] == 1
+    assert before["primo"]["transport"] == "stdio"
+    assert before["spento"]["status"] == "disconnected" and before["spento"]["failures"] == 1
+
+    assert after["primo"]["reconnects"] == 1
+    assert after["spento"]["failures"] == 2
+    assert wrapped.count("primo") == 2 and changes.count("primo") == 2
+
+
+if __name__ == "__main__":
+    test_shared_client_connects_all_servers_and_reconnects()
+    print("✅ Client MCP condiviso")
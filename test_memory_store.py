@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Test degli archivi per la memoria delle conversazioni (in-process e SQLite)
+
+Non richiede il server in esecuzione: verifica limite per utente, pulizia,
+statistiche e la condivisione della storia tra due istanze SQLite sullo
+stesso file (come due worker uvicorn).
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MCP_USE_ANONYMIZED_TELEMETRY", "false")
+
+from mcp_server import InMemoryMemoryStore, SQLiteMemoryStore
+
+
+def _message(role: str, content: str):
+    return {"role": role, "content": content, "timestamp": datetime.now().isoformat()}
+
+
+def _check_store(store):
+    for i in range(8):
+        store.append("user1", _message("user" if i % 2 == 0 else "assistant", f"msg-{i}"))
+    store.append("user2", _message("user", "ciao"))
+
+    messages = store.get_messages("user1")
+    assert [m["content"] for m in messages] == [f"msg-{i}" for i in range(3, 8)], messages
+    assert store.get_messages("nessuno") == []
+    assert store.has_user("user2") and not store.has_user("nessuno")
+
+    stats = store.get_user_stats()
+    assert stats["user1"]["message_count"] == 5
+    assert stats["user2"]["message_count"] == 1
+
+    assert store.clear("user1") == 1
+    assert store.clear("user1") == 0
+    assert store.get_messages("user1") == []
+    assert store.clear() == 1
+    assert store.get_user_stats() == {}
+
+
+def test_in_memory_store():
+    _check_store(InMemoryMemoryStore(limit=5))
+
+
+def test_sqlite_store():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteMemoryStore(limit=5, path=os.path.join(tmp, "memory.db"), batch_size=4)
+        try:
+            _check_store(store)
+        finally:
+            store.close()
+
+
+def test_sqlite_store_shared_between_workers():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "memory.db")
+        worker_a = SQLiteMemoryStore(limit=30, path=path, flush_interval=0.01)
+        worker_b = SQLiteMemoryStore(limit=30, path=path, flush_interval=0.01)
+        try:
+            worker_a.append("condiviso", _message("user", "dal worker A"))
+            worker_b.append("condiviso", _message("assistant", "dal worker B"))
+            worker_a.flush()
+            worker_b.flush()
+
+            for store in (worker_a, worker_b):
+                contents = [m["content"] for m in store.get_messages("condiviso")]
+                assert contents == ["dal worker A", "dal worker B"], contents
+        finally:
+            worker_a.close()
+            worker_b.close()
+
+        # La storia sopravvive al riavvio
+        reopened = SQLiteMemoryStore(limit=30, path=path)
+        try:
+            assert len(reopened.get_messages("condiviso")) == 2
+        finally:
+            reopened.close()
+
+
+def test_sqlite_full_batch_is_written_by_flusher_thread():
+    with tempfile.TemporaryDirectory() as tmp:
+        # flush_interval lungo: solo il blocco pieno può anticipare la scrittura
+        store = SQLiteMemoryStore(limit=30, path=os.path.join(tmp, "memory.db"), batch_size=3, flush_interval=30)
+        flush = store.flush
+        writers = []
+
+        def tracking_flush():
+            writers.append(threading.current_thread().name)
+            flush()
+
+        store.flush = tracking_flush
+        try:
+            for i in range(3):
+                store.append("utente", _message("user", f"msg-{i}"))
+            # append non scrive mai nel thread della richiesta
+            assert "MainThread" not in writers
+
+            deadline = time.monotonic() + 2
+            while store._pending and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert not store._pending and writers and set(writers) == {"memory-flusher"}
+            assert len(store.get_messages("utente")) == 3
+        finally:
+            store.close()
+
+
+def test_sqlite_read_latency():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteMemoryStore(limit=30, path=os.path.join(tmp, "memory.db"))
+        try:
+            for user in range(200):
+                for i in range(30):
+                    store.append(f"user-{user}", _message("user", f"messaggio {i} " * 20))
+            store.flush()
+
+            reads = 1000
+            start = time.perf_counter()
+            for i in range(reads):
+                store.get_messages(f"user-{i % 200}")
+            per_read_ms = (time.perf_counter() - start) / reads * 1000
+            print(f"   Lettura media SQLite: {per_read_ms:.3f} ms")
+            assert per_read_ms < 5
+        finally:
+            store.close()
+
+
+def test_in_memory_eviction():
+    store = InMemoryMemoryStore(limit=5, max_users=3)
+    for user in range(5):
+        store.append(f"user-{user}", _message("user", "ciao"))
+    # Un accesso rende user-2 il più recente: vengono rimossi user-0, user-1 e poi user-3
+    store.get_messages("user-2")
+    store.append("user-5", _message("user", "ciao"))
+    assert set(store.get_user_stats()) == {"user-2", "user-4", "user-5"}
+    assert store.evictions["max_users"] == 3
+
+    size = InMemoryMemoryStore._message_size(_message("user", "x" * 100))
+    store = InMemoryMemoryStore(limit=30, max_bytes=size * 10)
+    for i in range(20):
+        store.append(f"user-{i % 4}", _message("user", "x" * 100))
+    assert store.total_bytes <= size * 10
+    assert store.evictions["max_bytes"] > 0
+
+    store = InMemoryMemoryStore(limit=5, user_ttl=0.05)
+    store.append("inattivo", _message("user", "ciao"))
+    time.sleep(0.1)
+    store.append("attivo", _message("user", "ciao"))
+    assert store.sweep() == 1
+    assert not store.has_user("inattivo") and store.has_user("attivo")
+    assert store.evictions["ttl"] == 1
+
+
+def test_sqlite_eviction():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteMemoryStore(limit=5, path=os.path.join(tmp, "memory.db"), max_users=2)
+        try:
+            for user in range(4):
+                store.append(f"user-{user}", _message("user", "ciao"))
+                time.sleep(0.002)
+            assert store.sweep() == 2
+            assert set(store.get_user_stats()) == {"user-2", "user-3"}
+            assert store.evictions["max_users"] == 2
+        finally:
+            store.close()
+
+        store = SQLiteMemoryStore(limit=5, path=os.path.join(tmp, "ttl.db"), user_ttl=3600)
+        try:
+            old = {"role": "user", "content": "vecchio", "timestamp": "2020-01-01T00:00:00"}
+            store.append("inattivo", old)
+            store.append("attivo", _message("user", "nuovo"))
+            assert store.sweep() == 1
+            assert set(store.get_user_stats()) == {"attivo"}
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    print("🧪 Test archivi memoria conversazioni")
+    print("=" * 50)
+    for test in (test_in_memory_store, test_sqlite_store,
+                 test_sqlite_store_shared_between_workers, test_sqlite_full_batch_is_written_by_flusher_thread,
+                 test_sqlite_read_latency,
+                 test_in_memory_eviction, test_sqlite_eviction):
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            print(f"❌ {test.__name__}: {e}")
+            sys.exit(1)
@@ -0,0 +1,646 @@
+#!/usr/bin/env python3
+"""
+Test del function calling nativo di OpenRouterLLM
+
+Avvia un server OpenAI-compatibile locale (aiohttp) che risponde con una
+chiamata al tool finché non riceve il risultato, poi con la risposta finale.
+Non richiede chiavi API né server MCP.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("MCP_USE_ANONYMIZED_TELEMETRY", "false")
+
+import aiohttp
+from aiohttp import web
+from langchain.agents import create_agent
+from langchain_core.tools import BaseTool, tool
+
+import mcp_server
+from mcp_server import (CircuitOpenError, MetricsCallbackHandler, OpenRouterAPIError, OpenRouterLLM,
+                        OTLPJsonExporter, ProviderRateLimiter, ProviderResilience, RateLimitCallbackHandler,
+                        ToolCallLimiter, ToolResultCache, Tracer, TracingCallbackHandler, TracingMiddleware,
+                        http_pool, llm_resilience, rate_limiter, request_counters)
+
+
+@tool
+def conta_record(tabella: str) -> str:
+    """Conta i record di una tabella"""
+    return f"{tabella}: 42"
+
+
+def _completion(message, finish_reason):
+    return {"model": "stub", "choices": [{"message": message, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": 30, "completion_tokens": 20, "total_tokens": 50}}
+
+
+async def _start_stub_server(payloads, calls=(("conta_record", {"tabella": "rubrica"}),)):
+    """Server che chiede le chiamate ai tool indicate, poi risponde con i risultati ricevuti"""
+    async def chat(request):
+        payload = await request.json()
+        payloads.append(payload)
+        tool_results = [m for m in payload["messages"] if m["role"] == "tool"]
+        if payload.get("tools") and not tool_results:
+            return web.json_response(_completion({
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{i + 1}",
+                        "type": "function",
+                        "function": {"name": name, "arguments": json.dumps(args)}
+                    }
+                    for i, (name, args) in enumerate(calls)
+                ]
+            }, "tool_calls"))
+        if tool_results:
+            answer = "Risultato: " + ", ".join(m["content"] for m in tool_results)
+        else:
+            answer = "Nessun tool disponibile"
+        return web.json_response(_completion({"role": "assistant", "content": answer}, "stop"))
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def _run_agent(native_tools: bool):
+    payloads = []
+    runner, base_url = await _start_stub_server(payloads)
+    try:
+        llm = OpenRouterLLM(model="stub", api_key="test", base_url=base_url, native_tools=native_tools)
+        agent = create_agent(llm, tools=[conta_record])
+        result = await agent.ainvoke({"messages": [{"role": "user", "content": "Quanti record ha rubrica?"}]})
+        return llm, payloads, result["messages"]
+    finally:
+        await http_pool.close()
+        await runner.cleanup()
+
+
+def test_native_tool_calls_round_trip():
+    llm, payloads, messages = asyncio.run(_run_agent(native_tools=True))
+
+    assert len(payloads) == 2
+    assert payloads[0]["tools"][0]["function"]["name"] == "conta_record"
+    assert "tabella" in payloads[0]["tools"][0]["function"]["parameters"]["properties"]
+
+    # La chiamata al tool viene rimandata al modello con il suo risultato
+    assistant_call = payloads[1]["messages"][1]
+    assert assistant_call["tool_calls"][0]["function"]["name"] == "conta_record"
+    assert payloads[1]["messages"][2] == {"role": "tool", "tool_call_id": "call_1", "content": "rubrica: 42"}
+
+    assert messages[1].tool_calls[0]["args"] == {"tabella": "rubrica"}
+    assert messages[-1].content == "Risultato: rubrica: 42"
+
+    # Gli schemi dei tool vengono convertiti una sola volta
+    assert len(llm._tool_schemas) == 1
+
+
+async def _run_instrumented_agent():
+    runner, base_url = await _start_stub_server([])
+    counters = {"steps": 0}
+    token = request_counters.set(counters)
+    try:
+        llm = OpenRouterLLM(model="metriche", api_key="test", base_url=base_url)
+        agent = create_agent(llm, tools=[conta_record])
+        await agent.ainvoke({"messages": [{"role": "user", "content": "Quanti record ha rubrica?"}]},
+                            config={"callbacks": [MetricsCallbackHandler("openrouter", "metriche")]})
+        return counters
+    finally:
+        request_counters.reset(token)
+        await http_pool.close()
+        await runner.cleanup()
+
+
+def test_metrics_count_real_steps_llm_calls_and_tokens():
+    counters = asyncio.run(_run_instrumented_agent())
+    assert counters["steps"] == 1
+
+    labels = {"provider": "openrouter", "model": "metriche"}
+    assert mcp_server.LLM_LATENCY.count(status="ok", **labels) == 2
+    assert mcp_server.LLM_TOKENS.value(direction="in", **labels) == 60
+    assert mcp_server.LLM_TOKENS.value(direction="out", **labels) == 40
+    assert mcp_server.AGENT_STEPS.value(**labels) == 1
+
+    text = mcp_server.metrics.render()
+    assert "# TYPE mcp_llm_call_duration_seconds histogram" in text
+    assert 'mcp_llm_call_duration_seconds_bucket{provider="openrouter",model="metriche",status="ok",le="+Inf"} 2' in text
+    assert 'mcp_llm_tokens_total{provider="openrouter",model="metriche",direction="in"} 60' in text
+    assert 'mcp_agent_steps_total{provider="openrouter",model="metriche"} 1' in text
+
+
+async def _run_traced_agent(tracer):
+    runner, base_url = await _start_stub_server([])
+    try:
+        llm = OpenRouterLLM(model="stub", api_key="test", base_url=base_url)
+        agent = create_agent(llm, tools=[conta_record])
+        with tracer.span("mcp.query"):
+            await agent.ainvoke({"messages": [{"role": "user", "content": "Quanti record ha rubrica?"}]},
+                                config={"callbacks": [TracingCallbackHandler(tracer, "openrouter", "stub")]})
+    finally:
+        await http_pool.close()
+        await runner.cleanup()
+
+
+def test_tracing_exports_agent_steps_llm_and_tool_spans():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "traces.jsonl")
+        tracer = Tracer(enabled=True, exporter=OTLPJsonExporter(path=path))
+        asyncio.run(_run_traced_agent(tracer))
+
+        with open(path) as f:
+            lines = f.readlines()
+        assert len(lines) == 1
+        spans = json.loads(lines[0])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+
+    by_id = {span["spanId"]: span for span in spans}
+    names = sorted(span["name"] for span in spans)
+    assert names == ["agent.step model", "agent.step model", "agent.step tools", "llm.call", "llm.call",
+                     "mcp.query", "tool.call conta_record"]
+    assert len({span["traceId"] for span in spans}) == 1
+
+    # Chiamate LLM e tool sono figlie dei passi dell'agent, a loro volta figli della query
+    root = next(span for span in spans if span["name"] == "mcp.query")
+    assert "parentSpanId" not in root
+    for span in spans:
+        if span["name"].startswith("agent.step"):
+            assert span["parentSpanId"] == root["spanId"]
+        elif span is not root:
+            assert by_id[span["parentSpanId"]]["name"].startswith("agent.step")
+    llm_span = next(span for span in spans if span["name"] == "llm.call")
+    attributes = {a["key"]: a["value"] for a in llm_span["attributes"]}
+    assert attributes["llm.model"] == {"stringValue": "stub"}
+    assert attributes["llm.input_tokens"] == {"intValue": "30"}
+
+
+def test_tracing_middleware_returns_trace_id_and_filters_fast_requests():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    exported = []
+
+    class ListExporter(OTLPJsonExporter):
+        def export(self, spans):
+            exported.append(spans)
+
+    tracer = Tracer(enabled=True, exporter=ListExporter(), slow_ms=50)
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware, tracer=tracer)
+
+    @app.get("/veloce")
+    async def veloce():
+        with tracer.span("lavoro"):
+            return {"ok": True}
+
+    @app.get("/lento")
+    async def lento():
+        with tracer.span("lavoro"):
+            await asyncio.sleep(0.1)
+        return {"ok": True}
+
+    client = TestClient(app)
+    fast = client.get("/veloce")
+    assert len(fast.headers["x-trace-id"]) == 32
+    trace_id = "0af7651916cd43dd8448eb211c80319c"
+    slow = client.get("/lento", headers={"X-Trace-Id": trace_id})
+    assert slow.headers["x-trace-id"] == trace_id
+
+    # Solo la richiesta oltre slow_ms viene esportata, con lo span figlio
+    assert len(exported) == 1
+    assert {span.name for span in exported[0]} == {"GET /lento", "lavoro"}
+    assert all(span.trace_id == trace_id for span in exported[0])
+    assert tracer.get_stats()["open_traces"] == 0
+
+
+def test_native_tools_disabled_keeps_text_only_payload():
+    _, payloads, messages = asyncio.run(_run_agent(native_tools=False))
+
+    assert len(payloads) == 1
+    assert "tools" not in payloads[0]
+    assert messages[-1].content == "Nessun tool disponibile"
+
+
+class SlowConnector:
+    """Connector MCP finto: ogni tool attende i secondi indicati negli argomenti"""
+
+    async def call_tool(self, name, arguments, read_timeout_seconds=None):
+        await asyncio.sleep(arguments["secondi"])
+        return f"{name} ok"
+
+
+class ConnectorTool(BaseTool):
+    """Tool che passa dal connector come gli adapter di mcp_use"""
+
+    connector: Any
+    description: str = "Servizio lento"
+
+    def _run(self, **kwargs):
+        raise NotImplementedError
+
+    async def _arun(self, secondi: float) -> str:
+        try:
+            return await self.connector.call_tool(self.name, {"secondi": secondi})
+        except Exception as e:
+            return f"Errore: {e}"
+
+
+async def _run_fan_out():
+    connector = SlowConnector()
+    limiter = ToolCallLimiter({"mcpServers": {"servizi": {
+        "max_concurrency": 2, "tool_timeout": 1, "tool_timeouts": {"bloccato": 0.2}
+    }}})
+    limiter.wrap_connector("servizi", connector)
+    tools = [ConnectorTool(name=name, connector=connector) for name in ("uno", "due", "tre", "bloccato")]
+
+    calls = [("uno", {"secondi": 0.3}), ("due", {"secondi": 0.3}), ("tre", {"secondi": 0.3}),
+             ("bloccato", {"secondi": 5})]
+    runner, base_url = await _start_stub_server([], calls=calls)
+    try:
+        llm = OpenRouterLLM(model="stub", api_key="test", base_url=base_url)
+        agent = create_agent(llm, tools=tools)
+        start = time.perf_counter()
+        result = await agent.ainvoke({"messages": [{"role": "user", "content": "Interroga tutti i servizi"}]})
+        return limiter, time.perf_counter() - start, result["messages"][-1].content
+    finally:
+        await http_pool.close()
+        await runner.cleanup()
+
+
+def test_parallel_tool_calls_with_server_limit_and_timeout():
+    limiter, elapsed, answer = asyncio.run(_run_fan_out())
+
+    # Tre chiamate da 0.3s con al massimo 2 in parallelo: ~0.6s invece di 0.9s in sequenza
+    assert elapsed < 0.85, elapsed
+    assert "uno ok" in answer and "due ok" in answer and "tre ok" in answer
+    assert "non ha risposto entro 0.2 secondi" in answer
+
+    stats = limiter.get_stats()["servizi"]
+    assert stats["calls"] == 4
+    assert stats["max_in_flight"] == 2
+    assert stats["timeouts"] == 1
+    assert stats["in_flight"] == 0
+    assert mcp_server.TOOL_LATENCY.count(server="servizi", tool="bloccato", status="timeout") == 1
+    assert mcp_server.TOOL_LATENCY.count(server="servizi", tool="uno", status="ok") == 1
+
+
+class CountingConnector:
+    """Connector MCP finto che conta le chiamate effettivamente eseguite"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def call_tool(self, name, arguments, read_timeout_seconds=None):
+        self.calls.append((name, arguments))
+        await asyncio.sleep(0.05)
+        return type("Result", (), {"isError": name == "guasto", "content": f"{name}:{arguments}"})()
+
+
+def test_tool_result_cache_only_for_configured_tools():
+    cache = ToolResultCache({"mcpServers": {"db": {"tool_cache": {"tools": {"list_tables": 60, "guasto": 60}}}}},
+                            max_entries=2)
+    connector = CountingConnector()
+    cache.wrap_connector("db", connector)
+    cache.wrap_connector("db", connector)
+
+    async def scenario():
+        # Chiamate identiche contemporanee: una sola esecuzione
+        await asyncio.gather(*[connector.call_tool("list_tables", {"schema": "public"}) for _ in range(5)])
+        await connector.call_tool("list_tables", {"schema": "public"})
+        await connector.call_tool("list_tables", {"schema": "altro"})
+        # Tool non configurati ed esiti con errore non vengono salvati
+        await connector.call_tool("insert_record", {"id": 1})
+        await connector.call_tool("insert_record", {"id": 1})
+        await connector.call_tool("guasto", {})
+        await connector.call_tool("guasto", {})
+
+    asyncio.run(scenario())
+
+    names = [name for name, _ in connector.calls]
+    assert names.count("list_tables") == 2
+    assert names.count("insert_record") == 2
+    assert names.count("guasto") == 2
+
+    stats = cache.get_stats()
+    assert stats["shared"] == 4 and stats["hits"] == 1
+    assert stats["tools"]["db/list_tables"] == {"hits": 5, "misses": 2}
+    assert stats["entries"] == 2
+
+
+def test_tool_cache_waiter_survives_owner_cancellation():
+    cache = ToolResultCache({"mcpServers": {"db": {"tool_cache": {"tools": {"list_tables": 60}}}}})
+    calls = []
+
+    async def call_tool(name, arguments, read_timeout_seconds=None):
+        calls.append(name)
+        await asyncio.sleep(0.1)
+        return f"tabelle ({len(calls)})"
+
+    async def scenario():
+        owner = asyncio.create_task(cache.call("db", call_tool, "list_tables", {}))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.call("db", call_tool, "list_tables", {}))
+        await asyncio.sleep(0.01)
+        # Il client della prima richiesta si disconnette: chi attendeva lo stesso risultato prosegue
+        owner.cancel()
+        result = await waiter
+        return owner, result
+
+    owner, result = asyncio.run(scenario())
+    assert owner.cancelled()
+    assert result == "tabelle (2)" and len(calls) == 2
+    assert cache.get_stats()["shared"] == 1
+
+
+async def _run_scripted(responses, queries=None, outcomes=None):
+    """Esegue le query contro un server stub che risponde in ordine con (status, header[, ritardo])"""
+    sent = []
+
+    async def chat(request):
+        sent.append(time.monotonic())
+        status, headers, *delay = responses[len(sent) - 1]
+        if delay:
+            await asyncio.sleep(delay[0])
+        if status != 200:
+            return web.json_response({"error": "rate limited"}, status=status, headers=headers)
+        body = _completion({"role": "assistant", "content": "ok"}, "stop")
+        return web.json_response(body, headers=headers)
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    try:
+        llm = OpenRouterLLM(model="stub", api_key="test", base_url=base_url)
+        for _ in range(queries or len(responses)):
+            try:
+                result = await llm.ainvoke("ciao")
+            except Exception as e:
+                result = e
+            if outcomes is not None:
+                outcomes.append(result)
+        return sent
+    finally:
+        await http_pool.close()
+        await runner.cleanup()
+
+
+def test_rate_limiter_spaces_requests_and_follows_headers():
+    try:
+        # 600 richieste al minuto senza burst: una ogni 0.1s invece che tutte insieme
+        rate_limiter.configure({"providers": {"openrouter": {"rate_limits": {
+            "requests_per_minute": 600, "burst": 1, "tokens_per_minute": 60000
+        }}}})
+        sent = asyncio.run(_run_scripted([(200, {})] * 4))
+        gaps = [b - a for a, b in zip(sent, sent[1:])]
+        assert min(gaps) > 0.08, gaps
+
+        # Saldo esaurito negli header e 429 con Retry-After sospendono le richieste successive
+        rate_limiter.configure({"providers": {"openrouter": {}}})
+        sent = asyncio.run(_run_scripted([
+            (200, {"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "300ms"}),
+            (429, {"Retry-After": "0.3"}),
+            (200, {})
+        ], queries=2))
+        assert sent[1] - sent[0] > 0.25 and sent[2] - sent[1] > 0.25
+
+        stats = rate_limiter.get_stats()["openrouter/stub"]
+        assert stats["rate_limited"] == 1 and stats["header_updates"] == 1
+        assert stats["throttled"] >= 4
+    finally:
+        rate_limiter.configure({})
+
+
+def test_retries_and_circuit_breaker():
+    try:
+        llm_resilience.configure({"providers": {"openrouter": {"resilience": {
+            "max_retries": 2, "backoff_base": 0.01, "failure_threshold": 3, "open_seconds": 60
+        }}}})
+        outcomes = []
+        # Due 503 ritentati con successo, poi un 400 che non si ritenta
+        sent = asyncio.run(_run_scripted([(503, {}), (503, {}), (200, {}), (400, {})], queries=2, outcomes=outcomes))
+        assert len(sent) == 4
+        assert outcomes[0].content == "ok" and isinstance(outcomes[1], Exception)
+
+        # Tre errori consecutivi aprono il circuito: la query successiva non arriva al provider
+        outcomes = []
+        sent = asyncio.run(_run_scripted([(500, {}), (502, {}), (504, {})], queries=2, outcomes=outcomes))
+        assert len(sent) == 3
+        assert isinstance(outcomes[1], CircuitOpenError) and outcomes[1].retry_after > 0
+
+        stats = llm_resilience.get_stats()["openrouter/stub"]
+        assert stats["circuit"] == "open" and stats["circuit_opened"] == 1
+        assert stats["retries"] == 4 and stats["rejected"] == 1
+    finally:
+        llm_resilience.configure({})
+
+
+async def _stream_from_stub(lines):
+    """Raccoglie i chunk di OpenRouterLLM.astream da un server che invia le righe SSE indicate"""
+    async def chat(request):
+        payload = await request.json()
+        assert payload["stream"] is True
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for line in lines:
+            await response.write(f"{line}\n\n".encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    llm = OpenRouterLLM(model="stub", api_key="test",
+                        base_url=f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}")
+    chunks = []
+    try:
+        async for chunk in llm.astream("ciao"):
+            chunks.append(chunk)
+        return chunks, None
+    except Exception as e:
+        return chunks, e
+    finally:
+        await http_pool.close()
+        await runner.cleanup()
+
+
+def _delta(**delta):
+    return "data: " + json.dumps({"choices": [{"index": 0, "delta": delta}]})
+
+
+def test_stream_parses_sse_deltas_done_and_error_events():
+    tool_call = {"index": 0, "id": "call_1", "type": "function", "function": {"name": "conta_record", "arguments": ""}}
+    chunks, error = asyncio.run(_stream_from_stub([
+        ": OPENROUTER PROCESSING",
+        _delta(role="assistant", content=""),
+        _delta(content="Ciao"),
+        "data: {non json",
+        _delta(content=", mondo"),
+        _delta(tool_calls=[tool_call]),
+        _delta(tool_calls=[{"index": 0, "function": {"arguments": '{"tabella": "rubrica"}'}}]),
+        "data: [DONE]",
+        _delta(content="dopo DONE")
+    ]))
+    assert error is None
+    # Commenti keep-alive, delta vuoti e righe non valide vengono saltati; nulla dopo [DONE]
+    assert [c.content for c in chunks if c.content] == ["Ciao", ", mondo"]
+    assert sum(len(c.tool_call_chunks) for c in chunks) == 2
+    message = chunks[0]
+    for chunk in chunks[1:]:
+        message = message + chunk
+    assert message.content == "Ciao, mondo"
+    assert message.tool_calls == [{"name": "conta_record", "args": {"tabella": "rubrica"},
+                                   "id": "call_1", "type": "tool_call"}]
+
+    # Un evento error a metà stream interrompe la generazione con lo status del provider
+    chunks, error = asyncio.run(_stream_from_stub([
+        _delta(content="Parziale"),
+        "data: " + json.dumps({"error": {"code": 502, "message": "Provider disconnesso"}}),
+        _delta(content="mai letto")
+    ]))
+    assert [c.content for c in chunks if c.content] == ["Parziale"]
+    assert isinstance(error, OpenRouterAPIError) and error.status == 502
+    assert "Provider disconnesso" in str(error) and ProviderResilience.is_retryable(error)[0]
+
+
+def test_network_errors_keep_their_type_and_are_retryable():
+    async def scenario():
+        # Porta chiusa: l'errore di connessione arriva al chiamante con il suo tipo, dopo i retry
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            closed_port = probe.getsockname()[1]
+        llm = OpenRouterLLM(model="stub", api_key="test", base_url=f"http://127.0.0.1:{closed_port}")
+        try:
+            await llm.ainvoke("ciao")
+        except Exception as e:
+            return e
+        finally:
+            await http_pool.close()
+
+    try:
+        llm_resilience.configure({"providers": {"openrouter": {"resilience": {"max_retries": 1, "backoff_base": 0.01}}}})
+        error = asyncio.run(scenario())
+        assert isinstance(error, aiohttp.ClientConnectionError), repr(error)
+        assert llm_resilience.get_stats()["openrouter/stub"]["retries"] == 1
+    finally:
+        llm_resilience.configure({})
+
+    assert ProviderResilience.is_retryable(asyncio.TimeoutError())[0]
+    assert ProviderResilience.is_retryable(OpenRouterAPIError("overloaded", status=503))[0]
+    # Si classifica per tipo e status, non per numeri che compaiono nel messaggio
+    assert not ProviderResilience.is_retryable(Exception("tabella ordini_500 non trovata sulla porta 5003"))[0]
+    assert not ProviderResilience.is_retryable(OpenRouterAPIError("richiesta non valida 503", status=400))[0]
+    assert ProviderResilience.is_retryable(Exception("429 RESOURCE_EXHAUSTED"))[0]
+
+
+
+def test_http_session_closed_when_event_loop_changes():
+    """La sessione condivisa creata su un altro event loop viene chiusa, non abbandonata"""
+    async def get_session():
+        return http_pool.get_session()
+
+    # Loop originale ancora attivo in un altro thread: la chiusura viene eseguita su di esso
+    other_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=other_loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        first = asyncio.run_coroutine_threadsafe(get_session(), other_loop).result(timeout=5)
+
+        async def scenario():
+            second = http_pool.get_session()
+            for _ in range(100):
+                if first.closed:
+                    break
+                await asyncio.sleep(0.01)
+            return second
+
+        second = asyncio.run(scenario())
+        assert first.closed and second is not first
+    finally:
+        other_loop.call_soon_threadsafe(other_loop.stop)
+        thread.join(timeout=5)
+        other_loop.close()
+
+    # Loop originale già chiuso (asyncio.run terminato): la sessione si chiude dal nuovo loop
+    async def replace():
+        third = http_pool.get_session()
+        await asyncio.sleep(0.01)
+        await http_pool.close()
+        return third
+
+    third = asyncio.run(replace())
+    assert second.closed and third.closed
+
+def test_hedged_request_after_p95():
+    try:
+        llm_resilience.configure({"providers": {"openrouter": {"resilience": {
+            "hedge": True, "hedge_min_samples": 3, "hedge_min_delay": 0.05
+        }}}})
+        outcomes = []
+        # La quarta risposta è lenta: dopo il p95 parte una seconda richiesta che risponde subito
+        sent = asyncio.run(_run_scripted([(200, {})] * 3 + [(200, {}, 2), (200, {})], queries=4, outcomes=outcomes))
+        assert len(sent) == 5 and sent[4] - sent[3] < 0.5 and all(o.content == "ok" for o in outcomes)
+        stats = llm_resilience.get_stats()["openrouter/stub"]
+        assert stats["hedged"] == 1 and stats["hedge_wins"] == 1
+    finally:
+        llm_resilience.configure({})
+
+
+def test_rate_limit_callback_for_models_without_headers():
+    limiter = ProviderRateLimiter({"providers": {"gemini": {"rate_limits": {
+        "requests_per_minute": 6000, "tokens_per_minute": 600, "token_burst": 100,
+        "models": {"lento": {"requests_per_minute": 600, "burst": 1}}
+    }}}})
+    handler = RateLimitCallbackHandler(limiter, "gemini", "lento")
+
+    async def scenario():
+        start = time.monotonic()
+        for run_id in range(3):
+            await handler.on_chat_model_start({}, [[type("Msg", (), {"content": "x" * 40})()]], run_id=run_id)
+        elapsed = time.monotonic() - start
+        await handler.on_llm_error(Exception("429 RESOURCE_EXHAUSTED"), run_id=3)
+        return elapsed
+
+    elapsed = asyncio.run(scenario())
+    assert elapsed > 0.18, elapsed
+    stats = limiter.get_stats()["gemini/lento"]
+    assert stats["requests_per_minute"] == 600 and stats["tokens_per_minute"] == 600
+    assert stats["rate_limited"] == 1 and stats["blocked_for"] > 0
+
+
+if __name__ == "__main__":
+    test_native_tool_calls_round_trip()
+    test_metrics_count_real_steps_llm_calls_and_tokens()
+    test_tracing_exports_agent_steps_llm_and_tool_spans()
+    test_tracing_middleware_returns_trace_id_and_filters_fast_requests()
+    test_native_tools_disabled_keeps_text_only_payload()
+    test_parallel_tool_calls_with_server_limit_and_timeout()
+    test_tool_result_cache_only_for_configured_tools()
+    test_tool_cache_waiter_survives_owner_cancellation()
+    test_rate_limiter_spaces_requests_and_follows_headers()
+    test_retries_and_circuit_breaker()
+    test_network_errors_keep_their_type_and_are_retryable()
+    test_stream_parses_sse_deltas_done_and_error_events()
+    test_http_session_closed_when_event_loop_changes()
+    test_hedged_request_after_p95()
+    test_rate_limit_callback_for_models_without_headers()
+    print("✅ Function calling nativo OpenRouter")